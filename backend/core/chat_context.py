@@ -0,0 +1,226 @@
+"""Token-budgeted prompt assembly for /agent chat with a rolling conversation summary.
+
+The prompt is filled from the newest messages backwards until CHAT_CONTEXT_TOKENS (counted with
+the model's tokenizer when tiktoken is installed, estimated otherwise) is used up. Turns that no
+longer fit are folded into a rolling summary cached on the session as
+metadata["summary"] = {"text": ..., "upto_id": <last folded message id>}. Summaries are produced
+in the background after the reply, so a turn never waits on one; until the summary catches up,
+the oldest turns are simply left out.
+"""
+from __future__ import annotations
+
+import asyncio
+import os
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from sqlalchemy.orm import Session
+
+from core.dependencies import SessionLocal, logger
+from core.mapcoder.provider import acomplete
+from core.models import AgentMessage, AgentSession
+
+try:
+    import tiktoken
+except Exception:  # pragma: no cover - optional dependency
+    tiktoken = None
+
+# prompt budget (context + summary + question), excluding the completion
+CHAT_CONTEXT_TOKENS = int(os.environ.get("CHAT_CONTEXT_TOKENS", "3000"))
+CHAT_SUMMARY_TOKENS = int(os.environ.get("CHAT_SUMMARY_TOKENS", "400"))
+# how much old conversation one summarization call reads
+CHAT_SUMMARY_INPUT_TOKENS = int(os.environ.get("CHAT_SUMMARY_INPUT_TOKENS", "3000"))
+# fold once at least this many messages have dropped out of the window
+CHAT_SUMMARY_MIN_MESSAGES = int(os.environ.get("CHAT_SUMMARY_MIN_MESSAGES", "4"))
+
+_PAGE = 50
+_ENCODERS: Dict[str, Any] = {}
+
+
+def _encoder(model: Optional[str]):
+    if tiktoken is None:
+        return None
+    name = model or ""
+    enc = _ENCODERS.get(name)
+    if enc is None:
+        try:
+            enc = tiktoken.encoding_for_model(name)
+        except Exception:
+            enc = tiktoken.get_encoding("cl100k_base")
+        _ENCODERS[name] = enc
+    return enc
+
+
+def count_tokens(text: str, model: Optional[str] = None) -> int:
+    """Tokens of `text` for `model`; without tiktoken ~4 ASCII chars or 1 CJK char per token."""
+    if not text:
+        return 0
+    enc = _encoder(model)
+    if enc is not None:
+        return len(enc.encode(text, disallowed_special=()))
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return ascii_chars // 4 + (len(text) - ascii_chars) + 1
+
+
+@dataclass
+class ChatContext:
+    prompt: str
+    prompt_tokens: int
+    messages: int
+    summary_upto: int
+    # newest message id that fell out of the window and is not summarized yet (0 = none)
+    fold_upto: int = 0
+    unfolded: int = 0
+
+    @property
+    def needs_summary(self) -> bool:
+        return self.unfolded >= CHAT_SUMMARY_MIN_MESSAGES
+
+
+def _line(role: str, content: str) -> str:
+    return f"{role}: {content}"
+
+
+def _render(summary: str, lines: List[str], question: str) -> str:
+    parts = []
+    if summary:
+        parts.append(f"较早对话摘要:\n{summary}")
+    if lines:
+        parts.append("对话上下文:\n" + "\n".join(lines))
+    parts.append(f"用户问题: {question}")
+    return "\n\n".join(parts) + "\n\n请基于上述对话内容直接回答用户的问题。"
+
+
+def build_context(db: Session, session: AgentSession, question: str, model: Optional[str] = None,
+                  budget: int = CHAT_CONTEXT_TOKENS, max_messages: Optional[int] = None) -> ChatContext:
+    """Newest messages that fit in `budget` after the summary and the question (oldest first in
+    the prompt). Only reads as many rows as fit, plus one page to learn what was left out."""
+    summary = (session.metadata_ or {}).get("summary") or {}
+    summary_text = summary.get("text") or ""
+    upto = int(summary.get("upto_id") or 0)
+    remaining = budget - count_tokens(_render(summary_text, [], question), model)
+
+    lines: List[str] = []
+    fold_upto, unfolded = 0, 0
+    before: Optional[int] = None
+    full = False
+    while True:
+        query = db.query(AgentMessage.id, AgentMessage.role, AgentMessage.content).filter(
+            AgentMessage.session_id == session.id, AgentMessage.id > upto)
+        if before is not None:
+            query = query.filter(AgentMessage.id < before)
+        rows = query.order_by(AgentMessage.id.desc()).limit(_PAGE).all()
+        for mid, role, content in rows:
+            if not full:
+                line = _line(role, content)
+                cost = count_tokens(line, model) + 1
+                if cost <= remaining and (max_messages is None or len(lines) < max_messages):
+                    lines.append(line)
+                    remaining -= cost
+                    continue
+                full = True
+                fold_upto = mid
+            unfolded += 1
+        if len(rows) < _PAGE or (full and unfolded >= CHAT_SUMMARY_MIN_MESSAGES):
+            break
+        before = rows[-1].id
+    lines.reverse()
+    prompt = _render(summary_text, lines, question)
+    return ChatContext(prompt=prompt, prompt_tokens=budget - remaining, messages=len(lines), summary_upto=upto,
+                       fold_upto=fold_upto, unfolded=unfolded)
+
+
+# ------------------------------------------------------------------------------------------------
+# Rolling summary (background)
+# ------------------------------------------------------------------------------------------------
+
+_RUNNING: Set[int] = set()
+_TASKS: Set[asyncio.Task] = set()
+
+
+def _load_fold(session_id: int, upto: int, fold_upto: int, model: Optional[str]) -> Tuple[str, List[str], int]:
+    """Current summary and the next chunk of messages in (upto, fold_upto] that fits the input budget."""
+    db = SessionLocal()
+    try:
+        session = db.query(AgentSession).filter_by(id=session_id).first()
+        summary = ((session.metadata_ or {}).get("summary") or {}) if session else {}
+        if int(summary.get("upto_id") or 0) != upto:
+            return "", [], upto  # someone else moved the summary on
+        rows = (
+            db.query(AgentMessage.id, AgentMessage.role, AgentMessage.content)
+            .filter(AgentMessage.session_id == session_id, AgentMessage.id > upto, AgentMessage.id <= fold_upto)
+            .order_by(AgentMessage.id.asc())
+            .limit(_PAGE)
+            .all()
+        )
+        lines, last, used = [], upto, 0
+        for mid, role, content in rows:
+            line = _line(role, content)
+            cost = count_tokens(line, model)
+            if lines and used + cost > CHAT_SUMMARY_INPUT_TOKENS:
+                break
+            if cost > CHAT_SUMMARY_INPUT_TOKENS:
+                line = line[:CHAT_SUMMARY_INPUT_TOKENS] + "…"
+            lines.append(line)
+            used += cost
+            last = mid
+        return summary.get("text") or "", lines, last
+    finally:
+        db.close()
+
+
+def _store_summary(session_id: int, expected_upto: int, text: str, upto: int) -> bool:
+    db = SessionLocal()
+    try:
+        session = db.query(AgentSession).filter_by(id=session_id).first()
+        if not session:
+            return False
+        meta = dict(session.metadata_ or {})
+        if int((meta.get("summary") or {}).get("upto_id") or 0) != expected_upto:
+            return False
+        meta["summary"] = {"text": text, "upto_id": upto}
+        session.metadata_ = meta
+        db.commit()
+        return True
+    except Exception:
+        db.rollback()
+        logger.warning(f"保存对话摘要失败 session={session_id}", exc_info=True)
+        return False
+    finally:
+        db.close()
+
+
+async def _fold(session_id: int, upto: int, fold_upto: int, model: Optional[str], api_key: Optional[str]) -> None:
+    try:
+        while upto < fold_upto:
+            previous, lines, last = await asyncio.to_thread(_load_fold, session_id, upto, fold_upto, model)
+            if not lines:
+                return
+            prompt = (f"请将以下对话压缩成不超过 {CHAT_SUMMARY_TOKENS} token 的摘要，保留关键事实、结论、"
+                      f"用户偏好与未解决的问题，只输出摘要：\n")
+            if previous:
+                prompt += f"\n已有摘要：\n{previous}\n"
+            prompt += "\n新增对话：\n" + "\n".join(lines)
+            resp = await acomplete(prompt, model, max_tokens=CHAT_SUMMARY_TOKENS, temperature=0.0, api_key=api_key,
+                                   role="summary")
+            if not resp.text:
+                return
+            if not await asyncio.to_thread(_store_summary, session_id, upto, resp.text.strip(), last):
+                return
+            upto = last
+        logger.info(f"会话 {session_id} 对话摘要已更新至消息 {upto}")
+    except Exception:
+        logger.warning(f"生成对话摘要失败 session={session_id}", exc_info=True)
+    finally:
+        _RUNNING.discard(session_id)
+
+
+def schedule_summary(session_id: int, ctx: ChatContext, model: Optional[str], api_key: Optional[str] = None) -> None:
+    """Fold messages that fell out of the window into the session summary, in the background on the
+    running loop (at most one summarization per session at a time)."""
+    if not ctx.needs_summary or session_id in _RUNNING:
+        return
+    _RUNNING.add(session_id)
+    task = asyncio.ensure_future(_fold(session_id, ctx.summary_upto, ctx.fold_upto, model, api_key))
+    _TASKS.add(task)
+    task.add_done_callback(_TASKS.discard)
@@ -9,16 +9,19 @@ _env_path = _here / '.env'
 if _env_path.exists():
     load_dotenv(dotenv_path=_env_path)
 
-import json
 import logging
+import os
+import time
 from urllib.parse import quote_plus
 
 import redis
 from fastapi.security import OAuth2PasswordBearer
 from passlib.context import CryptContext
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+
+from core.metrics import DB_COMMIT_SECONDS, EVENT_PUBLISH_SECONDS
 
 # PostgresSQL 配置
 DB_USER = "postgres"
@@ -28,12 +31,35 @@ DB_PORT = "5432"
 DB_NAME = "agent_db"
 encoded_password = quote_plus(DB_PASSWORD)
 SQLALCHEMY_DATABASE_URL = f"postgresql://{DB_USER}:{encoded_password}@{DB_HOST}:{DB_PORT}/{DB_NAME}?client_encoding=utf8"
-engine = create_engine(SQLALCHEMY_DATABASE_URL, pool_pre_ping=True, connect_args={"options": "-c client_encoding=utf8"})
+# DATABASE_URL 可覆盖默认库（如基准测试使用 sqlite:///bench.db）
+SQLALCHEMY_DATABASE_URL = os.environ.get("DATABASE_URL") or SQLALCHEMY_DATABASE_URL
+if SQLALCHEMY_DATABASE_URL.startswith("sqlite"):
+    engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False, "timeout": 30})
+else:
+    engine = create_engine(SQLALCHEMY_DATABASE_URL, pool_pre_ping=True, connect_args={"options": "-c client_encoding=utf8"})
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
 
+# 提交耗时（含 flush）计入 db_commit_seconds
+@event.listens_for(Session, "before_commit")
+def _commit_started(session):
+    session.info["_commit_started"] = time.perf_counter()
+
+
+@event.listens_for(Session, "after_commit")
+def _commit_finished(session):
+    started = session.info.pop("_commit_started", None)
+    if started is not None:
+        DB_COMMIT_SECONDS.observe(time.perf_counter() - started)
+
+
+@event.listens_for(Session, "after_rollback")
+def _commit_aborted(session):
+    session.info.pop("_commit_started", None)
+
+
 def get_db():
     db = SessionLocal()
     try:
@@ -72,26 +98,38 @@ def get_redis():
         pass
 
 
-def publish_event(session_id: int, event: dict, redis_client: redis.Redis | None = None) -> None:
-    """Publish a JSON event to the session Redis channel: session:{id}:events.
+def publish_event(session_id: int, event: dict, redis_client: redis.Redis | None = None, log: bool = True) -> str | None:
+    """Publish a JSON event for the session on the event bus (see core.event_bus).
+
+    With Redis this is the channel session:{id}:events plus the session's capped event log, so SSE
+    clients can resume from Last-Event-ID; without Redis it is the in-process bus. Returns the
+    event id, or None when publishing failed. `log=False` only publishes (for high-volume,
+    superseded events such as token deltas, which would otherwise push real updates out of the log).
 
     Notes:
-    - `get_redis()` is a FastAPI dependency generator intended to be used with `Depends(get_redis)`
-      inside endpoint functions so FastAPI can manage the dependency lifecycle.
     - `publish_event` is a general helper that can be called from background tasks or
       other non-request code where FastAPI's dependency injection isn't available.
-      Therefore it defaults to creating/using a Redis client from the shared connection pool.
+      It uses the process-wide bus and its shared client; no client is created per call.
     - By accepting an optional `redis_client`, callers (including unit tests) can inject
-      a client (for example the one from `get_redis()` in an endpoint) for better control.
+      a client (for example the one from `get_redis()` in an endpoint) for better control;
+      the event then always goes through Redis.
     """
+    from core.event_bus import encode_event, get_event_bus
+
+    started = time.perf_counter()
     try:
-        r = redis_client if redis_client is not None else redis.Redis(connection_pool=redis_pool)
-        channel = f"session:{session_id}:events"
-        payload = json.dumps(event, ensure_ascii=False, default=str)
-        r.publish(channel, payload)
+        payload = encode_event(event)
+        bus = get_event_bus()
+        if redis_client is not None and bus.backend != "redis":
+            from core.event_bus import RedisEventBus
+            bus = RedisEventBus(redis_client)
+        event_id = bus.publish(session_id, payload, log=log, client=redis_client)
+        EVENT_PUBLISH_SECONDS.observe(time.perf_counter() - started)
+        return event_id
     except Exception as e:
         logger = logging.getLogger(__name__)
         logger.warning(f"publish_event failed for session {session_id}: {e}")
+        return None
 
 
 # JWT 和密码哈希配置
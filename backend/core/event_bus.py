@@ -0,0 +1,330 @@
+"""Session event bus: where publish_event sends events and where the SSE hub reads them.
+
+Backends:
+- RedisEventBus: every event is appended to a capped per-session Redis Stream
+  (session:{id}:log) and PUBLISHed on session:{id}:events in one Lua call; API processes
+  pattern-subscribe. Works across processes (dedicated session workers, several API workers).
+- InMemoryEventBus: in-process fallback when Redis is unavailable. Publishers (request handlers,
+  embedded session worker threads) hand events to the API loop with call_soon_threadsafe and a
+  bounded per-session deque stands in for the stream, so Last-Event-ID replay still works. Only
+  for single-process deployments: events from another process are not seen.
+
+EVENT_BUS_BACKEND = auto | redis | memory (auto: Redis if it answers a ping at first use).
+Both backends hand subscribers "<event id>\\n<json>" (no id prefix for unlogged events) and use
+Redis-style "ms-seq" ids.
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+import redis
+
+from core.dependencies import REDIS_DB, REDIS_HOST, REDIS_PORT, logger, redis_pool
+from core.metrics import EVENT_TRUNCATED
+
+try:
+    import redis.asyncio as aioredis
+except Exception:  # pragma: no cover - redis-py < 4.2
+    aioredis = None
+
+EVENT_BUS_BACKEND = os.environ.get("EVENT_BUS_BACKEND", "auto").lower()  # auto | redis | memory
+# 会话事件日志：断线重连时按 Last-Event-ID 补发
+SESSION_EVENT_LOG_MAXLEN = int(os.environ.get("SESSION_EVENT_LOG_MAXLEN", "500"))
+SESSION_EVENT_LOG_TTL = int(os.environ.get("SESSION_EVENT_LOG_TTL", "86400"))
+# sessions whose log the in-memory backend keeps (least recently published dropped first)
+EVENT_BUS_MEMORY_SESSIONS = int(os.environ.get("EVENT_BUS_MEMORY_SESSIONS", "1000"))
+# hard cap on one encoded event (UTF-8 bytes); larger events are shrunk by encode_event
+EVENT_MAX_BYTES = int(os.environ.get("EVENT_MAX_BYTES", "16384"))
+# preview length of artifacts referenced from events / of strings cut by the size cap
+EVENT_PREVIEW_CHARS = int(os.environ.get("EVENT_PREVIEW_CHARS", "280"))
+EVENT_CHANNEL_PATTERN = "session:*:events"
+_RECONNECT_MAX_DELAY = 10.0
+_EVENT_ID = re.compile(r"^\d+-\d+$")
+
+# (log entry id or None for unlogged events, JSON payload)
+Event = Tuple[Optional[str], str]
+Dispatch = Callable[[str, str], None]
+
+
+def parse_event_id(value: Optional[str]) -> Optional[Tuple[int, int]]:
+    """Event id "ms-seq" as a comparable tuple; None if absent or malformed."""
+    if not value or not _EVENT_ID.match(value.strip()):
+        return None
+    ms, seq = value.strip().split("-")
+    return int(ms), int(seq)
+
+
+def session_event_channel(session_id: int) -> str:
+    return f"session:{session_id}:events"
+
+
+def session_event_log_key(session_id: int) -> str:
+    return f"session:{session_id}:log"
+
+
+def _preview(text: str, limit: int = EVENT_PREVIEW_CHARS) -> str:
+    return text if len(text) <= limit else text[:limit] + "…"
+
+
+def content_ref(value: Any, preview: Optional[str] = None) -> Dict[str, Any]:
+    """Reference to a large value for events: content hash, JSON size and a short preview.
+
+    Clients compare the hash with what they hold and fetch the full value from the API only when
+    it changed (the artifact endpoints return the same hash as ETag).
+    """
+    raw = json.dumps(value, ensure_ascii=False, sort_keys=True, default=str)
+    return {
+        "hash": hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16],
+        "size": len(raw),
+        "preview": _preview(preview if preview is not None else raw),
+    }
+
+
+def _truncate(value: Any) -> Any:
+    if isinstance(value, str):
+        return _preview(value)
+    if isinstance(value, dict):
+        return {k: _truncate(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_truncate(v) for v in value]
+    return value
+
+
+def _skeleton(event: Dict[str, Any]) -> Dict[str, Any]:
+    """Type, scalars and the ids/status of nested objects: enough for a client to refetch."""
+    out: Dict[str, Any] = {}
+    for key, value in event.items():
+        if isinstance(value, dict):
+            out[key] = {k: v for k, v in value.items() if k in ("id", "session_id", "task_id", "status", "updated_at")}
+        elif not isinstance(value, (list, tuple, str)) or len(value) <= EVENT_PREVIEW_CHARS:
+            out[key] = value
+    return out
+
+
+def encode_event(event: Dict[str, Any]) -> str:
+    """JSON for the wire, capped at EVENT_MAX_BYTES.
+
+    An oversized event first has its long strings cut to previews; if it is still too large it is
+    reduced to its skeleton. Either way it is marked `truncated` so the client reloads the full data.
+    """
+    if "ts" not in event:
+        # publish time (epoch seconds) so subscribers can measure delivery lag
+        event = {**event, "ts": round(time.time(), 4)}
+    payload = json.dumps(event, ensure_ascii=False, default=str)
+    # a character is at most 4 bytes in UTF-8: only measure bytes when it can matter
+    if EVENT_MAX_BYTES <= 0 or len(payload) * 4 <= EVENT_MAX_BYTES or len(payload.encode("utf-8")) <= EVENT_MAX_BYTES:
+        return payload
+    size = len(payload.encode("utf-8"))
+    kind = str(event.get("type") or "unknown")
+    EVENT_TRUNCATED.inc(type=kind)
+    logger.warning(f"会话事件 {kind} 大小 {size}B 超出上限 {EVENT_MAX_BYTES}B，已截断")
+    shrunk = json.dumps({**_truncate(event), "truncated": True, "size": size}, ensure_ascii=False, default=str)
+    if len(shrunk.encode("utf-8")) <= EVENT_MAX_BYTES:
+        return shrunk
+    return json.dumps({**_skeleton(event), "truncated": True, "size": size}, ensure_ascii=False, default=str)
+
+
+def _message(event_id: Optional[str], payload: str) -> str:
+    return payload if event_id is None else f"{event_id}\n{payload}"
+
+
+def split_message(message: str) -> Event:
+    head, sep, body = message.partition("\n")
+    if sep and _EVENT_ID.match(head):
+        return head, body
+    return None, message
+
+
+# XADD + PUBLISH in one round trip and in one order: the live message carries the log entry id
+# so subscribers can emit it as the SSE id and de-duplicate against a replay.
+_PUBLISH_LUA = """
+local id = redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[1], '*', 'data', ARGV[2])
+if tonumber(ARGV[3]) > 0 then redis.call('EXPIRE', KEYS[1], ARGV[3]) end
+redis.call('PUBLISH', KEYS[2], id .. '\\n' .. ARGV[2])
+return id
+"""
+_publish_script = redis.Redis(connection_pool=redis_pool).register_script(_PUBLISH_LUA)
+
+
+class RedisEventBus:
+    backend = "redis"
+
+    def __init__(self, client: Optional[redis.Redis] = None) -> None:
+        self.client = client or redis.Redis(connection_pool=redis_pool)
+        self._reads = None  # async client for replays, bound to the API loop
+        self._reads_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def publish(self, session_id: int, payload: str, log: bool = True,
+                client: Optional[redis.Redis] = None) -> Optional[str]:
+        r = client if client is not None else self.client
+        if not log:
+            r.publish(session_event_channel(session_id), payload)
+            return None
+        event_id = _publish_script(keys=[session_event_log_key(session_id), session_event_channel(session_id)],
+                                  args=[SESSION_EVENT_LOG_MAXLEN, payload, SESSION_EVENT_LOG_TTL], client=r)
+        return event_id.decode() if isinstance(event_id, bytes) else event_id
+
+    def publish_many(self, events: List[Tuple[int, str, bool]]) -> List[Optional[str]]:
+        """Publish (session_id, payload, log) in order in one pipelined round trip."""
+        pipe = self.client.pipeline(transaction=False)
+        for session_id, payload, log in events:
+            if log:
+                _publish_script(keys=[session_event_log_key(session_id), session_event_channel(session_id)],
+                                args=[SESSION_EVENT_LOG_MAXLEN, payload, SESSION_EVENT_LOG_TTL], client=pipe)
+            else:
+                pipe.publish(session_event_channel(session_id), payload)
+        results = pipe.execute()
+        return [(r.decode() if isinstance(r, bytes) else r) if log else None for r, (_, _, log) in zip(results, events)]
+
+    async def listen(self, dispatch: Dispatch, connected: asyncio.Event) -> None:
+        """Pattern-subscribe and feed every session message to `dispatch` until cancelled, reconnecting with backoff."""
+        if aioredis is None:
+            logger.warning("redis.asyncio 不可用（需要 redis-py >= 4.2），SSE 事件分发已禁用")
+            return
+        delay = 0.5
+        while True:
+            client = aioredis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decode_responses=True)
+            pubsub = client.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.psubscribe(EVENT_CHANNEL_PATTERN)
+                connected.set()
+                delay = 0.5
+                logger.info(f"SSE 事件分发已订阅 {EVENT_CHANNEL_PATTERN}")
+                async for message in pubsub.listen():
+                    if message.get("type") == "pmessage":
+                        dispatch(str(message.get("channel")), str(message.get("data")))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"SSE 事件订阅中断: {e}；{delay:.1f}s 后重连")
+            finally:
+                connected.clear()
+                try:
+                    await pubsub.close()
+                    await client.close()
+                except Exception:
+                    pass
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, _RECONNECT_MAX_DELAY)
+
+    async def read_log(self, session_id: int, start_id: str) -> List[Event]:
+        """Logged events from `start_id` (inclusive), oldest first."""
+        if aioredis is None:
+            return []
+        loop = asyncio.get_running_loop()
+        if self._reads is None or self._reads_loop is not loop:
+            self._reads = aioredis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decode_responses=True,
+                                         max_connections=10)
+            self._reads_loop = loop
+        entries = await self._reads.xrange(session_event_log_key(session_id), min=start_id, max="+",
+                                           count=SESSION_EVENT_LOG_MAXLEN + 1)
+        return [(entry_id, fields.get("data", "")) for entry_id, fields in entries]
+
+    async def aclose(self) -> None:
+        if self._reads is not None:
+            try:
+                await self._reads.close()
+            except Exception:
+                pass
+            self._reads = None
+
+
+class InMemoryEventBus:
+    backend = "memory"
+
+    def __init__(self, maxlen: int = SESSION_EVENT_LOG_MAXLEN, max_sessions: int = EVENT_BUS_MEMORY_SESSIONS) -> None:
+        self.maxlen = maxlen
+        self.max_sessions = max_sessions
+        self._logs: "OrderedDict[int, Deque[Event]]" = OrderedDict()
+        self._listeners: List[Tuple[asyncio.AbstractEventLoop, Dispatch]] = []
+        self._last: Tuple[int, int] = (0, 0)
+        self._lock = threading.Lock()
+
+    def _next_id(self) -> str:
+        ms, seq = int(time.time() * 1000), 0
+        if ms <= self._last[0]:
+            ms, seq = self._last[0], self._last[1] + 1
+        self._last = (ms, seq)
+        return f"{ms}-{seq}"
+
+    def publish(self, session_id: int, payload: str, log: bool = True, client: Any = None) -> Optional[str]:
+        event_id = None
+        with self._lock:
+            if log:
+                event_id = self._next_id()
+                entries = self._logs.get(session_id)
+                if entries is None:
+                    entries = self._logs[session_id] = deque(maxlen=self.maxlen)
+                entries.append((event_id, payload))
+                self._logs.move_to_end(session_id)
+                while len(self._logs) > self.max_sessions:
+                    self._logs.popitem(last=False)
+            # delivered under the lock so every listener sees one session's events in log order
+            channel, message = session_event_channel(session_id), _message(event_id, payload)
+            for loop, dispatch in self._listeners:
+                try:
+                    loop.call_soon_threadsafe(dispatch, channel, message)
+                except RuntimeError:
+                    pass  # loop closed; its listener is removed when the hub stops
+        return event_id
+
+    def publish_many(self, events: List[Tuple[int, str, bool]]) -> List[Optional[str]]:
+        return [self.publish(session_id, payload, log) for session_id, payload, log in events]
+
+    async def listen(self, dispatch: Dispatch, connected: asyncio.Event) -> None:
+        listener = (asyncio.get_running_loop(), dispatch)
+        with self._lock:
+            self._listeners.append(listener)
+        connected.set()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            connected.clear()
+            with self._lock:
+                self._listeners.remove(listener)
+
+    async def read_log(self, session_id: int, start_id: str) -> List[Event]:
+        start = parse_event_id(start_id)
+        with self._lock:
+            entries = list(self._logs.get(session_id, ()))
+        return [e for e in entries if parse_event_id(e[0]) >= start]
+
+    async def aclose(self) -> None:
+        pass
+
+
+def _build_bus():
+    if EVENT_BUS_BACKEND == "memory":
+        return InMemoryEventBus()
+    if EVENT_BUS_BACKEND == "redis":
+        return RedisEventBus()
+    if aioredis is None:
+        logger.warning("redis.asyncio 不可用，会话事件使用进程内事件总线")
+        return InMemoryEventBus()
+    try:
+        bus = RedisEventBus()
+        bus.client.ping()
+        return bus
+    except Exception as e:
+        logger.warning(f"Redis 不可用，会话事件使用进程内事件总线（仅单进程部署有效）: {e}")
+        return InMemoryEventBus()
+
+
+_BUS = None
+_BUS_LOCK = threading.Lock()
+
+
+def get_event_bus():
+    global _BUS
+    with _BUS_LOCK:
+        if _BUS is None:
+            _BUS = _build_bus()
+        return _BUS
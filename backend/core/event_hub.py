@@ -0,0 +1,185 @@
+"""Per-process fan-out of session events to SSE clients.
+
+One asyncio task per worker process listens on the event bus (see event_bus.py: a single Redis
+pattern subscription on `session:*:events`, or the in-process bus) and hands each message to the
+in-memory queues of the SSE clients watching that session. Open streams therefore cost neither a
+thread nor a Redis connection each. Client queues are bounded (SSE_CLIENT_QUEUE); a client that
+falls that far behind is dropped: its stream ends with an `overflow` event and the browser
+reconnects.
+
+Logged events carry an id that becomes the SSE `id:`, so a reconnecting EventSource sends it back
+as Last-Event-ID and `replay` returns only what it missed from the session's event log.
+
+    async with get_event_hub().subscribe(session_id) as sub:
+        event_id, data = await sub.get(timeout=10)
+"""
+from __future__ import annotations
+
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional, Set, Tuple
+
+from core.dependencies import logger
+from core.event_bus import Event, get_event_bus, parse_event_id, split_message
+
+SSE_CLIENT_QUEUE = int(os.environ.get("SSE_CLIENT_QUEUE", "256"))
+SSE_HEARTBEAT_SECONDS = float(os.environ.get("SSE_HEARTBEAT_SECONDS", "10"))
+# how long a new stream waits for the hub's bus subscription before answering 503
+SSE_CONNECT_TIMEOUT = float(os.environ.get("SSE_CONNECT_TIMEOUT", "2"))
+
+
+class ClientDropped(Exception):
+    pass
+
+
+class Subscription:
+    def __init__(self, session_id: int, maxsize: int):
+        self.session_id = session_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, maxsize))
+        self.dropped = False
+
+    def offer(self, event: Event) -> bool:
+        try:
+            self.queue.put_nowait(event)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    def drop(self) -> None:
+        self.dropped = True
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+    async def get(self, timeout: Optional[float] = None) -> Optional[Event]:
+        """Next (event id, payload), None on timeout; raises ClientDropped once the client was dropped."""
+        try:
+            event = await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        if event is None and self.dropped:
+            raise ClientDropped()
+        return event
+
+
+class SessionEventHub:
+    def __init__(self, bus=None, client_queue: int = SSE_CLIENT_QUEUE):
+        self.bus = bus or get_event_bus()
+        self.client_queue = client_queue
+        self._subs: Dict[int, Set[Subscription]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._connected = asyncio.Event()
+        self.received = 0
+        self.delivered = 0
+        self.dropped_clients = 0
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._reader())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._task = None
+        await self.bus.aclose()
+        for subs in list(self._subs.values()):
+            for sub in list(subs):
+                sub.drop()
+        self._subs.clear()
+
+    async def wait_connected(self, timeout: float) -> bool:
+        self.start()
+        try:
+            await asyncio.wait_for(self._connected.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def _reader(self) -> None:
+        await self.bus.listen(self._dispatch, self._connected)
+
+    def _dispatch(self, channel: Any, data: Any) -> None:
+        self.received += 1
+        try:
+            session_id = int(str(channel).split(":")[1])
+        except (IndexError, ValueError):
+            return
+        subs = self._subs.get(session_id)
+        if not subs:
+            return
+        event = split_message(data if isinstance(data, str) else str(data))
+        for sub in list(subs):
+            if sub.offer(event):
+                self.delivered += 1
+            else:
+                logger.warning(f"SSE 客户端消费过慢（积压 {self.client_queue} 条），断开 session={session_id}")
+                self._remove(sub)
+                sub.drop()
+                self.dropped_clients += 1
+
+    def _remove(self, sub: Subscription) -> None:
+        subs = self._subs.get(sub.session_id)
+        if subs is not None:
+            subs.discard(sub)
+            if not subs:
+                self._subs.pop(sub.session_id, None)
+
+    @asynccontextmanager
+    async def subscribe(self, session_id: int) -> AsyncIterator[Subscription]:
+        self.start()
+        sub = Subscription(session_id, self.client_queue)
+        self._subs.setdefault(session_id, set()).add(sub)
+        try:
+            yield sub
+        finally:
+            self._remove(sub)
+
+    async def replay(self, session_id: int, last_event_id: str) -> Tuple[List[Event], bool]:
+        """Logged events after `last_event_id`, oldest first, and whether that is all of them.
+
+        Incomplete means the client's last event is no longer in the log (trimmed by MAXLEN or the
+        log expired): something between it and the oldest retained entry may be lost, so the
+        client should reload the session detail instead of trusting the replay alone.
+        """
+        if parse_event_id(last_event_id) is None:
+            return [], False
+        events = await self.bus.read_log(session_id, last_event_id)
+        if events and events[0][0] == last_event_id:
+            return events[1:], True
+        return events, False
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": self.bus.backend,
+            "connected": self._connected.is_set(),
+            "sessions": len(self._subs),
+            "clients": sum(len(s) for s in self._subs.values()),
+            "received": self.received,
+            "delivered": self.delivered,
+            "dropped_clients": self.dropped_clients,
+        }
+
+
+_HUB: Optional[SessionEventHub] = None
+_HUB_LOOP: Optional[asyncio.AbstractEventLoop] = None
+
+
+def get_event_hub() -> SessionEventHub:
+    """The hub of the running (API) loop; created on first use."""
+    global _HUB, _HUB_LOOP
+    loop = asyncio.get_running_loop()
+    if _HUB is None or _HUB_LOOP is not loop:
+        _HUB, _HUB_LOOP = SessionEventHub(), loop
+    return _HUB
+
+
+async def close_event_hub() -> None:
+    global _HUB, _HUB_LOOP
+    if _HUB is not None:
+        await _HUB.stop()
+    _HUB, _HUB_LOOP = None, None
@@ -0,0 +1,135 @@
+"""Batched, non-blocking session event publishing for code running on an event loop.
+
+`publish_event` does a blocking Redis round trip per event. The coordinator emits several events
+per stage (log lines, task updates, token deltas), so it uses the EventPublisher of its loop
+instead: `publish` only encodes and enqueues; a flusher task waits EVENT_BATCH_LINGER_MS for
+the burst to finish and sends up to EVENT_BATCH_MAX events in one pipelined round trip from a
+thread. There is one flusher per loop and batches go out one at a time, so events keep the order
+they were published in (per session and overall).
+
+Session worker loops only run while a job runs, so callers `await flush_events()` before finishing.
+
+    queue_event(session_id, {"type": "log", ...})  # the running loop's publisher
+    await flush_events()
+"""
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+import weakref
+from typing import Any, Dict, List, Optional, Tuple
+
+from core.dependencies import logger, publish_event
+from core.event_bus import encode_event, get_event_bus
+from core.metrics import EVENT_BATCH_SIZE, EVENT_PUBLISH_SECONDS
+
+EVENT_BATCH_LINGER_MS = float(os.environ.get("EVENT_BATCH_LINGER_MS", "5"))
+EVENT_BATCH_MAX = int(os.environ.get("EVENT_BATCH_MAX", "200"))
+# events waiting to be sent before new ones are dropped (Redis down or very slow)
+EVENT_BATCH_QUEUE = int(os.environ.get("EVENT_BATCH_QUEUE", "10000"))
+
+
+class EventPublisher:
+    def __init__(self, bus=None, linger: float = EVENT_BATCH_LINGER_MS / 1000.0, max_batch: int = EVENT_BATCH_MAX,
+                 max_queue: int = EVENT_BATCH_QUEUE):
+        self.bus = bus or get_event_bus()
+        self.linger = linger
+        self.max_batch = max(1, max_batch)
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, max_queue))
+        self._task: Optional[asyncio.Task] = None
+        self.sent = 0
+        self.dropped = 0
+
+    def publish(self, session_id: int, event: Dict[str, Any], log: bool = True) -> None:
+        """Queue an event; never blocks. Must be called on the publisher's loop."""
+        try:
+            self._queue.put_nowait((session_id, encode_event(event), log))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logger.warning(f"事件发送队列已满（{self._queue.maxsize}），丢弃 session={session_id} 的事件")
+            return
+        except Exception:
+            logger.debug("事件序列化失败", exc_info=True)
+            return
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    async def flush(self) -> None:
+        """Wait until everything published so far has been sent (or failed)."""
+        if not self._queue.empty() and (self._task is None or self._task.done()):
+            self._task = asyncio.ensure_future(self._run())
+        await self._queue.join()
+
+    async def aclose(self) -> None:
+        try:
+            await asyncio.wait_for(self.flush(), timeout=5)
+        except Exception:
+            pass
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            batch: List[Tuple[int, str, bool]] = [await self._queue.get()]
+            if self.linger > 0:
+                # let the rest of the burst arrive
+                await asyncio.sleep(self.linger)
+            while len(batch) < self.max_batch and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                await self._send(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _send(self, batch: List[Tuple[int, str, bool]]) -> None:
+        started = time.perf_counter()
+        try:
+            await asyncio.to_thread(self.bus.publish_many, batch)
+            self.sent += len(batch)
+        except Exception as e:
+            logger.warning(f"批量推送 {len(batch)} 个会话事件失败: {e}")
+        EVENT_PUBLISH_SECONDS.observe(time.perf_counter() - started)
+        EVENT_BATCH_SIZE.observe(len(batch))
+
+
+_PUBLISHERS: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, EventPublisher]" = weakref.WeakKeyDictionary()
+
+
+def get_event_publisher() -> Optional[EventPublisher]:
+    """The publisher of the running loop, or None outside a loop."""
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+    publisher = _PUBLISHERS.get(loop)
+    if publisher is None:
+        publisher = _PUBLISHERS[loop] = EventPublisher()
+    return publisher
+
+
+def queue_event(session_id: int, event: Dict[str, Any], log: bool = True) -> None:
+    """Queue on the running loop's publisher; publish synchronously when there is no loop."""
+    publisher = get_event_publisher()
+    if publisher is None:
+        publish_event(session_id, event, log=log)
+    else:
+        publisher.publish(session_id, event, log=log)
+
+
+async def flush_events() -> None:
+    publisher = get_event_publisher()
+    if publisher is not None:
+        await publisher.flush()
+
+
+async def close_event_publisher() -> None:
+    publisher = _PUBLISHERS.pop(asyncio.get_running_loop(), None)
+    if publisher is not None:
+        await publisher.aclose()
@@ -0,0 +1,186 @@
+"""Event-loop lag monitor and blocking-call detector.
+
+A sampler task on each monitored loop sleeps LOOP_LAG_INTERVAL and records how late it woke up
+(the loop's scheduling delay) into the event_loop_lag_seconds histogram. A single watchdog thread
+checks every sampler's heartbeat; when a loop has not come back for LOOP_LAG_THRESHOLD it grabs
+that loop thread's current stack, which is the synchronous call blocking it (sync HTTP, DB query,
+subprocess.run, ...). Recent stalls with their stacks are served on GET /admin/loop-lag.
+
+    monitor = get_loop_monitor("api")
+    monitor.start()  # on the loop to watch; stop() or cancel the returned task when done
+"""
+from __future__ import annotations
+
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+
+from core.dependencies import logger
+from core.metrics import EVENT_LOOP_LAG_SECONDS, EVENT_LOOP_STALLS
+
+LOOP_LAG_ENABLED = os.environ.get("LOOP_LAG_ENABLED", "true").lower() in ("1", "true", "yes")
+LOOP_LAG_INTERVAL = float(os.environ.get("LOOP_LAG_INTERVAL", "0.1"))
+# a loop that has not run its sampler for this long is considered blocked
+LOOP_LAG_THRESHOLD = float(os.environ.get("LOOP_LAG_THRESHOLD", "0.2"))
+LOOP_LAG_STACK_DEPTH = int(os.environ.get("LOOP_LAG_STACK_DEPTH", "25"))
+LOOP_LAG_KEEP_STALLS = int(os.environ.get("LOOP_LAG_KEEP_STALLS", "20"))
+
+
+class LoopMonitor:
+    def __init__(self, name: str, interval: float = LOOP_LAG_INTERVAL, threshold: float = LOOP_LAG_THRESHOLD):
+        self.name = name
+        self.interval = interval
+        self.threshold = threshold
+        self.samples: Deque[float] = deque(maxlen=max(1, int(60 / max(interval, 0.01))))
+        self.stalls: Deque[Dict[str, Any]] = deque(maxlen=LOOP_LAG_KEEP_STALLS)
+        self.max_lag = 0.0
+        self.total_stalls = 0
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread_id: Optional[int] = None
+        # monotonic time the sampler went to sleep; None while not sampling
+        self._beat: Optional[float] = None
+        self._stall: Optional[Dict[str, Any]] = None
+        self._lock = threading.Lock()
+
+    def start(self) -> Optional[asyncio.Task]:
+        """Start sampling the running loop (no-op when disabled or already sampling it)."""
+        if not LOOP_LAG_ENABLED:
+            return None
+        if self._task is not None and not self._task.done():
+            return self._task
+        self._task = asyncio.ensure_future(self._run())
+        _ensure_watchdog()
+        return self._task
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        # the loop may not run again soon (worker loops idle between jobs): stop watching now
+        self._beat = None
+
+    async def _run(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._thread_id = threading.get_ident()
+        try:
+            while True:
+                woke_at = self._loop.time() + self.interval
+                self._beat = time.monotonic()
+                await asyncio.sleep(self.interval)
+                self._record(max(0.0, self._loop.time() - woke_at))
+        finally:
+            self._beat = None
+
+    def _record(self, lag: float) -> None:
+        EVENT_LOOP_LAG_SECONDS.observe(lag, loop=self.name)
+        with self._lock:
+            self.samples.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+            stall, self._stall = self._stall, None
+        if stall is not None:
+            # the watchdog saw the stall begin; now we know how long it lasted
+            stall["lag_s"] = round(lag, 4)
+            logger.warning(f"事件循环 {self.name} 阻塞 {lag * 1000:.0f}ms，阻塞位置: {stall['where']}")
+
+    def check(self, now: float) -> None:
+        """Watchdog hook: capture the loop thread's stack if it has been blocked past the threshold."""
+        beat, thread_id = self._beat, self._thread_id
+        if beat is None or thread_id is None or self._stall is not None:
+            return
+        blocked = now - beat - self.interval
+        if blocked < self.threshold:
+            return
+        frame = sys._current_frames().get(thread_id)
+        if frame is None:
+            return
+        stack = traceback.format_stack(frame, limit=LOOP_LAG_STACK_DEPTH)
+        task = None
+        try:
+            current = asyncio.current_task(self._loop) if self._loop is not None else None
+            task = current.get_name() if current is not None else None
+        except Exception:
+            pass
+        stall = {
+            "at": round(time.time(), 3),
+            "blocked_s": round(blocked, 4),
+            "lag_s": None,
+            "task": task,
+            "where": " ".join(stack[-1].split()) if stack else "",
+            "stack": [line.rstrip() for line in stack],
+        }
+        with self._lock:
+            if self._beat != beat:
+                return  # the loop came back while we were looking
+            self._stall = stall
+            self.stalls.append(stall)
+            self.total_stalls += 1
+        EVENT_LOOP_STALLS.inc(loop=self.name)
+
+    def stats(self, stacks: bool = True) -> Dict[str, Any]:
+        with self._lock:
+            samples = sorted(self.samples)
+            stalls = [dict(s) for s in self.stalls]
+        if not stacks:
+            for s in stalls:
+                s.pop("stack", None)
+
+        def pct(q: float) -> Optional[float]:
+            return round(samples[min(len(samples) - 1, int(q * len(samples)))] * 1000, 2) if samples else None
+
+        return {
+            "running": self._beat is not None,
+            "interval_ms": self.interval * 1000,
+            "threshold_ms": self.threshold * 1000,
+            "samples": len(samples),
+            "p50_ms": pct(0.50),
+            "p99_ms": pct(0.99),
+            "max_ms": round(self.max_lag * 1000, 2),
+            "stalls": self.total_stalls,
+            "recent_stalls": stalls[::-1],
+        }
+
+
+_MONITORS: Dict[str, LoopMonitor] = {}
+_MONITORS_LOCK = threading.Lock()
+_WATCHDOG: Optional[threading.Thread] = None
+
+
+def get_loop_monitor(name: str) -> LoopMonitor:
+    with _MONITORS_LOCK:
+        monitor = _MONITORS.get(name)
+        if monitor is None:
+            monitor = _MONITORS[name] = LoopMonitor(name)
+        return monitor
+
+
+def _watchdog_main() -> None:
+    while True:
+        time.sleep(max(0.01, LOOP_LAG_INTERVAL / 2))
+        now = time.monotonic()
+        with _MONITORS_LOCK:
+            monitors: List[LoopMonitor] = list(_MONITORS.values())
+        for monitor in monitors:
+            try:
+                monitor.check(now)
+            except Exception:
+                logger.debug("事件循环监控检查失败", exc_info=True)
+
+
+def _ensure_watchdog() -> None:
+    global _WATCHDOG
+    with _MONITORS_LOCK:
+        if _WATCHDOG is None or not _WATCHDOG.is_alive():
+            _WATCHDOG = threading.Thread(target=_watchdog_main, name="loop-lag-watchdog", daemon=True)
+            _WATCHDOG.start()
+
+
+def loop_lag_stats(stacks: bool = True) -> Dict[str, Any]:
+    with _MONITORS_LOCK:
+        monitors = dict(_MONITORS)
+    return {name: monitor.stats(stacks) for name, monitor in sorted(monitors.items())}
@@ -1,14 +1,13 @@
 from __future__ import annotations
 
-import asyncio
 import logging
 import platform
 from dataclasses import dataclass
-from typing import Optional, Dict, Any
+from typing import Callable, Optional, Dict, Any
 
 from browser_use import Agent as BrowserUseAgent, Browser, ChatOpenAI
 
-from .provider import call_llm
+from .provider import LLMResponse, acomplete
 
 
 logger = logging.getLogger(__name__)
@@ -21,47 +20,62 @@ class AgentResult:
     meta: Dict[str, Any]
 
 
+TokenCallback = Callable[[str], None]
+
+
+def _meta(kind: str, resp: LLMResponse) -> Dict[str, Any]:
+    meta: Dict[str, Any] = {"type": kind}
+    if resp.cached:
+        meta["cached"] = True
+    if resp.shared:
+        meta["deduplicated"] = True
+    meta["llm"] = resp.stats()
+    return meta
+
+
 class RetrieverAgent:
-    async def run(self, prompt: str, model_id: Optional[str] = None, llm_params: Optional[dict] = None) -> AgentResult:
+    async def run(self, prompt: str, model_id: Optional[str] = None, llm_params: Optional[dict] = None,
+                  on_token: Optional[TokenCallback] = None) -> AgentResult:
         q = f"给我3个与此任务相关的编程示例（问题+解题思路），简洁列点：\n{prompt}"
         params = llm_params or {}
-        text = await asyncio.to_thread(call_llm, q, model_id, params.get("max_tokens", 800),
-                                       params.get("temperature", 0.2), params.get("api_key"))
-        return AgentResult(ok=bool(text), text=text or "", meta={"type": "retrieval"})
+        resp = await acomplete(q, model_id, params.get("max_tokens", 800), params.get("temperature", 0.2),
+                               params.get("api_key"), on_token=on_token, role="retrieval")
+        return AgentResult(ok=bool(resp.text), text=resp.text or "", meta=_meta("retrieval", resp))
 
 
 class PlannerAgent:
-    async def run(self, prompt: str, model_id: Optional[str] = None, llm_params: Optional[dict] = None) -> AgentResult:
+    async def run(self, prompt: str, model_id: Optional[str] = None, llm_params: Optional[dict] = None,
+                  on_token: Optional[TokenCallback] = None) -> AgentResult:
         q = ("基于任务，生成不低于3个候选计划（含关键步骤与风险），并给每个计划一个0-1的置信度：\n" + prompt)
         params = llm_params or {}
-        text = await asyncio.to_thread(call_llm, q, model_id, params.get("max_tokens", 800),
-                                       params.get("temperature", 0.2), params.get("api_key"))
-        return AgentResult(ok=bool(text), text=text or "", meta={"type": "planning"})
+        resp = await acomplete(q, model_id, params.get("max_tokens", 800), params.get("temperature", 0.2),
+                               params.get("api_key"), on_token=on_token, role="planning")
+        return AgentResult(ok=bool(resp.text), text=resp.text or "", meta=_meta("planning", resp))
 
 
 class CoderAgent:
     async def run(self, prompt: str, plan: Optional[str] = None, model_id: Optional[str] = None,
-                  llm_params: Optional[dict] = None) -> AgentResult:
+                  llm_params: Optional[dict] = None, on_token: Optional[TokenCallback] = None) -> AgentResult:
         base = f"请根据以下任务{('与计划' if plan else '')}生成可运行的代码，并给出必要说明：\n任务：{prompt}\n"
         if plan:
             base += f"计划：{plan}\n"
         params = llm_params or {}
-        text = await asyncio.to_thread(call_llm, base, model_id, params.get("max_tokens", 1600),
-                                       params.get("temperature", 0.2), params.get("api_key"))
-        return AgentResult(ok=bool(text), text=text or "", meta={"type": "coding"})
+        resp = await acomplete(base, model_id, params.get("max_tokens", 1600), params.get("temperature", 0.2),
+                               params.get("api_key"), on_token=on_token, role="coding")
+        return AgentResult(ok=bool(resp.text), text=resp.text or "", meta=_meta("coding", resp))
 
 
 class DebuggerAgent:
     async def run(self, prompt: str, code: Optional[str] = None, model_id: Optional[str] = None,
-                  llm_params: Optional[dict] = None) -> AgentResult:
+                  llm_params: Optional[dict] = None, on_token: Optional[TokenCallback] = None) -> AgentResult:
         base = "请基于样例I/O进行调试，指出问题并给出修复后的代码；若未知样例，可进行常识性检查。\n"
         if code:
             base += f"待调试代码：\n{code}\n"
         base += f"任务：{prompt}\n"
         params = llm_params or {}
-        text = await asyncio.to_thread(call_llm, base, model_id, params.get("max_tokens", 1600),
-                                       params.get("temperature", 0.2), params.get("api_key"))
-        return AgentResult(ok=bool(text), text=text or "", meta={"type": "debugging"})
+        resp = await acomplete(base, model_id, params.get("max_tokens", 1600), params.get("temperature", 0.2),
+                               params.get("api_key"), on_token=on_token, role="debugging")
+        return AgentResult(ok=bool(resp.text), text=resp.text or "", meta=_meta("debugging", resp))
 
 
 class BrowserNavAgent:
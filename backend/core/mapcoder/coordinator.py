@@ -1,15 +1,24 @@
 from __future__ import annotations
 
 import asyncio
+import os
 import re
+import time
 from datetime import datetime, timezone
-from typing import Iterable, List, Optional, Dict, Any
+from typing import Iterable, List, Optional, Dict, Any, Tuple
 
+from sqlalchemy import func
 from sqlalchemy.orm import Session
 
-from core.dependencies import logger, publish_event
+from core.dependencies import logger
+from core.event_bus import content_ref
+from core.event_publisher import flush_events, queue_event
+from core.messages import append_messages
+from core.metrics import STAGE_QUEUE_SECONDS, STAGE_RUN_SECONDS
+from core.query_stats import QUERY_BUDGET_SESSION, report, track_queries
 from core.models import AgentRole, AgentSession, AgentTask, AgentTaskLog
-from core.mapcoder.schemas import RoleConfig
+from core.mapcoder.leases import HEARTBEAT_SECONDS, TaskLeaseManager, renew_leases
+from core.mapcoder.schemas import RoleConfig, StageSpec
 from .agents import RetrieverAgent, PlannerAgent, CoderAgent, DebuggerAgent, BrowserNavAgent, AgentResult
 
 
@@ -21,10 +30,40 @@ MAPCODER_DEFAULT_ROLES: List[RoleConfig] = [
     RoleConfig(name="browser", description="操控浏览器执行任务", capabilities={"type": "browser_navigation"})
 ]
 
+# retriever 与 planner 只依赖提示词，可并行执行；solver 汇合两者，按候选计划并行派生 coder/debugger 分支
+MAPCODER_DEFAULT_STAGES: List[StageSpec] = [
+    StageSpec(name="retriever", title="retriever 子任务", description="检索相关示例", depends_on=("browser",)),
+    StageSpec(name="planner", title="planner 子任务", description="生成多候选计划", depends_on=("browser",)),
+    StageSpec(name="solver", title="候选计划求解", description="按置信度并行执行 coder/debugger 分支", depends_on=("retriever", "planner"), fanout=True),
+]
+BROWSER_STAGE = StageSpec(name="browser", title="Browser 自动化任务", description="利用浏览器执行用户任务", optional=True)
+BROWSER_KEYWORDS = ("搜索", "查", "浏览", "访问", "search", "browse")
+
+# 单个会话内可同时运行的阶段数
+STAGE_CONCURRENCY = int(os.environ.get("MAPCODER_STAGE_CONCURRENCY", "2"))
+# 参与求解的候选计划数（按置信度取前 k 个）及同时运行的分支数
+PLAN_TOP_K = int(os.environ.get("MAPCODER_PLAN_TOP_K", "3"))
+BRANCH_CONCURRENCY = int(os.environ.get("MAPCODER_BRANCH_CONCURRENCY", "2"))
+# 流式输出：LLM token 以 token_delta 事件节流推送（按时间间隔或累计字符数触发）
+STREAM_TOKENS = os.environ.get("MAPCODER_STREAM_TOKENS", "true").lower() in ("1", "true", "yes")
+TOKEN_FLUSH_SECONDS = float(os.environ.get("MAPCODER_TOKEN_FLUSH_MS", "200")) / 1000.0
+TOKEN_FLUSH_CHARS = int(os.environ.get("MAPCODER_TOKEN_FLUSH_CHARS", "256"))
+
+# 计划标题：行首（可带 Markdown 标题 / 引用 / 加粗标记）的 "计划A"、"方案一"、"Plan 2"，标签后须紧跟分隔符或行尾，
+# 避免把 "Planning"、"Plans"、"- 计划A的风险" 这类正文或列表项当成新计划
+_PLAN_HEADING = re.compile(
+    r"^[ \t]*(?:#{1,6}[ \t]*|>[ \t]*)?(?:\*\*)?(?:候选)?(?:(?:计划|方案)[ \t]*|plan[ \t]+)"
+    r"([A-Za-z]|\d+|[一二三四五六七八九十]+)(?:\*\*)?[ \t]*(?:[:：)）(（、\-–—]|\.(?!\d)|$)",
+    re.IGNORECASE | re.MULTILINE,
+)
+_PLAN_CONFIDENCE = re.compile(r"(?:置信度|confidence)[^0-9.]{0,6}(1(?:\.0+)?|0?\.\d+|0)", re.IGNORECASE)
+_PLAN_CONFIDENCE_PERCENT = re.compile(r"(?:置信度|confidence)[^0-9]{0,6}(\d{1,3})\s*%", re.IGNORECASE)
+
 _CODE_FENCE = re.compile(r"```(?:[a-zA-Z0-9_+-]+)?\s*([\s\S]*?)```", re.MULTILINE)
 
 
-def _extract_code_snippet(text: Optional[str]) -> Optional[str]:
+def _code_block(text: Optional[str]) -> Optional[str]:
+    """Code the answer clearly contains: a fenced block, or an answer that is itself source code."""
     if not text:
         return None
     match = _CODE_FENCE.search(text)
@@ -35,14 +74,114 @@ def _extract_code_snippet(text: Optional[str]) -> Optional[str]:
     stripped = text.strip()
     if stripped.startswith(("class ", "def ", "public ", "#include", "function ", "package ")):
         return stripped
+    return None
+
+
+def _extract_code_snippet(text: Optional[str]) -> Optional[str]:
+    if not text:
+        return None
+    snippet = _code_block(text)
+    if snippet:
+        return snippet
+    stripped = text.strip()
     if "\n" not in stripped and len(stripped.split()) < 6:
         return None
     return stripped if len(stripped) > 20 else None
 
 
+def _parse_candidate_plans(text: Optional[str]) -> List[Tuple[str, str, Optional[float]]]:
+    """Split planner output into (label, plan text, confidence) tuples, highest confidence first.
+
+    Returns an empty list when fewer than two plan headings can be found.
+    """
+    if not text:
+        return []
+    heads = list(_PLAN_HEADING.finditer(text))
+    if len(heads) < 2:
+        return []
+    plans = []
+    for i, head in enumerate(heads):
+        end = heads[i + 1].start() if i + 1 < len(heads) else len(text)
+        body = text[head.start():end].strip()
+        confidence = None
+        pct = _PLAN_CONFIDENCE_PERCENT.search(body)
+        if pct:
+            confidence = min(int(pct.group(1)), 100) / 100.0
+        else:
+            match = _PLAN_CONFIDENCE.search(body)
+            if match:
+                confidence = float(match.group(1))
+        plans.append((head.group(1), body, confidence))
+    # stable sort keeps planner order for equal / missing confidences
+    plans.sort(key=lambda p: p[2] if p[2] is not None else 0.5, reverse=True)
+    return plans
+
+
+def _task_output(task: Optional[AgentTask], prefer_code: bool = False) -> Optional[str]:
+    if not task or not isinstance(task.result, dict):
+        return None
+    if prefer_code:
+        return task.result.get("code") or task.result.get("text") or None
+    return task.result.get("text") or task.result.get("code") or None
+
+
+def task_event(task: AgentTask) -> Dict[str, Any]:
+    """Compact task_update event: the task's identity and status plus a reference (hash, size,
+    preview) to its result; the full result is served by GET .../tasks/{id}/result."""
+    data: Dict[str, Any] = {
+        "id": task.id,
+        "parent_id": task.parent_id,
+        "title": task.title,
+        "assigned_role_id": task.assigned_role_id,
+        "status": task.status,
+        "confidence": task.confidence,
+        "updated_at": (task.updated_at or datetime.now(timezone.utc)).isoformat(),
+    }
+    if isinstance(task.result, dict) and task.result:
+        ref = content_ref(task.result, _task_output(task, prefer_code=True) or "")
+        ref["role_type"] = task.result.get("role_type")
+        ref["has_code"] = bool(task.result.get("code"))
+        data["result_ref"] = ref
+    return {"type": "task_update", "task": data}
+
+
+class _TokenDeltaPublisher:
+    """Buffers one task's streamed tokens and publishes them as throttled token_delta events."""
+
+    def __init__(self, session_id: int, task_id: int):
+        self.session_id = session_id
+        self.task_id = task_id
+        self.seq = 0
+        self._buf: List[str] = []
+        self._size = 0
+        self._last = time.monotonic()
+
+    def __call__(self, delta: str) -> None:
+        self._buf.append(delta)
+        self._size += len(delta)
+        if self._size >= TOKEN_FLUSH_CHARS or time.monotonic() - self._last >= TOKEN_FLUSH_SECONDS:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self._buf:
+            return
+        text = "".join(self._buf)
+        self._buf, self._size, self._last = [], 0, time.monotonic()
+        self.seq += 1
+        try:
+            queue_event(self.session_id, {"type": "token_delta", "task_id": self.task_id, "seq": self.seq, "delta": text},
+                        log=False)
+        except Exception:
+            logger.debug("无法推送 token 事件", exc_info=True)
+
+
 class CoordinatorService:
-    def __init__(self, db: Session):
+    def __init__(self, db: Session, stage_concurrency: Optional[int] = None):
         self.db = db
+        self._leases = TaskLeaseManager(db)
+        self.stage_concurrency = stage_concurrency or STAGE_CONCURRENCY
+        self.plan_top_k = PLAN_TOP_K
+        self.branch_concurrency = BRANCH_CONCURRENCY
         self._retriever = RetrieverAgent()
         self._planner = PlannerAgent()
         self._coder = CoderAgent()
@@ -74,7 +213,7 @@ class CoordinatorService:
         self.db.add(log)
         self.db.flush()
         try:
-            publish_event(session_id, {
+            queue_event(session_id, {
                 "type": "log",
                 "log": {
                     "id": log.id,
@@ -102,7 +241,7 @@ class CoordinatorService:
         prompt_clean = (prompt or "").strip()
         metadata: Dict[str, Any] = {}
         if prompt_clean:
-            metadata = {"prompt": prompt_clean, "messages": [{"role": "user", "content": prompt_clean}]}
+            metadata = {"prompt": prompt_clean}
         overrides = llm_params or {}
         metadata.setdefault("llm_params", {})
         for key in ("max_tokens", "temperature", "api_key"):
@@ -118,6 +257,8 @@ class CoordinatorService:
         self.db.add(session)
         self.db.flush()
         logger.info(f"创建会话记录 AgentSession ID: {session.id}")
+        if prompt_clean:
+            append_messages(self.db, session.id, [("user", prompt_clean, None)])
 
         if prompt_clean:
             roles = self._ensure_roles(role_configs)
@@ -158,12 +299,22 @@ class CoordinatorService:
         logger.info(f"创建根任务记录 AgentTask ID: {root_task.id}")
 
     async def run_session(self, session) -> None:
-        """Run staged pipeline: retriever -> planner -> coder -> debugger, creating tasks on demand."""
-        logger.info(f"Coordinator starting session {session.id}")
-        session.status = "running"
-        session.updated_at = datetime.now(timezone.utc)
-        self.db.commit()
+        """Claim the session's root task lease and run its stage graph while heartbeating the lease.
 
+        If another worker holds a live lease on the root, this call returns without doing anything.
+        A root reclaimed after its previous worker died resumes from the last completed stage.
+        SQL statements of the whole run are counted and checked against QUERY_BUDGET_SESSION.
+        """
+        with track_queries(f"session {session.id}", QUERY_BUDGET_SESSION) as queries:
+            try:
+                await self._run_session(session)
+            finally:
+                # events are sent in batches; make sure this run's are out before the job is acked
+                await flush_events()
+                report(queries, "session")
+                logger.info(f"会话 {session.id} SQL 统计: {queries.count} 条, DB 耗时 {queries.db_time * 1000:.1f}ms")
+
+    async def _run_session(self, session) -> None:
         # Fetch root task (created in bootstrap)
         root = (
             self.db.query(AgentTask)
@@ -175,7 +326,51 @@ class CoordinatorService:
             # safety: create one if missing
             root = AgentTask(session_id=session.id, title="整体任务", description=(session.metadata_ or {}).get("prompt", ""), status="pending")
             self.db.add(root)
-            self.db.flush()
+            self.db.commit()
+        if self._leases.claim_task(root.id) is None:
+            logger.info(f"会话 {session.id} 的根任务已被其他 worker 领取或重试次数已用尽，跳过")
+            return
+
+        resuming = root.attempt_count > 1 and isinstance(root.result, dict) and "run_floor" in root.result
+        if resuming:
+            self._leases.expire_stale(session.id, exclude_id=root.id)
+            self.append_log(session.id, f"从上次中断处恢复执行（第 {root.attempt_count} 次尝试）", level="WARNING", task_id=root.id)
+        else:
+            # tasks at or below the floor belong to earlier runs and are never resumed
+            floor = self.db.query(func.max(AgentTask.id)).filter(AgentTask.session_id == session.id).scalar()
+            root.result = {"run_floor": floor}
+        self.db.commit()
+
+        heartbeat = asyncio.ensure_future(self._keep_leases(session.id))
+        try:
+            await self._run_claimed(session, root, resuming)
+        finally:
+            heartbeat.cancel()
+            try:
+                self.db.refresh(session)
+                # an exception leaves the root pending so a retried job can resume it
+                root.status = session.status if session.status in ("completed", "failed", "canceled") else "pending"
+                root.updated_at = datetime.now(timezone.utc)
+                self._leases.release(root)
+                self.db.commit()
+            except Exception:
+                self.db.rollback()
+                logger.warning(f"释放会话 {session.id} 的根任务租约失败", exc_info=True)
+
+    async def _keep_leases(self, session_id: int) -> None:
+        # 续期不能用 self.db：并发执行的阶段可能正改到一半，提交会把它们一并写入
+        while True:
+            await asyncio.sleep(HEARTBEAT_SECONDS)
+            try:
+                await asyncio.to_thread(renew_leases, session_id, self._leases.worker_id, self._leases.lease_seconds)
+            except Exception:
+                logger.debug("租约续期失败", exc_info=True)
+
+    async def _run_claimed(self, session, root: AgentTask, resuming: bool = False) -> None:
+        logger.info(f"Coordinator starting session {session.id}")
+        session.status = "running"
+        session.updated_at = datetime.now(timezone.utc)
+        self.db.commit()
 
         # cooperative cancel check helper
         def _canceled() -> bool:
@@ -192,74 +387,17 @@ class CoordinatorService:
             session.updated_at = datetime.now(timezone.utc)
             self.db.commit()
             return
-        #0) Browser Use
-        if any(k in prompt for k in ["搜索", "查", "浏览", "访问", "search", "browse"]):
-            if _canceled(): return
-            
-            # 获取 browser 角色
-            browser_role = self.db.query(AgentRole).filter_by(name="browser").first()
-            if not browser_role:
-                # 假如数据库没初始化这个角色，临时创建或者跳过
-                self.append_log(session.id, "未找到 browser 角色，跳过浏览器步骤", level="WARNING")
-            else:
-                browser_task = AgentTask(
-                    session_id=session.id, 
-                    parent_id=root.id, 
-                    assigned_role_id=browser_role.id, 
-                    title="Browser 自动化任务", 
-                    description=f"利用浏览器执行：{prompt}", 
-                    status="pending"
-                )
-                self.db.add(browser_task); self.db.flush()
-                
-                # 执行
-                await self._run_task(session, browser_task)
-                
-                # 可选：将浏览器的结果追加到 Prompt 中，供后续 Planner 参考
-                if browser_task.result and isinstance(browser_task.result, dict):
-                    browser_out = browser_task.result.get("text", "")
-                    prompt += f"\n\n[补充信息] 浏览器搜索结果：\n{browser_out}"
-                    # 更新 session metadata 里的 prompt 供后续使用
-                    meta = session.metadata_ or {}
-                    meta["prompt"] = prompt
-                    session.metadata_ = meta
-                    self.db.commit()
-        # 1) retriever
-        if _canceled():
+
+        # run the stage graph; independent stages execute concurrently
+        stages = self._plan_stages(prompt)
+        finished = await self._run_stage_graph(session, root, stages, _canceled, resuming=resuming)
+        if finished is None:
             self.append_log(session.id, "任务已被用户停止", level="INFO")
             try:
-                publish_event(session.id, {"type": "session", "session": {"id": session.id, "status": "canceled", "updated_at": datetime.now(timezone.utc).isoformat()}})
+                queue_event(session.id, {"type": "session", "session": {"id": session.id, "status": "canceled", "updated_at": datetime.now(timezone.utc).isoformat()}})
             except Exception:
                 pass
             return
-        retr_role = self.db.query(AgentRole).filter_by(name="retriever").first()
-        retr_task = AgentTask(session_id=session.id, parent_id=root.id, assigned_role_id=retr_role.id if retr_role else None, title="retriever 子任务", description="检索相关示例", status="pending")
-        self.db.add(retr_task); self.db.flush()
-        await self._run_task(session, retr_task)
-
-        # 2) planner
-        if _canceled():
-            return
-        plan_role = self.db.query(AgentRole).filter_by(name="planner").first()
-        plan_task = AgentTask(session_id=session.id, parent_id=root.id, assigned_role_id=plan_role.id if plan_role else None, title="planner 子任务", description="生成多候选计划", status="pending")
-        self.db.add(plan_task); self.db.flush()
-        await self._run_task(session, plan_task)
-
-        # 3) coder
-        if _canceled():
-            return
-        coder_role = self.db.query(AgentRole).filter_by(name="coder").first()
-        coder_task = AgentTask(session_id=session.id, parent_id=root.id, assigned_role_id=coder_role.id if coder_role else None, title="coder 子任务", description="根据计划生成代码", status="pending")
-        self.db.add(coder_task); self.db.flush()
-        await self._run_task(session, coder_task)
-
-        # 4) debugger
-        if _canceled():
-            return
-        dbg_role = self.db.query(AgentRole).filter_by(name="debugger").first()
-        dbg_task = AgentTask(session_id=session.id, parent_id=root.id, assigned_role_id=dbg_role.id if dbg_role else None, title="debugger 子任务", description="基于样例调试并修复", status="pending")
-        self.db.add(dbg_task); self.db.flush()
-        await self._run_task(session, dbg_task)
 
         # aggregate results
         try:
@@ -271,6 +409,8 @@ class CoordinatorService:
             )
             aggregated = {"codes": [], "texts": []}
             for t in tasks_all:
+                if t.status == "canceled" or (isinstance(t.result, dict) and t.result.get("role_type") == "plan"):
+                    continue
                 if t.result and isinstance(t.result, dict):
                     code_txt = t.result.get("code") or None
                     plain_txt = t.result.get("text") or code_txt or None
@@ -278,16 +418,23 @@ class CoordinatorService:
                         aggregated["texts"].append({"task_id": t.id, "title": t.title, "text": plain_txt})
                     if code_txt:
                         aggregated["codes"].append({"task_id": t.id, "title": t.title, "code": code_txt})
-            final_artifact = aggregated["codes"][-1] if aggregated["codes"] else (
-                {"task_id": aggregated["texts"][-1]["task_id"], "title": aggregated["texts"][-1]["title"], "text": "\n\n".join([x["text"] for x in aggregated["texts"][-3:]])} if aggregated["texts"] else {"text": "未生成结果"}
-            )
+            # 成功分支的代码即最终产物；没有成功分支时退回最后一段代码 / 最近几段文本
+            winner = finished.get("solver")
+            winner_code = winner.result.get("code") if winner is not None and isinstance(winner.result, dict) else None
+            if winner_code:
+                final_artifact = {"task_id": winner.id, "title": winner.title, "code": winner_code}
+            else:
+                final_artifact = aggregated["codes"][-1] if aggregated["codes"] else (
+                    {"task_id": aggregated["texts"][-1]["task_id"], "title": aggregated["texts"][-1]["title"], "text": "\n\n".join([x["text"] for x in aggregated["texts"][-3:]])} if aggregated["texts"] else {"text": "未生成结果"}
+                )
             session.final_result = final_artifact
             session.summary_title = final_artifact.get("title") or (final_artifact.get("text") or final_artifact.get("code") or session.title)[:120]
             session.status = "completed"
             session.updated_at = datetime.now(timezone.utc)
             self.db.commit()
             try:
-                publish_event(session.id, {"type": "final_result", "final_result": session.final_result, "summary_title": session.summary_title, "status": session.status, "updated_at": session.updated_at.isoformat()})
+                # the final artifact repeats a task's output: send a reference, GET .../final-result has it
+                queue_event(session.id, {"type": "final_result", "final_result_ref": content_ref(session.final_result, session.final_result.get("code") or session.final_result.get("text") or ""), "summary_title": session.summary_title, "status": session.status, "updated_at": session.updated_at.isoformat()})
             except Exception:
                 pass
             self.append_log(session.id, "任务已全部完成", level="INFO")
@@ -298,11 +445,225 @@ class CoordinatorService:
             self.db.commit()
             self.append_log(session.id, "聚合结果失败", level="ERROR")
 
-    async def _run_task(self, session, task) -> None:
-        task.status = "running"
-        task.attempt_count = (task.attempt_count or 0) + 1
-        task.updated_at = datetime.now(timezone.utc)
+    def _plan_stages(self, prompt: str) -> List[StageSpec]:
+        stages = list(MAPCODER_DEFAULT_STAGES)
+        if any(k in prompt for k in BROWSER_KEYWORDS):
+            stages.insert(0, BROWSER_STAGE)
+        return stages
+
+    def _create_stage_task(self, session, root: AgentTask, spec: StageSpec, roles: Dict[str, AgentRole]) -> Optional[AgentTask]:
+        role = roles.get(spec.name)
+        if not role and spec.optional:
+            self.append_log(session.id, f"未找到 {spec.name} 角色，跳过该步骤", level="WARNING")
+            return None
+        task = AgentTask(session_id=session.id, parent_id=root.id, assigned_role_id=role.id if role else None, title=spec.title, description=spec.description, status="pending")
+        self.db.add(task); self.db.flush()
+        return task
+
+    async def _run_stage_graph(self, session, root: AgentTask, stages: List[StageSpec], canceled, resuming: bool = False) -> Optional[Dict[str, Optional[AgentTask]]]:
+        """Run stages as a dependency graph: a stage starts once all of its dependencies have finished,
+        and independent stages run concurrently under the per-session ``stage_concurrency`` limit.
+        When resuming, stage tasks of the interrupted run are reused: completed ones keep their result,
+        unfinished ones run again on the same row until ``max_attempts`` is reached.
+
+        Returns the finished stage tasks keyed by stage name (None for skipped stages),
+        or None when the session was canceled midway.
+        """
+        names = {s.name for s in stages}
+        # one query for every role the graph (including fan-out branches) may need
+        roles = {r.name: r for r in self.db.query(AgentRole).all()}
+        pending: Dict[str, StageSpec] = {s.name: s for s in stages}
+        finished: Dict[str, Optional[AgentTask]] = {}
+        running: Dict[asyncio.Future, Tuple[StageSpec, Optional[AgentTask]]] = {}
+        gate = asyncio.Semaphore(max(1, self.stage_concurrency))
+        prior: Dict[str, AgentTask] = {}
+        if resuming:
+            floor = root.result.get("run_floor") or 0
+            for t in (
+                self.db.query(AgentTask)
+                .filter(AgentTask.session_id == session.id, AgentTask.parent_id == root.id, AgentTask.id > floor)
+                .order_by(AgentTask.id.asc())
+            ):
+                prior[t.title] = t
+
+        async def _guarded(spec: StageSpec, task: Optional[AgentTask], queued_at: float) -> Optional[AgentTask]:
+            async with gate:
+                if spec.fanout:
+                    return await self._run_plan_branches(session, root, finished, roles)
+                await self._run_stage(session, spec, task, finished, queued_at)
+            return task
+
+        try:
+            while pending or running:
+                if canceled():
+                    return None
+                progressed = True
+                while progressed:
+                    progressed = False
+                    for spec in list(pending.values()):
+                        if not all(d in finished or d not in names for d in spec.depends_on):
+                            continue
+                        del pending[spec.name]
+                        progressed = True
+                        if spec.fanout:
+                            running[asyncio.ensure_future(_guarded(spec, None, time.monotonic()))] = (spec, None)
+                            continue
+                        task = prior.get(spec.title)
+                        if task is not None and (task.status == "completed" or task.attempt_count >= task.max_attempts):
+                            finished[spec.name] = task
+                            continue
+                        if task is None:
+                            task = self._create_stage_task(session, root, spec, roles)
+                        if task is None:
+                            finished[spec.name] = None
+                            continue
+                        running[asyncio.ensure_future(_guarded(spec, task, time.monotonic()))] = (spec, task)
+                if not running:
+                    if pending:
+                        self.append_log(session.id, f"阶段依赖无法满足：{', '.join(pending)}", level="ERROR")
+                    break
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for fut in done:
+                    spec, _task = running.pop(fut)
+                    finished[spec.name] = fut.result()
+        finally:
+            for fut, (spec, task) in running.items():
+                fut.cancel()
+                if task is not None and task.status in ("pending", "running"):
+                    task.status = "canceled"
+                    task.updated_at = datetime.now(timezone.utc)
+                    self._leases.release(task)
+            if running:
+                self.db.commit()
+        return finished
+
+    def _materialize_plans(self, session, planner_task: Optional[AgentTask]) -> List[AgentTask]:
+        """Persist the planner's candidate plans as completed child tasks, highest confidence first."""
+        if not planner_task or planner_task.status != "completed":
+            return []
+        existing = self.db.query(AgentTask).filter_by(parent_id=planner_task.id).all()
+        if existing:
+            # resumed run: plans were already materialized by the previous worker
+            return sorted(existing, key=lambda t: t.confidence if t.confidence is not None else 0.5, reverse=True)
+        plan_tasks: List[AgentTask] = []
+        for label, body, confidence in _parse_candidate_plans(_task_output(planner_task)):
+            plan_tasks.append(AgentTask(
+                session_id=session.id,
+                parent_id=planner_task.id,
+                assigned_role_id=planner_task.assigned_role_id,
+                title=f"候选计划 {label}",
+                description=body,
+                status="completed",
+                confidence=confidence,
+                result={"text": body, "meta": {"type": "plan", "label": label}, "role_type": "plan"},
+            ))
+        if not plan_tasks:
+            return []
+        self.db.add_all(plan_tasks)
         self.db.commit()
+        for t in plan_tasks:
+            try:
+                queue_event(session.id, task_event(t))
+            except Exception:
+                pass
+        self.append_log(session.id, f"解析出 {len(plan_tasks)} 个候选计划，并行求解前 {min(len(plan_tasks), self.plan_top_k)} 个", level="INFO", task_id=planner_task.id)
+        return plan_tasks
+
+    async def _run_plan_branches(self, session, root: AgentTask, finished: Dict[str, Optional[AgentTask]], roles: Dict[str, AgentRole]) -> Optional[AgentTask]:
+        """MapCoder fan-out: run coder+debugger branches for the top-k plans concurrently.
+
+        Returns the debugger task of the first branch that succeeds (its answer contains code, see
+        `_code_block`); remaining branches are canceled.
+        """
+        planner_task = finished.get("planner")
+        plan_tasks: List[Optional[AgentTask]] = list(self._materialize_plans(session, planner_task))[:max(1, self.plan_top_k)]
+        if not plan_tasks:
+            # planner failed or produced no parsable plans: single branch over the whole planner output
+            plan_tasks = [None]
+        gate = asyncio.Semaphore(max(1, self.branch_concurrency))
+        branch_tasks: List[AgentTask] = []
+
+        async def _branch(plan_task: Optional[AgentTask], queued_at: float) -> Optional[AgentTask]:
+            async with gate:
+                return await self._run_branch(session, plan_task or root, plan_task or planner_task, roles, branch_tasks, queued_at)
+
+        running = {asyncio.ensure_future(_branch(p, time.monotonic())) for p in plan_tasks}
+        winner: Optional[AgentTask] = None
+        try:
+            while running and winner is None:
+                done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for fut in done:
+                    if winner is None and fut.result() is not None:
+                        winner = fut.result()
+        finally:
+            for fut in running:
+                fut.cancel()
+            stale = [t for t in branch_tasks if t.status in ("pending", "running")]
+            for t in stale:
+                t.status = "canceled"
+                t.updated_at = datetime.now(timezone.utc)
+                self._leases.release(t)
+            if stale:
+                self.db.commit()
+                for t in stale:
+                    try:
+                        queue_event(session.id, task_event(t))
+                    except Exception:
+                        pass
+        if winner is not None:
+            self.append_log(session.id, f"分支 {winner.title} 已成功，停止其余分支", level="INFO", task_id=winner.id)
+        return winner
+
+    async def _run_branch(self, session, parent: AgentTask, plan_task: Optional[AgentTask], roles: Dict[str, AgentRole], created: List[AgentTask], queued_at: Optional[float] = None) -> Optional[AgentTask]:
+        label = f"（{parent.title}）" if parent.parent_id else ""
+        coder_role, dbg_role = roles.get("coder"), roles.get("debugger")
+        coder_task = AgentTask(session_id=session.id, parent_id=parent.id, assigned_role_id=coder_role.id if coder_role else None, title=f"coder 子任务{label}", description="根据计划生成代码", status="pending")
+        self.db.add(coder_task); self.db.flush()
+        created.append(coder_task)
+        await self._run_task(session, coder_task, upstream={"planner": plan_task}, queued_at=queued_at)
+        if coder_task.status != "completed":
+            return None
+
+        dbg_task = AgentTask(session_id=session.id, parent_id=parent.id, assigned_role_id=dbg_role.id if dbg_role else None, title=f"debugger 子任务{label}", description="基于样例调试并修复", status="pending")
+        self.db.add(dbg_task); self.db.flush()
+        created.append(dbg_task)
+        await self._run_task(session, dbg_task, upstream={"coder": coder_task})
+        # 说明文字不算成功，否则先结束的分支就会"获胜"并取消其余分支
+        if dbg_task.status == "completed" and isinstance(dbg_task.result, dict) and _code_block(dbg_task.result.get("text")):
+            return dbg_task
+        return None
+
+    async def _run_stage(self, session, spec: StageSpec, task: AgentTask, finished: Dict[str, Optional[AgentTask]], queued_at: Optional[float] = None) -> None:
+        await self._run_task(session, task, upstream=finished, queued_at=queued_at)
+        if spec.name == "browser" and task.result and isinstance(task.result, dict):
+            # 将浏览器的结果追加到 Prompt 中，供后续阶段参考
+            meta = dict(session.metadata_ or {})
+            browser_out = task.result.get("text", "")
+            meta["prompt"] = (meta.get("prompt") or "") + f"\n\n[补充信息] 浏览器搜索结果：\n{browser_out}"
+            session.metadata_ = meta
+            self.db.commit()
+
+    def _timed_commit(self, metrics: Dict[str, Any]) -> None:
+        started = time.perf_counter()
+        self.db.commit()
+        metrics["db_commit_s"] = round(metrics.get("db_commit_s", 0.0) + time.perf_counter() - started, 4)
+
+    def _timed_publish(self, session_id: int, event: Dict[str, Any], metrics: Dict[str, Any]) -> None:
+        started = time.perf_counter()
+        try:
+            queue_event(session_id, event)
+        except Exception:
+            pass
+        metrics["publish_s"] = round(metrics.get("publish_s", 0.0) + time.perf_counter() - started, 4)
+
+    async def _run_task(self, session, task, upstream: Optional[Dict[str, Optional[AgentTask]]] = None,
+                        queued_at: Optional[float] = None) -> None:
+        """Run one stage task. Its timings (queue wait, LLM, DB commit, event publish) are recorded
+        in the /metrics histograms and in the payload of the task's final log entry."""
+        started = time.monotonic()
+        metrics: Dict[str, Any] = {"queue_s": round(started - queued_at, 4) if queued_at is not None else 0.0}
+        self._leases.acquire(task)
+        self._timed_commit(metrics)
         self.append_log(
             session_id=session.id,
             task_id=task.id,
@@ -315,30 +676,32 @@ class CoordinatorService:
         role = self.db.query(AgentRole).filter_by(id=task.assigned_role_id).first() if task.assigned_role_id else None
         role_type = (role.capabilities or {}).get("type") if role else None
         prompt = (session.metadata_ or {}).get("prompt") or task.description or ""
+        STAGE_QUEUE_SECONDS.observe(metrics["queue_s"], role=role_type or "generic")
 
         result: Optional[AgentResult] = None
+        tokens = _TokenDeltaPublisher(session.id, task.id) if STREAM_TOKENS else None
         if role_type == "retrieval":
-            result = await self._retriever.run(prompt, model_id=session.model_id, llm_params=self._llm_params(session))
+            result = await self._retriever.run(prompt, model_id=session.model_id, llm_params=self._llm_params(session), on_token=tokens)
         elif role_type == "planning":
-            result = await self._planner.run(prompt, model_id=session.model_id, llm_params=self._llm_params(session))
+            result = await self._planner.run(prompt, model_id=session.model_id, llm_params=self._llm_params(session), on_token=tokens)
         elif role_type == "coding":
-            # optionally use parent plan
-            parent = self.db.query(AgentTask).filter_by(id=task.parent_id).first() if task.parent_id else None
-            plan_text = None
-            if parent and parent.result:
-                plan_text = parent.result.get("text") or parent.result.get("code")
-            result = await self._coder.run(prompt, plan=plan_text, model_id=session.model_id, llm_params=self._llm_params(session))
+            # prefer the planner stage output, otherwise fall back to the parent plan
+            plan_text = _task_output(upstream.get("planner")) if upstream else None
+            if not plan_text:
+                parent = self.db.query(AgentTask).filter_by(id=task.parent_id).first() if task.parent_id else None
+                plan_text = _task_output(parent)
+            result = await self._coder.run(prompt, plan=plan_text, model_id=session.model_id, llm_params=self._llm_params(session), on_token=tokens)
         elif role_type == "debugging":
-            # pass previous code output if any sibling produced code
-            code_text = None
-            siblings = self.db.query(AgentTask).filter_by(session_id=session.id, parent_id=task.parent_id).all()
-            for s in siblings:
-                if s.result and isinstance(s.result, dict):
-                    cand = s.result.get("code") or s.result.get("text")
+            # pass the coder stage output, otherwise any sibling that produced code
+            code_text = _task_output(upstream.get("coder"), prefer_code=True) if upstream else None
+            if not code_text:
+                siblings = self.db.query(AgentTask).filter_by(session_id=session.id, parent_id=task.parent_id).all()
+                for s in siblings:
+                    cand = _task_output(s, prefer_code=True)
                     if cand:
                         code_text = cand
                         break
-            result = await self._debugger.run(prompt, code=code_text, model_id=session.model_id, llm_params=self._llm_params(session))
+            result = await self._debugger.run(prompt, code=code_text, model_id=session.model_id, llm_params=self._llm_params(session), on_token=tokens)
         elif role_type == "browser_navigation":
             result = await self._browser.run(
                 prompt, 
@@ -349,7 +712,11 @@ class CoordinatorService:
             # root or unknown role: just summarize
             result = AgentResult(ok=True, text=f"处理：{task.title}", meta={"type": "generic"})
 
+        if tokens is not None:
+            tokens.flush()
         await asyncio.sleep(0)
+        if result is not None and isinstance(result.meta, dict) and result.meta.get("llm"):
+            metrics["llm"] = result.meta["llm"]
 
         # Update task based on result
         if result and result.ok:
@@ -364,34 +731,35 @@ class CoordinatorService:
             task.result = payload
 
             task.updated_at = datetime.now(timezone.utc)
-            self.db.commit()
+            self._leases.release(task)
+            self._timed_commit(metrics)
             # publish task update event
-            try:
-                publish_event(session.id, {"type": "task_update", "task": {"id": task.id, "status": task.status, "result": task.result, "updated_at": task.updated_at.isoformat()}})
-            except Exception:
-                pass
+            self._timed_publish(session.id, task_event(task), metrics)
+            metrics["run_s"] = round(time.monotonic() - started, 4)
+            STAGE_RUN_SECONDS.observe(metrics["run_s"], role=role_type or "generic", status=task.status)
             self.append_log(
                 session_id=session.id,
                 task_id=task.id,
                 role_id=task.assigned_role_id,
                 level="INFO",
                 message=f"{task.title} 已完成",
-                payload={"meta": result.meta},
+                payload={"meta": result.meta, "metrics": metrics},
             )
         else:
             task.status = "failed"
             task.updated_at = datetime.now(timezone.utc)
-            self.db.commit()
-            try:
-                publish_event(session.id, {"type": "task_update", "task": {"id": task.id, "status": task.status, "updated_at": task.updated_at.isoformat()}})
-            except Exception:
-                pass
+            self._leases.release(task)
+            self._timed_commit(metrics)
+            self._timed_publish(session.id, task_event(task), metrics)
+            metrics["run_s"] = round(time.monotonic() - started, 4)
+            STAGE_RUN_SECONDS.observe(metrics["run_s"], role=role_type or "generic", status=task.status)
             self.append_log(
                 session_id=session.id,
                 task_id=task.id,
                 role_id=task.assigned_role_id,
                 level="ERROR",
                 message=f"{task.title} 执行失败",
+                payload={"metrics": metrics},
             )
 
     async def run_session_by_id(self, session_id: int) -> None:
@@ -0,0 +1,157 @@
+"""Lease-based claiming of AgentTask rows across worker nodes.
+
+A worker owns a task while `lease_owner` is its id and `lease_expires_at` lies in the future;
+owners extend the lease with heartbeats. A `running` task whose lease has expired belongs to a
+crashed worker and is runnable again, as long as `attempt_count < max_attempts`. Claims use
+`SELECT ... FOR UPDATE SKIP LOCKED` so concurrent workers never grab the same row (on backends
+without row locks, e.g. SQLite, the clause is ignored).
+
+Session runs are claimed through their root task; stage tasks are leased by the worker running
+the session and resumed from the last completed stage when another worker reclaims the root.
+"""
+from __future__ import annotations
+
+import os
+import socket
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import Session
+
+from core.dependencies import SessionLocal, logger
+from core.models import AgentTask
+
+WORKER_ID = os.environ.get("MAPCODER_WORKER_ID") or f"{socket.gethostname()}:{os.getpid()}"
+LEASE_SECONDS = float(os.environ.get("MAPCODER_TASK_LEASE_SECONDS", "60"))
+HEARTBEAT_SECONDS = float(os.environ.get("MAPCODER_TASK_HEARTBEAT_SECONDS", str(LEASE_SECONDS / 3)))
+
+
+def _now() -> datetime:
+    # lease columns are naive UTC so comparisons never depend on the DB session time zone
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def lease_active(task: Optional[AgentTask]) -> bool:
+    return bool(task and task.status == "running" and task.lease_expires_at and task.lease_expires_at > _now())
+
+
+class TaskLeaseManager:
+    def __init__(self, db: Session, worker_id: str = WORKER_ID, lease_seconds: float = LEASE_SECONDS):
+        self.db = db
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+
+    def _expiry(self) -> datetime:
+        return _now() + timedelta(seconds=self.lease_seconds)
+
+    @staticmethod
+    def _runnable(now: datetime):
+        return and_(
+            AgentTask.attempt_count < AgentTask.max_attempts,
+            or_(
+                AgentTask.status == "pending",
+                and_(AgentTask.status == "running", or_(AgentTask.lease_expires_at.is_(None), AgentTask.lease_expires_at < now)),
+            ),
+        )
+
+    def acquire(self, task: AgentTask) -> None:
+        """Take the lease on a task this worker created or already holds (no contention)."""
+        now = _now()
+        task.status = "running"
+        task.attempt_count = (task.attempt_count or 0) + 1
+        task.lease_owner = self.worker_id
+        task.lease_expires_at = self._expiry()
+        task.heartbeat_at = now
+        task.updated_at = datetime.now(timezone.utc)
+
+    def claim_task(self, task_id: int) -> Optional[AgentTask]:
+        """Atomically claim one specific task; returns None if it is leased elsewhere or exhausted."""
+        now = _now()
+        task = (
+            self.db.query(AgentTask)
+            .filter(AgentTask.id == task_id, self._runnable(now))
+            .with_for_update(skip_locked=True)
+            .first()
+        )
+        if task is None:
+            self.db.rollback()
+            return None
+        self.acquire(task)
+        self.db.commit()
+        return task
+
+    def heartbeat(self, session_id: int) -> int:
+        """Extend every lease this worker holds in the session. Returns the number of rows renewed."""
+        now = _now()
+        renewed = (
+            self.db.query(AgentTask)
+            .filter(AgentTask.session_id == session_id, AgentTask.lease_owner == self.worker_id, AgentTask.status == "running")
+            .update({AgentTask.lease_expires_at: self._expiry(), AgentTask.heartbeat_at: now}, synchronize_session=False)
+        )
+        self.db.commit()
+        return renewed
+
+    def release(self, task: AgentTask) -> None:
+        task.lease_owner = None
+        task.lease_expires_at = None
+
+    def expire_stale(self, session_id: int, exclude_id: Optional[int] = None) -> List[AgentTask]:
+        """Mark running tasks of a session whose lease has lapsed as failed (their worker is gone)."""
+        now = _now()
+        q = self.db.query(AgentTask).filter(
+            AgentTask.session_id == session_id,
+            AgentTask.status == "running",
+            or_(AgentTask.lease_expires_at.is_(None), AgentTask.lease_expires_at < now),
+        )
+        if exclude_id is not None:
+            q = q.filter(AgentTask.id != exclude_id)
+        stale = q.all()
+        for t in stale:
+            t.status = "failed"
+            t.updated_at = datetime.now(timezone.utc)
+            self.release(t)
+        if stale:
+            self.db.commit()
+        return stale
+
+    def reclaim_orphaned_roots(self, limit: int = 10) -> List[AgentTask]:
+        """Find session root tasks whose worker died and make them runnable again.
+
+        Roots with attempts left go back to `pending` (the caller re-enqueues their sessions);
+        exhausted roots are marked failed.
+        """
+        now = _now()
+        roots = (
+            self.db.query(AgentTask)
+            .filter(
+                AgentTask.parent_id.is_(None),
+                AgentTask.status == "running",
+                AgentTask.lease_expires_at.isnot(None),
+                AgentTask.lease_expires_at < now,
+            )
+            .order_by(AgentTask.lease_expires_at.asc())
+            .with_for_update(skip_locked=True)
+            .limit(limit)
+            .all()
+        )
+        for root in roots:
+            logger.warning(f"任务 {root.id} 的租约已过期 (owner={root.lease_owner})，由 {self.worker_id} 回收")
+            root.status = "pending" if root.attempt_count < root.max_attempts else "failed"
+            root.updated_at = datetime.now(timezone.utc)
+            self.release(root)
+        self.db.commit()
+        return roots
+
+
+def renew_leases(session_id: int, worker_id: str = WORKER_ID, lease_seconds: float = LEASE_SECONDS) -> int:
+    """Heartbeat on a DB session of its own, so the commit never includes another session's
+    half-written changes (e.g. those of the stages running on the coordinator's session)."""
+    db = SessionLocal()
+    try:
+        return TaskLeaseManager(db, worker_id, lease_seconds).heartbeat(session_id)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
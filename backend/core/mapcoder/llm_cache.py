@@ -0,0 +1,210 @@
+"""Content-addressed cache for LLM completions.
+
+Keys hash (base url, model, normalized prompt, temperature, max_tokens). Only deterministic calls
+are cached: temperature 0, or callers passing `cacheable=True`. Lookups go through an in-memory
+LRU tier first, then an optional shared tier (Redis or on-disk, LLM_CACHE_BACKEND); shared-tier
+hits are promoted into memory. Every entry carries a TTL; the memory tier additionally evicts
+least-recently-used entries beyond LLM_CACHE_MAX_ENTRIES / LLM_CACHE_MAX_BYTES.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from core.dependencies import logger
+
+LLM_CACHE_ENABLED = os.environ.get("LLM_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+LLM_CACHE_BACKEND = os.environ.get("LLM_CACHE_BACKEND", "memory").lower()  # memory | redis | disk
+LLM_CACHE_TTL = float(os.environ.get("LLM_CACHE_TTL", "3600"))
+LLM_CACHE_MAX_ENTRIES = int(os.environ.get("LLM_CACHE_MAX_ENTRIES", "1024"))
+LLM_CACHE_MAX_BYTES = int(os.environ.get("LLM_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+LLM_CACHE_DIR = os.environ.get("LLM_CACHE_DIR", str(Path(__file__).resolve().parent.parent.parent / ".llm_cache"))
+
+_REDIS_PREFIX = "llmcache:"
+
+
+def normalize_prompt(prompt: str) -> str:
+    lines = (prompt or "").replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    return "\n".join(line.rstrip() for line in lines).strip()
+
+
+class _MemoryTier:
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.evictions = 0
+        self._data: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.time():
+                self._pop(key)
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str, ttl: float) -> None:
+        with self._lock:
+            if key in self._data:
+                self._pop(key)
+            self._data[key] = (time.time() + ttl, value)
+            self.size += len(value)
+            while self._data and (len(self._data) > self.max_entries or self.size > self.max_bytes):
+                self._pop(next(iter(self._data)))
+                self.evictions += 1
+
+    def _pop(self, key: str) -> None:
+        _, value = self._data.pop(key)
+        self.size -= len(value)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class _RedisTier:
+    name = "redis"
+
+    def __init__(self):
+        import redis
+
+        from core.dependencies import redis_pool
+
+        self.redis = redis.Redis(connection_pool=redis_pool)
+
+    def get(self, key: str) -> Optional[str]:
+        return self.redis.get(_REDIS_PREFIX + key)
+
+    def set(self, key: str, value: str, ttl: float) -> None:
+        self.redis.set(_REDIS_PREFIX + key, value, ex=max(1, int(ttl)))
+
+
+class _DiskTier:
+    name = "disk"
+
+    def __init__(self, directory: str):
+        self.dir = Path(directory)
+        self.dir.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key: str) -> Path:
+        return self.dir / key[:2] / f"{key}.json"
+
+    def get(self, key: str) -> Optional[str]:
+        path = self._path(key)
+        try:
+            entry = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+        if entry.get("expires_at", 0) < time.time():
+            path.unlink(missing_ok=True)
+            return None
+        return entry.get("value")
+
+    def set(self, key: str, value: str, ttl: float) -> None:
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps({"expires_at": time.time() + ttl, "value": value}, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, path)
+
+
+class LLMCache:
+    def __init__(self, backend: str = LLM_CACHE_BACKEND, ttl: float = LLM_CACHE_TTL,
+                 max_entries: int = LLM_CACHE_MAX_ENTRIES, max_bytes: int = LLM_CACHE_MAX_BYTES):
+        self.ttl = ttl
+        self.memory = _MemoryTier(max_entries, max_bytes)
+        self.shared = None
+        try:
+            if backend == "redis":
+                self.shared = _RedisTier()
+            elif backend == "disk":
+                self.shared = _DiskTier(LLM_CACHE_DIR)
+        except Exception as e:
+            logger.warning(f"LLM 缓存共享层 {backend} 初始化失败，仅使用内存层: {e}")
+        self.counters = {"hits_memory": 0, "hits_shared": 0, "misses": 0, "sets": 0, "errors": 0}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key_for(base_url: Optional[str], model: str, prompt: str, temperature: float, max_tokens: int,
+                cacheable: bool = False) -> Optional[str]:
+        """Return the cache key, or None if the call is not deterministic enough to cache."""
+        if not LLM_CACHE_ENABLED or not (cacheable or temperature == 0):
+            return None
+        material = json.dumps([base_url or "", model, normalize_prompt(prompt), float(temperature), int(max_tokens)],
+                              ensure_ascii=False)
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.counters[name] += 1
+
+    def get(self, key: Optional[str]) -> Optional[str]:
+        if key is None:
+            return None
+        value = self.memory.get(key)
+        if value is not None:
+            self._count("hits_memory")
+            return value
+        if self.shared is not None:
+            try:
+                value = self.shared.get(key)
+            except Exception as e:
+                self._count("errors")
+                logger.debug(f"LLM 缓存读取失败: {e}")
+                value = None
+            if value is not None:
+                self._count("hits_shared")
+                self.memory.set(key, value, self.ttl)
+                return value
+        self._count("misses")
+        return None
+
+    def set(self, key: Optional[str], value: str, ttl: Optional[float] = None) -> None:
+        if key is None or not value:
+            return
+        ttl = ttl or self.ttl
+        self.memory.set(key, value, ttl)
+        self._count("sets")
+        if self.shared is not None:
+            try:
+                self.shared.set(key, value, ttl)
+            except Exception as e:
+                self._count("errors")
+                logger.debug(f"LLM 缓存写入失败: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            data: Dict[str, Any] = dict(self.counters)
+        lookups = data["hits_memory"] + data["hits_shared"] + data["misses"]
+        data.update({
+            "enabled": LLM_CACHE_ENABLED,
+            "shared_backend": getattr(self.shared, "name", None),
+            "entries": len(self.memory),
+            "bytes": self.memory.size,
+            "evictions": self.memory.evictions,
+            "hit_ratio": round((lookups - data["misses"]) / lookups, 4) if lookups else None,
+        })
+        return data
+
+
+_CACHE: Optional[LLMCache] = None
+_CACHE_LOCK = threading.Lock()
+
+
+def get_llm_cache() -> LLMCache:
+    global _CACHE
+    with _CACHE_LOCK:
+        if _CACHE is None:
+            _CACHE = LLMCache()
+        return _CACHE
@@ -1,10 +1,27 @@
 from __future__ import annotations
 
+import asyncio
+import hashlib
+import json
 import os
+import threading
+import time
+import weakref
 import requests
-from typing import Optional
+from dataclasses import dataclass, replace
+from typing import Any, Callable, Dict, Optional, Tuple
 
 from core.dependencies import logger
+from core.metrics import LLM_LATENCY_SECONDS, LLM_REQUESTS, LLM_TOKENS, LLM_TTFT_SECONDS
+from core.mapcoder.llm_cache import get_llm_cache
+from core.mapcoder.resilience import RETRYABLE_STATUSES, CircuitOpenError, RetryableError, aresilient, resilient
+from core.mapcoder.rate_limit import ModelLimiter, Permit, estimate_tokens, get_rate_limiter, parse_retry_after
+from core.mapcoder.singleflight import flight_key, get_single_flight
+
+try:
+    import httpx
+except Exception:  # pragma: no cover - optional dependency
+    httpx = None
 
 # Read configuration from environment
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY") or os.environ.get("OPENAI_KEY") or os.environ.get("OPENAI")
@@ -12,76 +29,579 @@ OPENAI_BASE_URL = os.environ.get("OPENAI_BASE_URL") or os.environ.get("OPENAI_BA
 DEFAULT_MODEL = os.environ.get("CHATGPT_MODEL", "gpt-4o")
 DEBUG_ALLOW_TEMP_KEY = os.environ.get("DEBUG_ALLOW_TEMP_KEY", "false").lower() in ("1", "true", "yes")
 TEMP_OPENAI_KEY = os.environ.get("TEMP_OPENAI_KEY") if DEBUG_ALLOW_TEMP_KEY else None
+# auto: "openai" when a key is configured, otherwise "mock"; or any registered backend name
+LLM_BACKEND = os.environ.get("LLM_BACKEND", "auto").lower()
+# OpenAI-compatible server that needs no key (vLLM, Ollama, llama.cpp, ...)
+LOCAL_LLM_BASE_URL = os.environ.get("LOCAL_LLM_BASE_URL", "http://127.0.0.1:11434/v1")
+
+# Connection pool for the async client (one pool per event loop, shared by every agent on it)
+LLM_POOL_MAX_CONNECTIONS = int(os.environ.get("LLM_POOL_MAX_CONNECTIONS", "100"))
+LLM_POOL_MAX_KEEPALIVE = int(os.environ.get("LLM_POOL_MAX_KEEPALIVE", "20"))
+LLM_POOL_KEEPALIVE_EXPIRY = float(os.environ.get("LLM_POOL_KEEPALIVE_EXPIRY", "30"))
+LLM_CONNECT_TIMEOUT = float(os.environ.get("LLM_CONNECT_TIMEOUT", "5"))
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", "30"))
+# auto: use HTTP/2 when the h2 package is installed
+LLM_HTTP2 = os.environ.get("LLM_HTTP2", "auto").lower()
+# Streaming: give up if no content token arrives within the first-token timeout
+LLM_FIRST_TOKEN_TIMEOUT = float(os.environ.get("LLM_FIRST_TOKEN_TIMEOUT", "10"))
+LLM_STREAM_TOTAL_TIMEOUT = float(os.environ.get("LLM_STREAM_TOTAL_TIMEOUT", "120"))
+
+
+_MOCK_QUICKSORT = "def quicksort(a):\n    if len(a)<=1: return a\n    pivot=a[0]\n    left=[x for x in a[1:] if x<=pivot]\n    right=[x for x in a[1:] if x>pivot]\n    return quicksort(left)+[pivot]+quicksort(right)"
 
 
 def _mock_response_for_prompt(prompt: str, model: str) -> str:
     # Local deterministic simple mock for development when provider is not configured.
-    low = prompt.lower()
+    # Match on the role instruction (the first line): coder/debugger prompts go on to quote the
+    # task, the selected plan and code, whose words ("计划", ...) would pick the wrong answer.
+    low = prompt.split("\n", 1)[0].lower()
     if "给我3个" in low or ("3个" in low and "示例" in low):
         return "1) 示例A：问题：...；思路：...\n2) 示例B：问题：...；思路：...\n3) 示例C：问题：...；思路：..."
+    if "调试" in low or "修复" in low or "debug" in low:
+        return "找到问题：边界条件未处理。建议修复：在循环中判断空列表并返回。\n修复后的代码：\n```python\n" + _MOCK_QUICKSORT + "\n```"
+    if "生成可运行的代码" in low or "生成代码" in low or "实现" in low:
+        return _MOCK_QUICKSORT + "\n\n# 示例使用: quicksort([3,1,2])"
     if "候选计划" in low or "计划" in low:
         return "计划A(置信度0.9)：步骤1, 步骤2。\n计划B(置信度0.6)：步骤1, 步骤2。\n计划C(置信度0.4)：步骤1, 步骤2。"
-    if "生成可运行的代码" in low or "生成代码" in low or "实现" in low:
-        return "def quicksort(a):\n    if len(a)<=1: return a\n    pivot=a[0]\n    left=[x for x in a[1:] if x<=pivot]\n    right=[x for x in a[1:] if x>pivot]\n    return quicksort(left)+[pivot]+quicksort(right)\n\n# 示例使用: quicksort([3,1,2])"
-    if "调试" in low or "修复" in low or "debug" in low:
-        return "找到问题：边界条件未处理。建议修复：在循环中判断空列表并返回。\n修复后的代码：..."
     return f"（模拟）{prompt[:800]}"
 
 
+# ---------------------------------------------------------------------------------------------
+# Backends: how to reach a model and how to read its one known response shape
+# ---------------------------------------------------------------------------------------------
+
+class LLMBackend:
+    name = "base"
+    requires_key = True
+    # answered in-process, no HTTP (never cached, rate limited or retried)
+    offline = False
+    base_url: Optional[str] = None
+
+    def chat_url(self) -> str:
+        raise NotImplementedError
+
+    def headers(self, key: Optional[str]) -> Dict[str, str]:
+        return {"Content-Type": "application/json"}
+
+    def payload(self, prompt: str, model: str, max_tokens: int, temperature: float, stream: bool) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def parse(self, data: Any) -> str:
+        raise NotImplementedError
+
+    def parse_delta(self, chunk: Any) -> str:
+        raise NotImplementedError
+
+    def usage(self, data: Any) -> Optional[Dict[str, int]]:
+        """Token counts reported by the server (response body or final stream chunk), if any."""
+        return None
+
+    def respond(self, prompt: str, model: str) -> str:
+        raise NotImplementedError
+
+
+class OpenAICompatibleBackend(LLMBackend):
+    """`/v1/chat/completions` over HTTP; parses `choices[0].message.content` and nothing else."""
+
+    name = "openai"
+
+    def __init__(self, base_url: Optional[str] = None):
+        self.base_url = (base_url or "https://api.openai.com").rstrip("/")
+        self._url = self.base_url + ("/chat/completions" if self.base_url.endswith("/v1") else "/v1/chat/completions")
+
+    def chat_url(self) -> str:
+        return self._url
+
+    def headers(self, key: Optional[str]) -> Dict[str, str]:
+        headers = {"Content-Type": "application/json"}
+        if key:
+            headers["Authorization"] = f"Bearer {key}"
+        return headers
+
+    def payload(self, prompt: str, model: str, max_tokens: int, temperature: float, stream: bool) -> Dict[str, Any]:
+        payload = {
+            "model": model,
+            "messages": [{"role": "user", "content": prompt}],
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "stream": stream,
+        }
+        if stream:
+            # ask for a final chunk carrying `usage`; servers that don't know the option ignore it
+            payload["stream_options"] = {"include_usage": True}
+        return payload
+
+    def parse(self, data: Any) -> str:
+        try:
+            return data["choices"][0]["message"]["content"] or ""
+        except (KeyError, IndexError, TypeError):
+            logger.warning(f"{self.name} 响应格式不符合 chat.completions: {str(data)[:300]}")
+            return ""
+
+    def parse_delta(self, chunk: Any) -> str:
+        try:
+            return chunk["choices"][0]["delta"].get("content") or ""
+        except (KeyError, IndexError, TypeError, AttributeError):
+            return ""
+
+    def usage(self, data: Any) -> Optional[Dict[str, int]]:
+        usage = data.get("usage") if isinstance(data, dict) else None
+        if not isinstance(usage, dict):
+            return None
+        return {k: int(usage.get(k) or 0) for k in ("prompt_tokens", "completion_tokens", "total_tokens")}
+
+
+class LocalBackend(OpenAICompatibleBackend):
+    name = "local"
+    requires_key = False
+
+    def __init__(self, base_url: Optional[str] = None):
+        super().__init__(base_url or LOCAL_LLM_BASE_URL)
+
+
+class MockBackend(LLMBackend):
+    name = "mock"
+    requires_key = False
+    offline = True
+
+    def respond(self, prompt: str, model: str) -> str:
+        return _mock_response_for_prompt(prompt, model)
+
+
+_BACKEND_FACTORIES: Dict[str, Callable[[], LLMBackend]] = {
+    "openai": lambda: OpenAICompatibleBackend(OPENAI_BASE_URL),
+    "local": LocalBackend,
+    "mock": MockBackend,
+}
+_BACKENDS: Dict[str, LLMBackend] = {}
+_BACKENDS_LOCK = threading.Lock()
+
+
+def register_backend(name: str, factory: Callable[[], LLMBackend]) -> None:
+    """Register (or replace) a backend; select it with LLM_BACKEND=<name>."""
+    with _BACKENDS_LOCK:
+        _BACKEND_FACTORIES[name] = factory
+        _BACKENDS.pop(name, None)
+
+
+def get_backend(name: Optional[str] = None) -> LLMBackend:
+    name = (name or LLM_BACKEND).lower()
+    if name == "auto":
+        name = "openai" if (TEMP_OPENAI_KEY or OPENAI_API_KEY) else "mock"
+    with _BACKENDS_LOCK:
+        backend = _BACKENDS.get(name)
+        if backend is None:
+            factory = _BACKEND_FACTORIES.get(name)
+            if factory is None:
+                raise ValueError(f"未知的 LLM backend: {name}")
+            backend = _BACKENDS[name] = factory()
+        return backend
+
+
+def _resolve(model_id: Optional[str], api_key: Optional[str]) -> Tuple[LLMBackend, str, Optional[str]]:
+    model = model_id or DEFAULT_MODEL
+    key = api_key or TEMP_OPENAI_KEY or OPENAI_API_KEY
+    backend = get_backend("openai" if api_key and LLM_BACKEND == "auto" else None)
+    if backend.requires_key and not key:
+        logger.warning(
+            "LLM provider 未配置: OPENAI_API_KEY 为空，且未启用临时密钥；使用本地模拟回答以便开发测试"
+        )
+        backend = get_backend("mock")
+    return backend, model, key
+
+
+class FirstTokenTimeout(TimeoutError):
+    pass
+
+
+# ---------------------------------------------------------------------------------------------
+# Long-lived clients, one per (base url, api key); async ones additionally per event loop
+# ---------------------------------------------------------------------------------------------
+
+def _client_key(backend: LLMBackend, key: Optional[str]) -> Tuple[str, str]:
+    return backend.base_url or backend.name, hashlib.sha256((key or "").encode("utf-8")).hexdigest()[:16]
+
+
+_SYNC_SESSIONS: Dict[Tuple[str, str], requests.Session] = {}
+_SYNC_LOCK = threading.Lock()
+
+# httpx clients are bound to the loop they were created on; session workers each own a loop
+_ASYNC_CLIENTS: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Tuple[str, str], Any]]" = weakref.WeakKeyDictionary()
+
+
+def _sync_session(backend: LLMBackend, key: Optional[str]) -> requests.Session:
+    ident = _client_key(backend, key)
+    with _SYNC_LOCK:
+        session = _SYNC_SESSIONS.get(ident)
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=LLM_POOL_MAX_KEEPALIVE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers.update(backend.headers(key))
+            _SYNC_SESSIONS[ident] = session
+        return session
+
+
+def _http2_enabled() -> bool:
+    if LLM_HTTP2 in ("0", "false", "no"):
+        return False
+    try:
+        import h2  # noqa: F401
+        return True
+    except Exception:
+        if LLM_HTTP2 in ("1", "true", "yes"):
+            logger.warning("LLM_HTTP2 已开启但未安装 h2，回退到 HTTP/1.1")
+        return False
+
+
+def get_async_client(backend: Optional[LLMBackend] = None, key: Optional[str] = None):
+    """Return the pooled httpx.AsyncClient for the running event loop and (backend, key) pair."""
+    if httpx is None:
+        raise RuntimeError("httpx 未安装，无法使用异步 LLM 客户端")
+    backend = backend or get_backend()
+    clients = _ASYNC_CLIENTS.setdefault(asyncio.get_running_loop(), {})
+    ident = _client_key(backend, key)
+    client = clients.get(ident)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            http2=_http2_enabled(),
+            headers=backend.headers(key),
+            limits=httpx.Limits(
+                max_connections=LLM_POOL_MAX_CONNECTIONS,
+                max_keepalive_connections=LLM_POOL_MAX_KEEPALIVE,
+                keepalive_expiry=LLM_POOL_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(LLM_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),
+        )
+        clients[ident] = client
+    return client
+
+
+async def aclose_async_client() -> None:
+    """Close the running loop's pooled clients; call before the loop shuts down."""
+    clients = _ASYNC_CLIENTS.pop(asyncio.get_running_loop(), None) or {}
+    for client in clients.values():
+        await client.aclose()
+
+
+@dataclass
+class LLMResponse:
+    text: str
+    cached: bool = False
+    # answered by another caller's identical in-flight request (single-flight follower)
+    shared: bool = False
+    # upstream timings of the attempt that produced `text` (seconds; ttft only when streamed)
+    latency: Optional[float] = None
+    ttft: Optional[float] = None
+    # time spent waiting for the rate limiter before that attempt
+    queued: Optional[float] = None
+    # server-reported usage when available, otherwise estimated (4 chars per token)
+    prompt_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+
+    def stats(self) -> Dict[str, Any]:
+        """Compact numbers for logs and task payloads (None fields dropped)."""
+        out: Dict[str, Any] = {"cached": self.cached, "shared": self.shared}
+        for name in ("latency", "ttft", "queued"):
+            value = getattr(self, name)
+            if value is not None:
+                out[f"{name}_s"] = round(value, 4)
+        if self.prompt_tokens is not None:
+            out["prompt_tokens"] = self.prompt_tokens
+            out["completion_tokens"] = self.completion_tokens
+        return out
+
+
+# ---------------------------------------------------------------------------------------------
+# One upstream attempt (inside the rate limiter); retries wrap these
+# ---------------------------------------------------------------------------------------------
+
+def _limiter_for(payload: Dict[str, Any], key: Optional[str]) -> Tuple[ModelLimiter, int]:
+    prompt = payload["messages"][-1]["content"]
+    return get_rate_limiter(payload["model"], key), estimate_tokens(prompt, payload.get("max_tokens") or 0)
+
+
+def _settle(permit: Permit, payload: Dict[str, Any], usage: Optional[Dict[str, int]], text: str,
+            started: float, ttft: Optional[float] = None) -> LLMResponse:
+    # refund the unused part of the max_tokens reservation; prefer the provider's own count
+    if usage and usage.get("total_tokens"):
+        permit.used_tokens = usage["total_tokens"]
+        prompt_tokens, completion_tokens = usage.get("prompt_tokens"), usage.get("completion_tokens")
+    else:
+        prompt_tokens = permit.tokens - int(payload.get("max_tokens") or 0)
+        completion_tokens = len(text) // 4
+        permit.used_tokens = prompt_tokens + completion_tokens
+    return LLMResponse(text, latency=time.perf_counter() - started, ttft=ttft, queued=permit.waited,
+                       prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+
+
+def _rejected(limiter: ModelLimiter, status: int, retry_after: Optional[str], body: Any) -> LLMResponse:
+    if status == 429:
+        limiter.backoff(parse_retry_after(retry_after))
+    logger.warning(f"LLM 调用失败 status={status} body={body}")
+    if status in RETRYABLE_STATUSES:
+        raise RetryableError(status, parse_retry_after(retry_after))
+    return LLMResponse("")
+
+
+def _post_sync(backend: LLMBackend, key: Optional[str], payload: Dict[str, Any]) -> LLMResponse:
+    limiter, tokens = _limiter_for(payload, key)
+    with limiter.slot(tokens) as permit:
+        started = time.perf_counter()
+        resp = _sync_session(backend, key).post(backend.chat_url(), json=payload,
+                                                timeout=(LLM_CONNECT_TIMEOUT, LLM_TIMEOUT))
+        if resp.status_code != 200:
+            return _rejected(limiter, resp.status_code, resp.headers.get("retry-after"), resp.text[:500])
+        data = resp.json()
+        return _settle(permit, payload, backend.usage(data), backend.parse(data), started)
+
+
+async def _astream_chat(backend: LLMBackend, key: Optional[str], payload: Dict[str, Any],
+                        on_token: Callable[[str], None], first_token_timeout: float,
+                        limiter: ModelLimiter, permit: Permit) -> LLMResponse:
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    deadline = loop.time() + first_token_timeout
+    parts = []
+    usage = None
+    ttft = None
+    async with get_async_client(backend, key).stream("POST", backend.chat_url(), json=payload) as resp:
+        if resp.status_code != 200:
+            body = await resp.aread()
+            return _rejected(limiter, resp.status_code, resp.headers.get("retry-after"), repr(body[:500]))
+        lines = resp.aiter_lines()
+        while True:
+            try:
+                if parts:
+                    line = await lines.__anext__()
+                else:
+                    line = await asyncio.wait_for(lines.__anext__(), max(0.0, deadline - loop.time()))
+            except StopAsyncIteration:
+                break
+            except asyncio.TimeoutError:
+                raise FirstTokenTimeout(f"{first_token_timeout:.0f}s 内未收到首个 token")
+            if not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if data == "[DONE]":
+                break
+            try:
+                chunk = json.loads(data)
+            except ValueError:
+                continue
+            usage = backend.usage(chunk) or usage
+            delta = backend.parse_delta(chunk)
+            if delta:
+                if ttft is None:
+                    ttft = time.perf_counter() - started
+                parts.append(delta)
+                on_token(delta)
+    return _settle(permit, payload, usage, "".join(parts), started, ttft)
+
+
+async def _apost(backend: LLMBackend, key: Optional[str], payload: Dict[str, Any],
+                 on_token: Optional[Callable[[str], None]], first_token_timeout: float) -> LLMResponse:
+    limiter, tokens = _limiter_for(payload, key)
+    async with limiter.aslot(tokens) as permit:
+        if on_token is not None:
+            return await asyncio.wait_for(
+                _astream_chat(backend, key, payload, on_token, first_token_timeout, limiter, permit),
+                LLM_STREAM_TOTAL_TIMEOUT,
+            )
+        started = time.perf_counter()
+        resp = await get_async_client(backend, key).post(backend.chat_url(), json=payload)
+        if resp.status_code != 200:
+            return _rejected(limiter, resp.status_code, resp.headers.get("retry-after"), resp.text[:500])
+        data = resp.json()
+        return _settle(permit, payload, backend.usage(data), backend.parse(data), started)
+
+
+def _observe(role: str, model: str, resp: LLMResponse) -> None:
+    """Record an upstream call; cache hits and single-flight followers cost nothing upstream."""
+    if resp.cached or resp.shared:
+        LLM_REQUESTS.inc(role=role, outcome="cached" if resp.cached else "shared")
+        return
+    LLM_REQUESTS.inc(role=role, outcome="ok" if resp.text else "empty")
+    if resp.latency is not None:
+        LLM_LATENCY_SECONDS.observe(resp.latency, role=role, model=model)
+    if resp.ttft is not None:
+        LLM_TTFT_SECONDS.observe(resp.ttft, role=role, model=model)
+    if resp.prompt_tokens is not None:
+        LLM_TOKENS.observe(resp.prompt_tokens, role=role, kind="prompt")
+        LLM_TOKENS.observe(resp.completion_tokens or 0, role=role, kind="completion")
+
+
+async def _aresilient_post(backend: LLMBackend, key: Optional[str], payload: Dict[str, Any],
+                           on_token: Optional[Callable[[str], None]], first_token_timeout: float) -> LLMResponse:
+    url = backend.chat_url()
+    if on_token is None:
+        return await aresilient(url, lambda: _apost(backend, key, payload, None, first_token_timeout), hedge=True)
+    emitted = []
+
+    def tracked(delta: str) -> None:
+        emitted.append(True)
+        on_token(delta)
+
+    # a stream is only retried while nothing has been delivered to the caller yet
+    return await aresilient(url, lambda: _apost(backend, key, payload, tracked, first_token_timeout),
+                            can_retry=lambda: not emitted)
+
+
+# ---------------------------------------------------------------------------------------------
+# Public entry points
+# ---------------------------------------------------------------------------------------------
+
 def call_llm(
     prompt: str,
     model_id: Optional[str] = None,
     max_tokens: int = 1024,
     temperature: float = 0.2,
     api_key: Optional[str] = None,
+    cacheable: bool = False,
+    role: str = "other",
 ) -> str:
-    """Call an OpenAI-compatible LLM HTTP endpoint (non-streaming).
+    """Call the configured LLM backend (non-streaming).
 
     Resolution order for API key:
     - explicit api_key parameter (if provided)
     - TEMP_OPENAI_KEY if DEBUG_ALLOW_TEMP_KEY
     - OPENAI_API_KEY from environment
 
-    If no key is available, return a deterministic mock response to keep local dev working.
+    If the backend needs a key and none is available, return a deterministic mock response to keep
+    local dev working. Deterministic calls (temperature 0 or cacheable=True) are served from /
+    stored in the LLM cache, and concurrent identical calls share one upstream request. Upstream
+    requests wait their turn in the per-model/per-key rate limiter (see rate_limit.py) instead of
+    provoking 429s; retryable failures are retried with backoff behind a per-endpoint circuit
+    breaker (see resilience.py). Unexpected errors are logged with their traceback and yield "";
+    only an unconfigured provider answers with the mock. Async callers should use `acall_llm`
+    instead of wrapping this in a thread.
+    `role` labels the call in the /metrics LLM histograms.
     """
-    model = model_id or DEFAULT_MODEL
-    key = api_key or TEMP_OPENAI_KEY or OPENAI_API_KEY
+    backend, model, key = _resolve(model_id, api_key)
+    if backend.offline:
+        return backend.respond(prompt, model)
 
-    if not key:
-        logger.warning(
-            "LLM provider 未配置: OPENAI_API_KEY 为空，且未启用临时密钥；使用本地模拟回答以便开发测试"
+    cache = get_llm_cache()
+    cache_key = cache.key_for(backend.base_url, model, prompt, temperature, max_tokens, cacheable)
+    cached = cache.get(cache_key)
+    if cached is not None:
+        _observe(role, model, LLMResponse(cached, cached=True))
+        return cached
+
+    payload = backend.payload(prompt, model, max_tokens, temperature, stream=False)
+    url = backend.chat_url()
+    try:
+        logger.info(f"LLM call -> backend={backend.name} model={model} tokens={max_tokens}")
+        resp, shared = get_single_flight().do_sync(
+            flight_key(backend.base_url, key, model, prompt, temperature, max_tokens, False),
+            lambda: resilient(url, lambda: _post_sync(backend, key, payload)),
         )
-        return _mock_response_for_prompt(prompt, model)
+    except (RetryableError, CircuitOpenError) as e:
+        logger.warning(f"LLM 调用放弃 model={model}: {e}")
+        LLM_REQUESTS.inc(role=role, outcome="failed")
+        return ""
+    except Exception as e:
+        # 真实后端出错时不能用模拟回答冒充结果（也会掩盖程序错误），记录堆栈并返回空
+        logger.exception(f"LLM 请求异常: {e}")
+        LLM_REQUESTS.inc(role=role, outcome="error")
+        return ""
+    _observe(role, model, replace(resp, shared=shared))
+    cache.set(cache_key, resp.text)
+    return resp.text
 
-    base = (OPENAI_BASE_URL.rstrip("/") if OPENAI_BASE_URL else "https://api.openai.com")
-    if base.endswith("/v1"):
-        url = base + "/chat/completions"
-    else:
-        url = base + "/v1/chat/completions"
-    headers = {"Authorization": f"Bearer {key}", "Content-Type": "application/json"}
-    payload = {
-        "model": model,
-        "messages": [{"role": "user", "content": prompt}],
-        "max_tokens": max_tokens,
-        "temperature": temperature,
-        "stream": False,
-    }
 
+async def acomplete(
+    prompt: str,
+    model_id: Optional[str] = None,
+    max_tokens: int = 1024,
+    temperature: float = 0.2,
+    api_key: Optional[str] = None,
+    on_token: Optional[Callable[[str], None]] = None,
+    first_token_timeout: Optional[float] = None,
+    cacheable: bool = False,
+    role: str = "other",
+) -> LLMResponse:
+    """Async counterpart of `call_llm` over the loop's pooled keep-alive client.
+
+    Same backend and key resolution, error handling, caching and single-flight behaviour as
+    `call_llm`. When `on_token` is given the request is streamed: each content delta is passed to
+    `on_token` as it arrives, the call fails (empty text) if no token arrives within
+    `first_token_timeout`, and the whole stream is bounded by LLM_STREAM_TOTAL_TIMEOUT.
+    Non-streaming calls may be hedged (LLM_HEDGE). A cache hit or mock answer is delivered to
+    `on_token` as a single delta. Upstream responses carry latency, TTFT and token counts, which
+    are also recorded in the /metrics LLM histograms under `role`.
+    """
+    backend, model, key = _resolve(model_id, api_key)
+    if backend.offline:
+        text = backend.respond(prompt, model)
+        if on_token:
+            on_token(text)
+        return LLMResponse(text)
+
+    cache = get_llm_cache()
+    cache_key = cache.key_for(backend.base_url, model, prompt, temperature, max_tokens, cacheable)
+    cached = cache.get(cache_key)
+    if cached is not None:
+        if on_token:
+            on_token(cached)
+        _observe(role, model, LLMResponse(cached, cached=True))
+        return LLMResponse(cached, cached=True)
+
+    stream = on_token is not None
+    payload = backend.payload(prompt, model, max_tokens, temperature, stream=stream)
     try:
-        logger.info(f"LLM call -> model={model} url={url} tokens={max_tokens}")
-        resp = requests.post(url, json=payload, headers=headers, timeout=30)
-        if resp.status_code != 200:
-            logger.warning(f"LLM 调用失败 status={resp.status_code} body={resp.text[:500]}")
-            return ""
-        data = resp.json()
-        choices = data.get("choices") or []
-        if choices and isinstance(choices, list):
-            first = choices[0]
-            msg = first.get("message") or {}
-            content = msg.get("content") or first.get("text") or ""
-            return content or ""
-        return ""
+        logger.info(f"LLM call -> backend={backend.name} model={model} tokens={max_tokens} stream={stream}")
+        resp, shared = await get_single_flight().do_async(
+            flight_key(backend.base_url, key, model, prompt, temperature, max_tokens, stream),
+            lambda emit: _aresilient_post(backend, key, payload, emit, first_token_timeout or LLM_FIRST_TOKEN_TIMEOUT),
+            on_token,
+        )
+    except (RetryableError, CircuitOpenError) as e:
+        logger.warning(f"LLM 调用放弃 model={model}: {e}")
+        LLM_REQUESTS.inc(role=role, outcome="failed")
+        return LLMResponse("")
+    except FirstTokenTimeout as e:
+        logger.warning(f"LLM 首 token 超时 model={model}: {e}")
+        LLM_REQUESTS.inc(role=role, outcome="first_token_timeout")
+        return LLMResponse("")
+    except asyncio.TimeoutError:
+        logger.warning(f"LLM 流式调用超过 {LLM_STREAM_TOTAL_TIMEOUT:.0f}s model={model}")
+        LLM_REQUESTS.inc(role=role, outcome="timeout")
+        return LLMResponse("")
     except Exception as e:
-        logger.warning(f"LLM 请求异常: {e}")
-        # Fallback to mock to avoid breaking the flow in development
-        return _mock_response_for_prompt(prompt, model)
+        logger.exception(f"LLM 请求异常: {e}")
+        LLM_REQUESTS.inc(role=role, outcome="error")
+        return LLMResponse("")
+    if shared:
+        resp = replace(resp, shared=True)
+    else:
+        cache.set(cache_key, resp.text)
+    _observe(role, model, resp)
+    return resp
+
+
+async def acall_llm(
+    prompt: str,
+    model_id: Optional[str] = None,
+    max_tokens: int = 1024,
+    temperature: float = 0.2,
+    api_key: Optional[str] = None,
+    on_token: Optional[Callable[[str], None]] = None,
+    first_token_timeout: Optional[float] = None,
+    cacheable: bool = False,
+    role: str = "other",
+) -> str:
+    """Text-only shortcut for `acomplete`."""
+    resp = await acomplete(prompt, model_id, max_tokens, temperature, api_key, on_token=on_token,
+                           first_token_timeout=first_token_timeout, cacheable=cacheable, role=role)
+    return resp.text
+
+
+def provider_status() -> Dict[str, Any]:
+    backend = get_backend()
+    return {
+        "backend": backend.name,
+        "base_url": backend.base_url,
+        "registered": sorted(_BACKEND_FACTORIES),
+    }
@@ -0,0 +1,295 @@
+"""Per-model / per-API-key rate limiting for LLM calls.
+
+Each (model, api key) pair gets a `ModelLimiter` that enforces three limits at once:
+requests per minute and tokens per minute (token buckets refilled continuously) and a cap on
+concurrent requests. Callers are queued FIFO and granted strictly in arrival order, so a large
+request is not starved by a stream of small ones; nobody is rejected. A 429 from the provider
+pauses the whole limiter for the advertised Retry-After.
+
+Limits come from LLM_RPM / LLM_TPM / LLM_MAX_CONCURRENCY (0 = unlimited) and can be overridden per
+model with LLM_RATE_LIMITS, e.g. '{"gpt-4o": {"rpm": 500, "tpm": 200000, "concurrency": 16}}'.
+Token usage is estimated up front (prompt chars / 4 + max_tokens) and the unused part is refunded
+once the completion is known.
+
+The limiter is thread-safe and can be awaited from any event loop, so the same instance serves
+the session worker loops, FastAPI handlers and synchronous callers.
+"""
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
+
+from core.dependencies import logger
+
+LLM_RPM = float(os.environ.get("LLM_RPM", "0"))
+LLM_TPM = float(os.environ.get("LLM_TPM", "0"))
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", "0"))
+LLM_RETRY_AFTER_DEFAULT = float(os.environ.get("LLM_RETRY_AFTER_DEFAULT", "2"))
+
+
+def _load_overrides() -> Dict[str, Dict[str, float]]:
+    raw = os.environ.get("LLM_RATE_LIMITS")
+    if not raw:
+        return {}
+    try:
+        data = json.loads(raw)
+        return data if isinstance(data, dict) else {}
+    except ValueError:
+        logger.warning("LLM_RATE_LIMITS 不是合法的 JSON，忽略按模型配置")
+        return {}
+
+
+LLM_RATE_LIMITS = _load_overrides()
+
+
+def estimate_tokens(prompt: str, max_tokens: int = 0) -> int:
+    return len(prompt or "") // 4 + int(max_tokens or 0)
+
+
+class _TokenBucket:
+    """Continuous-refill bucket; rate_per_minute <= 0 means unlimited. Not locked (owner locks)."""
+
+    def __init__(self, rate_per_minute: float):
+        self.capacity = float(rate_per_minute)
+        self.rate = self.capacity / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    @property
+    def unlimited(self) -> bool:
+        return self.capacity <= 0
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_for(self, amount: float, now: float) -> float:
+        """Seconds until `amount` is available (requests larger than the bucket wait for a full one)."""
+        if self.unlimited:
+            return 0.0
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def take(self, amount: float) -> None:
+        if not self.unlimited:
+            self.level -= min(amount, self.capacity)
+
+    def refund(self, amount: float) -> None:
+        if not self.unlimited and amount > 0:
+            self.level = min(self.capacity, self.level + amount)
+
+
+class _Waiter:
+    __slots__ = ("tokens", "enqueued_at", "wake")
+
+    def __init__(self, tokens: int, wake: Callable[[], None]):
+        self.tokens = tokens
+        self.enqueued_at = time.monotonic()
+        self.wake = wake
+
+
+class Permit:
+    """A granted slot. Set `used_tokens` once the real usage is known to refund the estimate."""
+
+    def __init__(self, limiter: "ModelLimiter", tokens: int, waited: float):
+        self.limiter = limiter
+        self.tokens = tokens
+        self.waited = waited
+        self.used_tokens: Optional[int] = None
+
+
+class ModelLimiter:
+    def __init__(self, name: str, rpm: float = 0, tpm: float = 0, concurrency: int = 0):
+        self.name = name
+        self.concurrency = int(concurrency)
+        self._requests = _TokenBucket(rpm)
+        self._tokens = _TokenBucket(tpm)
+        self._queue: Deque[_Waiter] = deque()
+        self._lock = threading.Lock()
+        self._paused_until = 0.0
+        self.in_flight = 0
+        self.granted = 0
+        self.throttled = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    # -- core (caller holds self._lock) -------------------------------------------------------
+    def _try_grant(self, waiter: _Waiter) -> Optional[float]:
+        """0 = granted; >0 = retry after that many seconds; None = wait until woken."""
+        if not self._queue or self._queue[0] is not waiter:
+            return None
+        if self.concurrency > 0 and self.in_flight >= self.concurrency:
+            return None
+        now = time.monotonic()
+        delay = max(
+            self._paused_until - now,
+            self._requests.wait_for(1, now),
+            self._tokens.wait_for(waiter.tokens, now),
+        )
+        if delay > 0:
+            return delay
+        self._requests.take(1)
+        self._tokens.take(waiter.tokens)
+        self._queue.popleft()
+        self.in_flight += 1
+        waited = now - waiter.enqueued_at
+        self.granted += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        if waited > 0.001:
+            self.throttled += 1
+        self._wake_head()
+        return 0.0
+
+    def _wake_head(self) -> None:
+        if self._queue:
+            self._queue[0].wake()
+
+    def _abandon(self, waiter: _Waiter) -> None:
+        with self._lock:
+            try:
+                self._queue.remove(waiter)
+            except ValueError:
+                return
+            self._wake_head()
+
+    def _release(self, permit: Permit) -> None:
+        with self._lock:
+            self.in_flight = max(0, self.in_flight - 1)
+            if permit.used_tokens is not None:
+                self._tokens.refund(permit.tokens - permit.used_tokens)
+            self._wake_head()
+
+    # -- public API ---------------------------------------------------------------------------
+    def acquire(self, tokens: int = 0) -> Permit:
+        event = threading.Event()
+        waiter = _Waiter(tokens, event.set)
+        with self._lock:
+            self._queue.append(waiter)
+        try:
+            while True:
+                # clear before checking so a wake-up between the check and the wait is not lost
+                event.clear()
+                with self._lock:
+                    delay = self._try_grant(waiter)
+                if delay == 0:
+                    return Permit(self, tokens, time.monotonic() - waiter.enqueued_at)
+                event.wait(delay)
+        except BaseException:
+            self._abandon(waiter)
+            raise
+
+    async def aacquire(self, tokens: int = 0) -> Permit:
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+
+        def wake() -> None:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:  # loop already closed
+                pass
+
+        waiter = _Waiter(tokens, wake)
+        with self._lock:
+            self._queue.append(waiter)
+        try:
+            while True:
+                event.clear()
+                with self._lock:
+                    delay = self._try_grant(waiter)
+                if delay == 0:
+                    return Permit(self, tokens, time.monotonic() - waiter.enqueued_at)
+                try:
+                    await asyncio.wait_for(event.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            self._abandon(waiter)
+            raise
+
+    @contextlib.contextmanager
+    def slot(self, tokens: int = 0):
+        permit = self.acquire(tokens)
+        try:
+            yield permit
+        finally:
+            self._release(permit)
+
+    @contextlib.asynccontextmanager
+    async def aslot(self, tokens: int = 0):
+        permit = await self.aacquire(tokens)
+        try:
+            yield permit
+        finally:
+            self._release(permit)
+
+    def backoff(self, seconds: Optional[float] = None) -> None:
+        """Pause all grants after a provider 429 (Retry-After seconds, or the default)."""
+        seconds = LLM_RETRY_AFTER_DEFAULT if seconds is None else max(0.0, seconds)
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        logger.warning(f"LLM 限流 {self.name}: 暂停发放请求 {seconds:.1f}s")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            now = time.monotonic()
+            oldest = now - self._queue[0].enqueued_at if self._queue else 0.0
+            return {
+                "queue_depth": len(self._queue),
+                "oldest_wait_s": round(oldest, 3),
+                "in_flight": self.in_flight,
+                "concurrency": self.concurrency or None,
+                "rpm": self._requests.capacity or None,
+                "tpm": self._tokens.capacity or None,
+                "granted": self.granted,
+                "throttled": self.throttled,
+                "avg_wait_s": round(self.total_wait / self.granted, 4) if self.granted else 0.0,
+                "max_wait_s": round(self.max_wait, 3),
+                "paused_s": round(max(0.0, self._paused_until - now), 3),
+            }
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+_LIMITERS: Dict[Tuple[str, str], ModelLimiter] = {}
+_LIMITERS_LOCK = threading.Lock()
+
+
+def _key_tag(api_key: Optional[str]) -> str:
+    return hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:8]
+
+
+def get_rate_limiter(model: str, api_key: Optional[str] = None) -> ModelLimiter:
+    ident = (model or "", _key_tag(api_key))
+    with _LIMITERS_LOCK:
+        limiter = _LIMITERS.get(ident)
+        if limiter is None:
+            cfg = LLM_RATE_LIMITS.get(model or "", {})
+            limiter = _LIMITERS[ident] = ModelLimiter(
+                f"{model}#{ident[1]}",
+                rpm=float(cfg.get("rpm", LLM_RPM)),
+                tpm=float(cfg.get("tpm", LLM_TPM)),
+                concurrency=int(cfg.get("concurrency", LLM_MAX_CONCURRENCY)),
+            )
+        return limiter
+
+
+def rate_limit_stats() -> Dict[str, Any]:
+    with _LIMITERS_LOCK:
+        limiters = list(_LIMITERS.values())
+    return {limiter.name: limiter.stats() for limiter in limiters}
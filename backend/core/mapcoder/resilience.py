@@ -0,0 +1,270 @@
+"""Retry, circuit breaking and request hedging for LLM endpoints.
+
+An attempt that fails with a retryable HTTP status (`RetryableError`) or a transport error is
+retried with full-jitter exponential backoff (honouring Retry-After) up to LLM_RETRY_ATTEMPTS.
+Failures (and timeouts, which are not retried) are also counted per endpoint: after
+LLM_BREAKER_FAILURES consecutive failures the endpoint's breaker opens and calls fail fast with
+`CircuitOpenError` for LLM_BREAKER_RESET_SECONDS, after which a single probe is let through
+(half-open).
+
+With LLM_HEDGE enabled, a non-streaming call that has not answered within the endpoint's recent
+p95 latency gets a second, identical request; whichever finishes first wins and the other is
+cancelled. Hedging only kicks in once LLM_HEDGE_MIN_SAMPLES latencies have been observed.
+"""
+from __future__ import annotations
+
+import asyncio
+import os
+import random
+import threading
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Tuple, TypeVar
+
+from core.dependencies import logger
+
+try:
+    import httpx
+except Exception:  # pragma: no cover - optional dependency
+    httpx = None
+
+import requests
+
+LLM_RETRY_ATTEMPTS = int(os.environ.get("LLM_RETRY_ATTEMPTS", "3"))
+LLM_RETRY_BASE_DELAY = float(os.environ.get("LLM_RETRY_BASE_DELAY", "0.5"))
+LLM_RETRY_MAX_DELAY = float(os.environ.get("LLM_RETRY_MAX_DELAY", "8"))
+LLM_BREAKER_FAILURES = int(os.environ.get("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_RESET_SECONDS = float(os.environ.get("LLM_BREAKER_RESET_SECONDS", "30"))
+LLM_HEDGE = os.environ.get("LLM_HEDGE", "false").lower() in ("1", "true", "yes")
+LLM_HEDGE_MIN_SAMPLES = int(os.environ.get("LLM_HEDGE_MIN_SAMPLES", "20"))
+LLM_HEDGE_MIN_DELAY = float(os.environ.get("LLM_HEDGE_MIN_DELAY", "0.5"))
+
+RETRYABLE_STATUSES = frozenset({408, 409, 425, 429, 500, 502, 503, 504})
+
+# builtin TimeoutError is left out on purpose: asyncio.wait_for raises it for our own deadlines
+_TRANSIENT = [ConnectionError, requests.ConnectionError, requests.Timeout]
+if httpx is not None:
+    _TRANSIENT.append(httpx.TransportError)
+TRANSIENT_ERRORS: Tuple[type, ...] = tuple(_TRANSIENT)
+
+T = TypeVar("T")
+
+
+class RetryableError(Exception):
+    def __init__(self, status: int, retry_after: Optional[float] = None, detail: str = ""):
+        super().__init__(f"status={status} {detail}".strip())
+        self.status = status
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+def backoff_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+    """Full-jitter exponential delay before retry number `attempt` (0-based)."""
+    delay = random.uniform(0, min(LLM_RETRY_MAX_DELAY, LLM_RETRY_BASE_DELAY * (2 ** attempt)))
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, LLM_RETRY_MAX_DELAY))
+    return delay
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = LLM_BREAKER_FAILURES, reset_seconds: float = LLM_BREAKER_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.rejected = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> None:
+        with self._lock:
+            if self.state == "closed":
+                return
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self.state = "half_open"
+                self._probing = False
+            if self.state == "half_open" and not self._probing:
+                self._probing = True
+                return
+            self.rejected += 1
+        raise CircuitOpenError("LLM endpoint circuit is open")
+
+    def is_open(self) -> bool:
+        """True while calls would be rejected; unlike allow() this never takes the half-open probe."""
+        with self._lock:
+            return self.state == "open" and time.monotonic() - self.opened_at < self.reset_seconds
+
+    def release(self) -> None:
+        """End an attempt without a verdict (cancelled, or failed in a way that says nothing about
+        the endpoint): a half-open breaker lets the next call probe instead."""
+        with self._lock:
+            self._probing = False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    logger.warning(f"LLM 端点连续失败 {self.failures} 次，熔断 {self.reset_seconds:.0f}s")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                self._probing = False
+
+
+class Endpoint:
+    """Breaker, latency window and counters for one upstream URL."""
+
+    def __init__(self, name: str, window: int = 200):
+        self.name = name
+        self.breaker = CircuitBreaker()
+        self._latencies: Deque[float] = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def observe(self, seconds: float) -> None:
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def p95(self) -> Optional[float]:
+        with self._lock:
+            if len(self._latencies) < LLM_HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    def stats(self) -> Dict[str, Any]:
+        p95 = self.p95()
+        return {
+            "breaker": self.breaker.state,
+            "consecutive_failures": self.breaker.failures,
+            "rejected": self.breaker.rejected,
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "p95_s": round(p95, 3) if p95 is not None else None,
+        }
+
+
+_ENDPOINTS: Dict[str, Endpoint] = {}
+_ENDPOINTS_LOCK = threading.Lock()
+
+
+def get_endpoint(url: str) -> Endpoint:
+    with _ENDPOINTS_LOCK:
+        ep = _ENDPOINTS.get(url)
+        if ep is None:
+            ep = _ENDPOINTS[url] = Endpoint(url)
+        return ep
+
+
+def endpoint_stats() -> Dict[str, Any]:
+    with _ENDPOINTS_LOCK:
+        endpoints = list(_ENDPOINTS.values())
+    return {ep.name: ep.stats() for ep in endpoints}
+
+
+def _retryable(exc: BaseException) -> bool:
+    return isinstance(exc, RetryableError) or isinstance(exc, TRANSIENT_ERRORS)
+
+
+def _unhealthy(exc: BaseException) -> bool:
+    """Errors that count against the endpoint's breaker: retryable ones plus timeouts (total
+    deadline, FirstTokenTimeout), which are not retried but mean the provider is stalling."""
+    return _retryable(exc) or isinstance(exc, (TimeoutError, asyncio.TimeoutError))
+
+
+def _settle_breaker(ep: Endpoint, exc: BaseException) -> None:
+    if _unhealthy(exc):
+        ep.breaker.record_failure()
+    else:
+        # cancellation (branch cancelled, losing hedge) or a request error: no verdict
+        ep.breaker.release()
+
+
+async def _hedged(ep: Endpoint, attempt: Callable[[], Awaitable[T]]) -> T:
+    delay = ep.p95()
+    if delay is None:
+        return await attempt()
+    futures = [asyncio.ensure_future(attempt())]
+    try:
+        done, _ = await asyncio.wait(futures, timeout=max(delay, LLM_HEDGE_MIN_DELAY))
+        if not done:
+            ep.hedges += 1
+            futures.append(asyncio.ensure_future(attempt()))
+        pending = set(futures)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for fut in done:
+                if fut.exception() is None:
+                    if fut is not futures[0]:
+                        ep.hedge_wins += 1
+                    return fut.result()
+        # every request failed: surface the original request's error
+        return futures[0].result()
+    finally:
+        for fut in futures:
+            if not fut.done():
+                fut.cancel()
+
+
+async def aresilient(url: str, attempt: Callable[[], Awaitable[T]], hedge: bool = False,
+                     can_retry: Callable[[], bool] = lambda: True) -> T:
+    """Run `attempt` against `url` with breaker, retries and optional hedging.
+
+    `can_retry` lets streaming callers refuse a retry once tokens have been delivered.
+    """
+    ep = get_endpoint(url)
+    for n in range(max(1, LLM_RETRY_ATTEMPTS)):
+        ep.breaker.allow()
+        started = time.monotonic()
+        try:
+            result = await (_hedged(ep, attempt) if hedge and LLM_HEDGE else attempt())
+        except BaseException as e:
+            # every outcome settles the breaker, or a half-open probe would stay taken forever
+            _settle_breaker(ep, e)
+            if not _retryable(e) or n + 1 >= LLM_RETRY_ATTEMPTS or not can_retry():
+                raise
+            delay = backoff_delay(n, getattr(e, "retry_after", None))
+            ep.retries += 1
+            logger.info(f"LLM 请求失败 ({e})，{delay:.2f}s 后第 {n + 1} 次重试")
+            await asyncio.sleep(delay)
+            continue
+        ep.breaker.record_success()
+        ep.observe(time.monotonic() - started)
+        return result
+    raise RuntimeError("unreachable")
+
+
+def resilient(url: str, attempt: Callable[[], T]) -> T:
+    """Blocking variant of `aresilient` (no hedging)."""
+    ep = get_endpoint(url)
+    for n in range(max(1, LLM_RETRY_ATTEMPTS)):
+        ep.breaker.allow()
+        started = time.monotonic()
+        try:
+            result = attempt()
+        except BaseException as e:
+            _settle_breaker(ep, e)
+            if not _retryable(e) or n + 1 >= LLM_RETRY_ATTEMPTS:
+                raise
+            delay = backoff_delay(n, getattr(e, "retry_after", None))
+            ep.retries += 1
+            logger.info(f"LLM 请求失败 ({e})，{delay:.2f}s 后第 {n + 1} 次重试")
+            time.sleep(delay)
+            continue
+        ep.breaker.record_success()
+        ep.observe(time.monotonic() - started)
+        return result
+    raise RuntimeError("unreachable")
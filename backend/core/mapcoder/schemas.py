@@ -1,7 +1,7 @@
 from __future__ import annotations
 
 from dataclasses import dataclass
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Tuple
 
 from pydantic import BaseModel
 
@@ -19,6 +19,23 @@ class RoleConfig:
     capabilities: Optional[Dict[str, Any]] = None
 
 
+@dataclass
+class StageSpec:
+    """流水线中的一个阶段（DAG 节点）。
+
+    name 同时作为角色名使用；depends_on 中引用的阶段若未出现在本次流水线中则视为已满足。
+    optional=True 时若找不到对应角色则跳过该阶段，而不是以无角色任务运行。
+    fanout=True 的阶段不创建自身任务行，而是按候选计划派生并行的 coder/debugger 分支。
+    """
+
+    name: str
+    title: str
+    description: str
+    depends_on: Tuple[str, ...] = ()
+    optional: bool = False
+    fanout: bool = False
+
+
 # --- Pydantic schemas for router input/output ---
 class RoleConfigSchema(BaseModel):
     name: str
@@ -58,6 +75,7 @@ class SessionDetail(SessionSummary):
     tasks: Optional[List[Dict[str, Any]]] = None
     logs: Optional[List[Dict[str, Any]]] = None
     final_result: Optional[Dict[str, Any]] = None
+    messages: Optional[List[Dict[str, Any]]] = None
 
 
 class SessionStatusResponse(BaseModel):
@@ -68,6 +86,7 @@ class SessionStatusResponse(BaseModel):
 
 __all__ = [
     "RoleConfig",
+    "StageSpec",
     "RoleConfigSchema",
     "CreateSessionRequest",
     "UpdateSessionRequest",
@@ -0,0 +1,383 @@
+"""Session run job queue.
+
+`/mapcoder/session/{id}/run` only enqueues a job; a pool of worker threads (embedded in the API
+process and/or in dedicated `python -m scripts.session_worker` processes) pulls jobs and runs
+`CoordinatorService.run_session_by_id`. Each worker thread owns one long-lived event loop.
+
+Backends:
+- RedisSessionQueue: reliable-queue pattern (BRPOPLPUSH pending -> processing, LREM on ack) plus a
+  lease hash; jobs whose lease expires (worker crashed) are moved back to pending, so delivery
+  is at-least-once across processes.
+- InMemorySessionQueue: thread-safe local fallback when Redis is unavailable; jobs are retried
+  on failure but do not survive a process restart.
+
+Duplicate deliveries are harmless: the coordinator claims the session's root task lease before
+running (see leases.py). The sweeper also re-enqueues sessions whose root lease expired.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field, asdict
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+import redis
+
+from core.dependencies import logger, redis_pool
+from core.event_publisher import close_event_publisher
+from core.loop_monitor import get_loop_monitor
+from core.mapcoder.provider import aclose_async_client
+
+QUEUE_BACKEND = os.environ.get("MAPCODER_QUEUE_BACKEND", "auto").lower()  # auto | redis | memory
+QUEUE_WORKERS = int(os.environ.get("MAPCODER_QUEUE_WORKERS", "2"))
+# 是否在 API 进程内启动 worker；部署独立 worker 进程时可关闭
+QUEUE_EMBEDDED = os.environ.get("MAPCODER_QUEUE_EMBEDDED", "true").lower() in ("1", "true", "yes")
+JOB_VISIBILITY_TIMEOUT = float(os.environ.get("MAPCODER_JOB_VISIBILITY_TIMEOUT", "300"))
+JOB_MAX_ATTEMPTS = int(os.environ.get("MAPCODER_JOB_MAX_ATTEMPTS", "3"))
+SWEEP_SECONDS = float(os.environ.get("MAPCODER_QUEUE_SWEEP_SECONDS", "15"))
+
+PENDING_KEY = "mapcoder:jobs:pending"
+PROCESSING_KEY = "mapcoder:jobs:processing"
+LEASES_KEY = "mapcoder:jobs:leases"
+DEAD_KEY = "mapcoder:jobs:dead"
+
+
+@dataclass
+class SessionJob:
+    session_id: int
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    attempt: int = 0
+    enqueued_at: float = field(default_factory=time.time)
+    raw: Optional[str] = field(default=None, repr=False, compare=False)
+
+    def dumps(self) -> str:
+        data = asdict(self)
+        data.pop("raw", None)
+        return json.dumps(data)
+
+    @classmethod
+    def loads(cls, raw: str) -> "SessionJob":
+        data = json.loads(raw)
+        return cls(session_id=int(data["session_id"]), id=data["id"], attempt=int(data.get("attempt", 0)),
+                   enqueued_at=float(data.get("enqueued_at") or time.time()), raw=raw)
+
+
+class InMemorySessionQueue:
+    backend = "memory"
+
+    def __init__(self, max_attempts: int = JOB_MAX_ATTEMPTS) -> None:
+        self.max_attempts = max_attempts
+        self._pending: "queue.Queue[SessionJob]" = queue.Queue()
+        self._processing: Dict[str, SessionJob] = {}
+        self._dead: List[SessionJob] = []
+        self._lock = threading.Lock()
+
+    def enqueue(self, session_id: int) -> SessionJob:
+        job = SessionJob(session_id=session_id)
+        self._pending.put(job)
+        return job
+
+    def reserve(self, timeout: float = 1.0) -> Optional[SessionJob]:
+        try:
+            job = self._pending.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        with self._lock:
+            self._processing[job.id] = job
+        return job
+
+    def touch(self, job: SessionJob) -> None:
+        pass
+
+    def ack(self, job: SessionJob) -> None:
+        with self._lock:
+            self._processing.pop(job.id, None)
+
+    def nack(self, job: SessionJob) -> None:
+        with self._lock:
+            self._processing.pop(job.id, None)
+        job.attempt += 1
+        if job.attempt >= self.max_attempts:
+            self._dead.append(job)
+            logger.error(f"会话任务 {job.session_id} 重试 {job.attempt} 次后放弃")
+            return
+        self._pending.put(job)
+
+    def requeue_expired(self) -> int:
+        return 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": self.backend, "pending": self._pending.qsize(), "processing": len(self._processing),
+                "dead": len(self._dead)}
+
+
+class RedisSessionQueue:
+    backend = "redis"
+
+    def __init__(self, client: Optional[redis.Redis] = None, visibility_timeout: float = JOB_VISIBILITY_TIMEOUT,
+                 max_attempts: int = JOB_MAX_ATTEMPTS) -> None:
+        self.redis = client or redis.Redis(connection_pool=redis_pool)
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+
+    def enqueue(self, session_id: int) -> SessionJob:
+        job = SessionJob(session_id=session_id)
+        self.redis.lpush(PENDING_KEY, job.dumps())
+        return job
+
+    def reserve(self, timeout: float = 1.0) -> Optional[SessionJob]:
+        # keep the blocking window below the shared pool's socket_timeout
+        raw = self.redis.brpoplpush(PENDING_KEY, PROCESSING_KEY, timeout=max(1, int(timeout)))
+        if raw is None:
+            return None
+        job = SessionJob.loads(raw)
+        self.redis.hset(LEASES_KEY, job.id, time.time() + self.visibility_timeout)
+        return job
+
+    def touch(self, job: SessionJob) -> None:
+        self.redis.hset(LEASES_KEY, job.id, time.time() + self.visibility_timeout)
+
+    def ack(self, job: SessionJob) -> None:
+        pipe = self.redis.pipeline()
+        pipe.lrem(PROCESSING_KEY, 1, job.raw)
+        pipe.hdel(LEASES_KEY, job.id)
+        pipe.execute()
+
+    def nack(self, job: SessionJob) -> None:
+        retry = SessionJob(session_id=job.session_id, id=job.id, attempt=job.attempt + 1, enqueued_at=job.enqueued_at)
+        pipe = self.redis.pipeline()
+        pipe.lrem(PROCESSING_KEY, 1, job.raw)
+        pipe.hdel(LEASES_KEY, job.id)
+        if retry.attempt >= self.max_attempts:
+            logger.error(f"会话任务 {job.session_id} 重试 {retry.attempt} 次后放弃")
+            pipe.lpush(DEAD_KEY, retry.dumps())
+        else:
+            pipe.rpush(PENDING_KEY, retry.dumps())
+        pipe.execute()
+
+    def requeue_expired(self) -> int:
+        """Move jobs whose lease has expired (crashed worker) back to the head of the pending list."""
+        now = time.time()
+        moved = 0
+        for raw in self.redis.lrange(PROCESSING_KEY, 0, -1):
+            try:
+                job = SessionJob.loads(raw)
+            except Exception:
+                self.redis.lrem(PROCESSING_KEY, 1, raw)
+                continue
+            deadline = self.redis.hget(LEASES_KEY, job.id)
+            if deadline is None:
+                # reserved but lease not written yet (or the worker died in between): start the clock now
+                self.redis.hsetnx(LEASES_KEY, job.id, now + self.visibility_timeout)
+                continue
+            if float(deadline) > now:
+                continue
+            # LREM is atomic: only the worker that actually removes the entry re-enqueues it
+            if self.redis.lrem(PROCESSING_KEY, 1, raw):
+                self.redis.hdel(LEASES_KEY, job.id)
+                job.raw = raw
+                self.nack(job)
+                moved += 1
+        if moved:
+            logger.warning(f"重新入队 {moved} 个租约过期的会话任务")
+        return moved
+
+    def stats(self) -> Dict[str, Any]:
+        pipe = self.redis.pipeline()
+        pipe.llen(PENDING_KEY)
+        pipe.llen(PROCESSING_KEY)
+        pipe.llen(DEAD_KEY)
+        pending, processing, dead = pipe.execute()
+        return {"backend": self.backend, "pending": pending, "processing": processing, "dead": dead}
+
+
+def _build_queue():
+    if QUEUE_BACKEND == "memory":
+        return InMemorySessionQueue()
+    client = redis.Redis(connection_pool=redis_pool)
+    if QUEUE_BACKEND == "redis":
+        return RedisSessionQueue(client)
+    try:
+        client.ping()
+        return RedisSessionQueue(client)
+    except Exception as e:
+        logger.warning(f"Redis 不可用，会话任务队列使用进程内实现: {e}")
+        return InMemorySessionQueue()
+
+
+_QUEUE = None
+_QUEUE_LOCK = threading.Lock()
+
+
+def get_session_queue():
+    global _QUEUE
+    with _QUEUE_LOCK:
+        if _QUEUE is None:
+            _QUEUE = _build_queue()
+        return _QUEUE
+
+
+async def run_session_job(job: SessionJob) -> None:
+    # imported lazily: coordinator pulls in the agent stack
+    from core.dependencies import SessionLocal
+    from core.mapcoder.coordinator import CoordinatorService
+    from core.models import AgentSession
+
+    db = SessionLocal()
+    try:
+        session = db.query(AgentSession).filter_by(id=job.session_id).first()
+        if not session:
+            logger.warning(f"Session {job.session_id} 不存在，丢弃任务 {job.id}")
+            return
+        if session.status in ("completed", "canceled"):
+            # duplicate delivery of an already finished run
+            return
+        await CoordinatorService(db).run_session(session)
+    finally:
+        db.close()
+
+
+class SessionWorkerPool:
+    """Fixed pool of worker threads, each with its own event loop, pulling jobs from the queue."""
+
+    def __init__(self, job_queue=None, workers: int = QUEUE_WORKERS) -> None:
+        self.queue = job_queue or get_session_queue()
+        self.workers = max(1, workers)
+        self.active = 0
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        if self._threads:
+            return
+        self._stop.clear()
+        for idx in range(self.workers):
+            t = threading.Thread(target=self._worker_main, args=(idx,), name=f"session-worker-{idx}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        logger.info(f"会话任务 worker 已启动: backend={self.queue.backend} workers={self.workers}")
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stop.set()
+        for t in self._threads:
+            t.join(timeout=timeout)
+        self._threads = []
+
+    def stats(self) -> Dict[str, Any]:
+        data = self.queue.stats()
+        data.update({"workers": len(self._threads), "active": self.active})
+        return data
+
+    def _worker_main(self, idx: int) -> None:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        next_sweep = 0.0
+        try:
+            while not self._stop.is_set():
+                try:
+                    # one sweeper per process is enough; row locks / LREM keep nodes from double-recovering
+                    if idx == 0 and time.time() >= next_sweep:
+                        self.queue.requeue_expired()
+                        self._recover_orphaned_sessions()
+                        next_sweep = time.time() + SWEEP_SECONDS
+                    job = self.queue.reserve(timeout=1.0)
+                except Exception as e:
+                    logger.warning(f"会话任务队列不可用: {e}")
+                    self._stop.wait(2.0)
+                    continue
+                if job is None:
+                    continue
+                with self._lock:
+                    self.active += 1
+                try:
+                    loop.run_until_complete(self._execute(job))
+                    self.queue.ack(job)
+                except Exception:
+                    logger.exception(f"会话任务执行失败 session={job.session_id} attempt={job.attempt}")
+                    try:
+                        self.queue.nack(job)
+                    except Exception:
+                        logger.warning("会话任务重新入队失败", exc_info=True)
+                finally:
+                    with self._lock:
+                        self.active -= 1
+        finally:
+            try:
+                loop.run_until_complete(close_event_publisher())
+                loop.run_until_complete(aclose_async_client())
+            except Exception:
+                pass
+            loop.close()
+
+    def _recover_orphaned_sessions(self) -> None:
+        """Re-enqueue sessions whose root task lease expired because the owning worker died."""
+        from core.dependencies import SessionLocal, publish_event
+        from core.mapcoder.leases import TaskLeaseManager
+        from core.models import AgentSession
+
+        db = SessionLocal()
+        try:
+            for root in TaskLeaseManager(db).reclaim_orphaned_roots():
+                if root.status == "pending":
+                    self.queue.enqueue(root.session_id)
+                    continue
+                session = db.query(AgentSession).filter_by(id=root.session_id).first()
+                if session and session.status not in ("completed", "canceled"):
+                    session.status = "failed"
+                    session.updated_at = datetime.now(timezone.utc)
+                    db.commit()
+                    publish_event(session.id, {"type": "session", "session": {"id": session.id, "status": session.status, "updated_at": session.updated_at.isoformat()}})
+        finally:
+            db.close()
+
+    async def _execute(self, job: SessionJob) -> None:
+        async def _heartbeat():
+            interval = max(1.0, getattr(self.queue, "visibility_timeout", JOB_VISIBILITY_TIMEOUT) / 3)
+            while True:
+                await asyncio.sleep(interval)
+                try:
+                    self.queue.touch(job)
+                except Exception:
+                    logger.debug("会话任务续约失败", exc_info=True)
+
+        hb = asyncio.ensure_future(_heartbeat())
+        lag = get_loop_monitor(threading.current_thread().name)
+        lag.start()
+        try:
+            await run_session_job(job)
+        finally:
+            hb.cancel()
+            lag.stop()
+
+
+_POOL: Optional[SessionWorkerPool] = None
+
+
+def start_embedded_workers() -> Optional[SessionWorkerPool]:
+    global _POOL
+    if not QUEUE_EMBEDDED:
+        return None
+    if _POOL is None:
+        _POOL = SessionWorkerPool()
+    _POOL.start()
+    return _POOL
+
+
+def stop_embedded_workers() -> None:
+    if _POOL is not None:
+        _POOL.stop()
+
+
+def queue_stats() -> Dict[str, Any]:
+    if _POOL is not None:
+        return _POOL.stats()
+    data = get_session_queue().stats()
+    data.update({"workers": 0, "active": 0})
+    return data
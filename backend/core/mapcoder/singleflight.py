@@ -0,0 +1,192 @@
+"""Single-flight registry: concurrent identical LLM requests share one upstream call.
+
+The first caller for a key becomes the leader and performs the request; callers arriving while
+it is in flight wait for the leader's result instead of sending their own. The registry is
+process-wide and thread-safe, so followers may live on other session worker loops or be
+synchronous callers. Streaming followers receive the deltas seen so far on join and every later
+delta as the leader receives it, delivered on the follower's own loop. If the leader is
+cancelled, one waiting follower takes over; callers that re-join skip the deltas they already got.
+"""
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+import hashlib
+import json
+import threading
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from core.dependencies import logger
+
+TokenCallback = Callable[[str], None]
+
+
+def flight_key(*parts: Any) -> str:
+    """Hash the request identity (base url, api key, model, prompt, sampling params, ...)."""
+    material = json.dumps(parts, ensure_ascii=False, default=str)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class _LeaderCancelled(Exception):
+    pass
+
+
+class _Listener:
+    """A caller's token callback, run on the caller's loop.
+
+    `emit` runs on the leader's thread, so a follower's callback is handed to its own loop with
+    call_soon_threadsafe (its events then go through that loop's publisher, in order). `delivered`
+    survives re-joins: after a leader is cancelled the next flight streams from the start again and
+    the first `delivered` deltas are skipped.
+    """
+
+    def __init__(self, callback: TokenCallback, loop: Optional[asyncio.AbstractEventLoop]):
+        self.callback = callback
+        self.loop = loop
+        self.delivered = 0
+        self.seen = 0
+
+    def __call__(self, delta: str) -> None:
+        self.seen += 1
+        if self.seen <= self.delivered:
+            return
+        self.delivered += 1
+        if self.loop is None or _running_loop() is self.loop:
+            self.callback(delta)
+        else:
+            self.loop.call_soon_threadsafe(self.callback, delta)
+
+
+def _running_loop() -> Optional[asyncio.AbstractEventLoop]:
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+class _Flight:
+    def __init__(self) -> None:
+        self.future: concurrent.futures.Future = concurrent.futures.Future()
+        self.deltas: List[str] = []
+        self.listeners: List[_Listener] = []
+        self.lock = threading.Lock()
+
+    def emit(self, delta: str) -> None:
+        with self.lock:
+            self.deltas.append(delta)
+            for listener in self.listeners:
+                try:
+                    listener(delta)
+                except Exception:
+                    logger.debug("single-flight token listener failed", exc_info=True)
+
+    def settle(self, result: Any = None, exc: Optional[BaseException] = None) -> None:
+        """Resolve the shared future; a no-op once it is done."""
+        with self.lock:
+            if self.future.done():
+                return
+            if exc is not None:
+                self.future.set_exception(exc)
+            else:
+                self.future.set_result(result)
+
+    def unsubscribe(self, listener: Optional[_Listener]) -> None:
+        with self.lock:
+            if listener in self.listeners:
+                self.listeners.remove(listener)
+
+    def subscribe(self, listener: Optional[_Listener]) -> None:
+        if listener is None:
+            return
+        with self.lock:
+            listener.seen = 0
+            for delta in self.deltas:
+                listener(delta)
+            self.listeners.append(listener)
+
+
+class SingleFlight:
+    def __init__(self) -> None:
+        self._flights: Dict[str, _Flight] = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.followers = 0
+
+    def _join(self, key: str, on_token: Optional[_Listener]) -> Tuple[_Flight, bool]:
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.leaders += 1
+            else:
+                self.followers += 1
+        flight.subscribe(on_token)
+        return flight, leader
+
+    def _finish(self, key: str, flight: _Flight) -> None:
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    async def do_async(self, key: Optional[str], fn: Callable[[Optional[TokenCallback]], Awaitable[Any]],
+                       on_token: Optional[TokenCallback] = None) -> Tuple[Any, bool]:
+        """Run `fn` once per key across concurrent callers. Returns (result, shared)."""
+        if key is None:
+            return await fn(on_token), False
+        listener = _Listener(on_token, asyncio.get_running_loop()) if on_token is not None else None
+        while True:
+            flight, leader = self._join(key, listener)
+            if not leader:
+                try:
+                    # shield: a cancelled follower must not cancel the future the others share
+                    return await asyncio.shield(asyncio.wrap_future(flight.future)), True
+                except _LeaderCancelled:
+                    continue
+                except asyncio.CancelledError:
+                    flight.unsubscribe(listener)
+                    raise
+            try:
+                result = await fn(flight.emit if on_token is not None else None)
+            except asyncio.CancelledError:
+                self._finish(key, flight)
+                flight.settle(exc=_LeaderCancelled())
+                raise
+            except BaseException as e:
+                self._finish(key, flight)
+                flight.settle(exc=e)
+                raise
+            self._finish(key, flight)
+            flight.settle(result)
+            return result, False
+
+    def do_sync(self, key: Optional[str], fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        if key is None:
+            return fn(), False
+        while True:
+            flight, leader = self._join(key, None)
+            if not leader:
+                try:
+                    return flight.future.result(), True
+                except _LeaderCancelled:
+                    continue
+            try:
+                result = fn()
+            except BaseException as e:
+                self._finish(key, flight)
+                flight.settle(exc=e)
+                raise
+            self._finish(key, flight)
+            flight.settle(result)
+            return result, False
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"in_flight": len(self._flights), "leaders": self.leaders, "followers": self.followers}
+
+
+_REGISTRY = SingleFlight()
+
+
+def get_single_flight() -> SingleFlight:
+    return _REGISTRY
@@ -1,10 +1,14 @@
 import asyncio
+import os
+import time
 from contextlib import AsyncExitStack
 from typing import Any, Dict, Optional, Tuple
 
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
 
+from core.metrics import MCP_CALL_SECONDS, MCP_SPAWN_SECONDS
+
 
 class MCPStdioRunner:
     """
@@ -19,11 +23,13 @@ class MCPStdioRunner:
         self, command: str, args: list[str], env: Optional[Dict[str, str]] = None
     ) -> Tuple[AsyncExitStack, ClientSession]:
         exit_stack = AsyncExitStack()
+        started = time.perf_counter()
         params = StdioServerParameters(command=command, args=args, env=env)
         stdio_transport = await exit_stack.enter_async_context(stdio_client(params))
         stdio, write = stdio_transport
         session = await exit_stack.enter_async_context(ClientSession(stdio, write))
         await session.initialize()
+        MCP_SPAWN_SECONDS.observe(time.perf_counter() - started, command=os.path.basename(command))
         return exit_stack, session
 
     async def list_tools(self, command: str, args: list[str], env: Optional[Dict[str, str]] = None) -> Any:
@@ -44,7 +50,8 @@ class MCPStdioRunner:
     ) -> Any:
         exit_stack, session = await self._open_session(command, args, env)
         try:
-            result = await session.call_tool(tool_name, tool_args)
+            with MCP_CALL_SECONDS.time(tool=tool_name):
+                result = await session.call_tool(tool_name, tool_args)
             return result.content
         finally:
             await exit_stack.aclose()
@@ -0,0 +1,106 @@
+"""Chat transcript storage in the append-only agent_messages table.
+
+Messages are only ever inserted; reads page by primary key within a session (keyset pagination on
+the (session_id, id) index), so a turn costs two small INSERTs no matter how long the conversation
+is, and the full history is kept. Sessions created before this table existed keep their
+transcript in metadata["messages"]; it is moved into the table the first time the session is
+touched (`migrate_legacy_messages`).
+"""
+from __future__ import annotations
+
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from core.models import AgentMessage, AgentSession
+
+MAX_PAGE_SIZE = 200
+
+
+def message_dict(m: AgentMessage) -> Dict[str, Any]:
+    return {
+        "id": m.id,
+        "role": m.role,
+        "content": m.content,
+        "created_at": m.created_at.isoformat() if m.created_at else None,
+    }
+
+
+def append_messages(db: Session, session_id: int, messages: Iterable[Tuple[str, str, Optional[datetime]]]) -> List[AgentMessage]:
+    """Insert (role, content, created_at) rows; the caller commits."""
+    rows = [
+        AgentMessage(session_id=session_id, role=role, content=content, created_at=created_at or datetime.now(timezone.utc))
+        for role, content, created_at in messages
+    ]
+    db.add_all(rows)
+    return rows
+
+
+def recent_messages(db: Session, session_id: int, limit: int) -> List[AgentMessage]:
+    """The last `limit` messages of a session, oldest first."""
+    if limit <= 0:
+        return []
+    rows = (
+        db.query(AgentMessage)
+        .filter(AgentMessage.session_id == session_id)
+        .order_by(AgentMessage.id.desc())
+        .limit(limit)
+        .all()
+    )
+    rows.reverse()
+    return rows
+
+
+def page_messages(db: Session, session_id: int, before_id: Optional[int] = None, after_id: Optional[int] = None,
+                  limit: int = 50) -> Dict[str, Any]:
+    """Keyset page of a session's messages, oldest first.
+
+    Without cursors this is the newest page; `before_id` walks back through history and `after_id`
+    fetches what was added since. `next_before_id` is the cursor for the previous (older) page,
+    or None at the beginning of the conversation.
+    """
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    query = db.query(AgentMessage).filter(AgentMessage.session_id == session_id)
+    if after_id is not None:
+        rows = query.filter(AgentMessage.id > after_id).order_by(AgentMessage.id.asc()).limit(limit + 1).all()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        return {"messages": [message_dict(m) for m in rows], "next_before_id": None,
+                "next_after_id": rows[-1].id if rows else after_id, "has_more": has_more}
+    if before_id is not None:
+        query = query.filter(AgentMessage.id < before_id)
+    rows = query.order_by(AgentMessage.id.desc()).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    rows.reverse()
+    return {"messages": [message_dict(m) for m in rows], "next_before_id": rows[0].id if has_more and rows else None,
+            "next_after_id": rows[-1].id if rows else None, "has_more": has_more}
+
+
+def migrate_legacy_messages(db: Session, session: AgentSession) -> bool:
+    """Move metadata["messages"] into agent_messages (once per session); the caller commits."""
+    meta = session.metadata_ or {}
+    legacy = meta.get("messages")
+    if not legacy:
+        return False
+    rows = []
+    for m in legacy:
+        if not isinstance(m, dict) or not m.get("content"):
+            continue
+        created_at = None
+        if m.get("created_at"):
+            try:
+                created_at = datetime.fromisoformat(str(m["created_at"]))
+            except ValueError:
+                created_at = None
+        rows.append((str(m.get("role") or "user"), str(m["content"]), created_at))
+    append_messages(db, session.id, rows)
+    meta = dict(meta)
+    meta.pop("messages", None)
+    session.metadata_ = meta
+    return True
+
+
+def delete_messages(db: Session, session_id: int) -> int:
+    return db.query(AgentMessage).filter(AgentMessage.session_id == session_id).delete(synchronize_session=False)
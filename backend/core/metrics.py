@@ -0,0 +1,151 @@
+"""In-process metrics with Prometheus text exposition (served on GET /metrics).
+
+Dependency-free histograms and counters: each worker process keeps its own registry, which is
+what Prometheus expects when it scrapes every replica. Observations are thread-safe, so session
+worker threads, their event loops and request handlers can all record into the same metric.
+
+    with LLM_LATENCY_SECONDS.time(role="coding", model="gpt-4o"):
+        ...
+    DB_COMMIT_SECONDS.observe(0.004)
+"""
+from __future__ import annotations
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+TOKEN_BUCKETS = (16, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+
+LabelKey = Tuple[str, ...]
+_INF = 'le="+Inf"'
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> LabelKey:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help_text, labelnames)
+        self._values: Dict[LabelKey, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_labels(self.labelnames, k)} {v}" for k, v in items]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # per label set: [count per bucket..., +Inf count], sum
+        self._series: Dict[LabelKey, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = ([0] * (len(self.buckets) + 1), [0.0])
+            series[0][idx] += 1
+            series[1][0] += value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted((k, (list(c), s[0])) for k, (c, s) in self._series.items())
+        lines = []
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}")
+            cumulative += counts[-1]
+            lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, _INF)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+REGISTRY: List[_Metric] = []
+
+
+def render_metrics() -> str:
+    out: List[str] = []
+    for metric in list(REGISTRY):
+        out.append(f"# HELP {metric.name} {metric.help}")
+        out.append(f"# TYPE {metric.name} {metric.kind}")
+        out.extend(metric.render())
+    return "\n".join(out) + "\n"
+
+
+# --- MapCoder stages ------------------------------------------------------------------------
+STAGE_QUEUE_SECONDS = Histogram("mapcoder_stage_queue_seconds", "Time a stage task waited between creation and start", ["role"])
+STAGE_RUN_SECONDS = Histogram("mapcoder_stage_run_seconds", "Stage task execution time", ["role", "status"])
+
+# --- LLM calls (upstream requests only; cache hits and single-flight followers are excluded) --
+LLM_LATENCY_SECONDS = Histogram("llm_request_seconds", "LLM request latency", ["role", "model"])
+LLM_TTFT_SECONDS = Histogram("llm_time_to_first_token_seconds", "LLM time to first token", ["role", "model"])
+LLM_TOKENS = Histogram("llm_tokens", "Tokens per LLM request", ["role", "kind"], buckets=TOKEN_BUCKETS)
+LLM_REQUESTS = Counter("llm_requests_total", "LLM calls by outcome", ["role", "outcome"])
+
+# --- infrastructure ---------------------------------------------------------------------------
+DB_QUERIES = Histogram("db_queries", "SQL statements per HTTP request / coordinator run", ["scope"],
+                       buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000))
+DB_COMMIT_SECONDS = Histogram("db_commit_seconds", "SQLAlchemy session commit time (flush included)", buckets=FAST_BUCKETS)
+EVENT_PUBLISH_SECONDS = Histogram("event_publish_seconds", "Session event publish latency", buckets=FAST_BUCKETS)
+EVENT_TRUNCATED = Counter("event_truncated_total", "Session events cut down to EVENT_MAX_BYTES", ["type"])
+EVENT_BATCH_SIZE = Histogram("event_publish_batch_size", "Events per pipelined publish batch",
+                             buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+EVENT_LOOP_LAG_SECONDS = Histogram("event_loop_lag_seconds", "Event loop scheduling delay", ["loop"], buckets=FAST_BUCKETS)
+EVENT_LOOP_STALLS = Counter("event_loop_stalls_total", "Event loop blocked past LOOP_LAG_THRESHOLD", ["loop"])
+MCP_SPAWN_SECONDS = Histogram("mcp_spawn_seconds", "MCP stdio server spawn + initialize time", ["command"])
+MCP_CALL_SECONDS = Histogram("mcp_call_seconds", "MCP tool call latency", ["tool"])
@@ -1,8 +1,9 @@
 from datetime import datetime, timezone
 
-from core.dependencies import Base
+from core.dependencies import Base, logger
 from sqlalchemy import Column, Integer, String, Boolean, JSON
-from sqlalchemy import Text, DateTime, ForeignKey, Float
+from sqlalchemy import Text, DateTime, ForeignKey, Float, Index
+from sqlalchemy import inspect, text
 
 
 # 用户表
@@ -55,6 +56,10 @@ class AgentTask(Base):
     confidence = Column(Float, nullable=True)
     attempt_count = Column(Integer, default=0, nullable=False)
     max_attempts = Column(Integer, default=3, nullable=False)
+    # 分布式租约：持有者、过期时间（UTC）与最近心跳
+    lease_owner = Column(String(120), nullable=True, index=True)
+    lease_expires_at = Column(DateTime, nullable=True, index=True)
+    heartbeat_at = Column(DateTime, nullable=True)
     result = Column(JSON)
     created_at = Column(DateTime, default=datetime.now(timezone.utc))
     updated_at = Column(DateTime, default=datetime.now(timezone.utc))
@@ -70,3 +75,53 @@ class AgentTaskLog(Base):
     message = Column(Text, nullable=False)
     payload = Column(JSON)
     created_at = Column(DateTime, default=datetime.now(timezone.utc))
+
+
+# 会话消息：只追加不改写，按 (session_id, id) 键集分页
+class AgentMessage(Base):
+    __tablename__ = 'agent_messages'
+    __table_args__ = (Index('ix_agent_messages_session_id_id', 'session_id', 'id'),)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    session_id = Column(Integer, ForeignKey('agent_sessions.id'), nullable=False)
+    role = Column(String(20), nullable=False)
+    content = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
+
+# create_all 只建缺失的表，不会给已有的表补列：这些列在表建好之后才加入模型，启动时按需补上
+_ADDED_COLUMNS = {
+    AgentTask.__table__: ("lease_owner", "lease_expires_at", "heartbeat_at"),
+}
+
+
+def ensure_columns(bind) -> None:
+    """Add the columns in _ADDED_COLUMNS (and their indexes) to tables created before them.
+
+    Idempotent; run after `Base.metadata.create_all` on every start.
+    """
+    inspector = inspect(bind)
+    for table, names in _ADDED_COLUMNS.items():
+        if not inspector.has_table(table.name):
+            continue
+        existing = {c["name"] for c in inspector.get_columns(table.name)}
+        for name in names:
+            if name in existing:
+                continue
+            column = table.c[name]
+            ddl = f"ALTER TABLE {table.name} ADD COLUMN {name} {column.type.compile(dialect=bind.dialect)}"
+            try:
+                with bind.begin() as conn:
+                    conn.execute(text(ddl))
+                logger.info(f"数据库表 {table.name} 已补充列 {name}")
+            except Exception as e:
+                # 多个进程同时启动时可能已被其他进程补上
+                logger.warning(f"补充列 {table.name}.{name} 失败: {e}")
+        indexes = {i["name"] for i in inspect(bind).get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in indexes or not {c.name for c in index.columns} <= set(names):
+                continue
+            try:
+                index.create(bind)
+                logger.info(f"数据库表 {table.name} 已补充索引 {index.name}")
+            except Exception as e:
+                logger.warning(f"补充索引 {index.name} 失败: {e}")
@@ -1,3 +1,4 @@
+import os
 from datetime import timedelta, datetime, timezone
 
 import jwt
@@ -7,6 +8,9 @@ from fastapi import Depends, HTTPException, status
 from jose import JWTError
 from sqlalchemy.orm import Session
 
+# 逗号分隔的管理员用户名，如 ADMIN_USERS=alice,bob；为空时管理接口一律拒绝访问
+ADMIN_USERS = {u.strip() for u in os.environ.get("ADMIN_USERS", "").split(",") if u.strip()}
+
 
 async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
     credentials_exception = HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="无法认证访问令牌",
@@ -30,3 +34,9 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = De
     if user is None:
         raise credentials_exception
     return {"user": user, "id": user.id}
+
+
+async def get_admin_user(current=Depends(get_current_user)):
+    if current["user"].username not in ADMIN_USERS:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="需要管理员权限")
+    return current
@@ -0,0 +1,173 @@
+"""Request-scoped SQL statement counting and N+1 detection.
+
+Engine-level cursor hooks count every statement and its time against the QueryStats active in
+the current context. HTTP requests are tracked by QueryCountMiddleware (see main.py) and
+coordinator runs by CoordinatorService.run_session; both log when a scope goes over its budget.
+Sync endpoints run in a worker thread with a copy of the request context, so their statements
+land in the same QueryStats.
+
+The same parametrized statement executed many times in one scope is the N+1 signature (a query
+inside a loop); those are reported with their repeat count.
+
+    with assert_max_queries(3):
+        _session_to_detail(session, db)
+"""
+from __future__ import annotations
+
+import contextvars
+import os
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from core.dependencies import logger
+from core.metrics import DB_QUERIES
+
+# statements per HTTP request / per coordinator run before it is flagged; 0 disables the check
+QUERY_BUDGET_REQUEST = int(os.environ.get("QUERY_BUDGET_REQUEST", "30"))
+QUERY_BUDGET_SESSION = int(os.environ.get("QUERY_BUDGET_SESSION", "400"))
+# one statement repeated this often within a scope is reported as a likely N+1
+QUERY_REPEAT_THRESHOLD = int(os.environ.get("QUERY_REPEAT_THRESHOLD", "10"))
+
+
+class QueryStats:
+    def __init__(self, label: str = "", budget: int = 0, parent: Optional["QueryStats"] = None):
+        self.label = label
+        self.budget = budget
+        # enclosing scope: nested scopes (a coordinator run inside assert_max_queries) count into it too
+        self.parent = parent
+        self.count = 0
+        self.db_time = 0.0
+        self.statements: Counter = Counter()
+        self.started = time.perf_counter()
+
+    def record(self, statement: str, elapsed: float) -> None:
+        self.count += 1
+        self.db_time += elapsed
+        self.statements[statement] += 1
+        if self.parent is not None:
+            self.parent.record(statement, elapsed)
+
+    @property
+    def over_budget(self) -> bool:
+        return self.budget > 0 and self.count > self.budget
+
+    def repeated(self, threshold: Optional[int] = None) -> List[Tuple[str, int]]:
+        """Statements executed at least `threshold` times (most repeated first)."""
+        threshold = QUERY_REPEAT_THRESHOLD if threshold is None else threshold
+        return [(sql, n) for sql, n in self.statements.most_common() if n >= threshold]
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "queries": self.count,
+            "db_time_ms": round(self.db_time * 1000, 2),
+            "elapsed_ms": round((time.perf_counter() - self.started) * 1000, 2),
+            "budget": self.budget,
+            "repeated": [{"sql": _short(sql), "count": n} for sql, n in self.repeated()],
+        }
+
+    def problems(self) -> Optional[str]:
+        """Human-readable description when over budget or N+1 suspects exist, else None."""
+        parts = []
+        if self.over_budget:
+            parts.append(f"{self.count} 条 SQL 超出预算 {self.budget}")
+        for sql, n in self.repeated():
+            parts.append(f"疑似 N+1（重复 {n} 次）: {_short(sql)}")
+        return "; ".join(parts) or None
+
+
+_current: contextvars.ContextVar[Optional[QueryStats]] = contextvars.ContextVar("query_stats", default=None)
+
+
+def _short(sql: str, limit: int = 160) -> str:
+    sql = " ".join(sql.split())
+    return sql if len(sql) <= limit else sql[:limit] + "..."
+
+
+def current_query_stats() -> Optional[QueryStats]:
+    return _current.get()
+
+
+@contextmanager
+def track_queries(label: str = "", budget: int = 0) -> Iterator[QueryStats]:
+    """Count statements issued in this context (and tasks/threads spawned from it) into a new QueryStats.
+
+    An enclosing scope keeps counting them as well.
+    """
+    stats = QueryStats(label, budget, parent=_current.get())
+    token = _current.set(stats)
+    try:
+        yield stats
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def assert_max_queries(limit: int, label: str = "") -> Iterator[QueryStats]:
+    """Test helper: fail with the statement breakdown if the block issues more than `limit` statements."""
+    with track_queries(label) as stats:
+        yield stats
+    if stats.count > limit:
+        lines = "\n".join(f"  {n}x {_short(sql)}" for sql, n in stats.statements.most_common())
+        raise AssertionError(f"{label or 'block'} 执行了 {stats.count} 条 SQL，上限 {limit}:\n{lines}")
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        conn.info.setdefault("_query_started", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current.get()
+    started = conn.info.get("_query_started")
+    if stats is None or not started:
+        return
+    stats.record(statement, time.perf_counter() - started.pop())
+
+
+class QueryCountMiddleware:
+    """ASGI middleware: per-request statement count and DB time.
+
+    Adds X-DB-Queries / X-DB-Time-Ms response headers (X-DB-Query-Budget: exceeded when over
+    QUERY_BUDGET_REQUEST) and logs requests that are over budget or show N+1 patterns. Headers
+    of streaming responses reflect the statements issued before the first byte.
+    """
+
+    def __init__(self, app, budget: int = QUERY_BUDGET_REQUEST):
+        self.app = app
+        self.budget = budget
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        label = f"{scope.get('method', '')} {scope.get('path', '')}"
+        with track_queries(label, self.budget) as stats:
+            async def send_with_headers(message):
+                if message["type"] == "http.response.start":
+                    headers = list(message.get("headers") or [])
+                    headers.append((b"x-db-queries", str(stats.count).encode()))
+                    headers.append((b"x-db-time-ms", f"{stats.db_time * 1000:.1f}".encode()))
+                    if stats.over_budget:
+                        headers.append((b"x-db-query-budget", b"exceeded"))
+                    message = {**message, "headers": headers}
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_with_headers)
+            finally:
+                report(stats, "request")
+
+
+def report(stats: QueryStats, scope: str) -> None:
+    """Log a scope that went over budget or repeated a statement; record its size in /metrics."""
+    DB_QUERIES.observe(stats.count, scope=scope)
+    problem = stats.problems()
+    if problem:
+        logger.warning(f"[SQL] {stats.label}: {problem} (DB 耗时 {stats.db_time * 1000:.1f}ms)")
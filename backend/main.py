@@ -1,35 +1,78 @@
+import asyncio
 import sys
 from datetime import datetime
 from pathlib import Path
 
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
 from starlette.middleware.cors import CORSMiddleware
 from starlette.staticfiles import StaticFiles
 
 from core.dependencies import engine
-from core.models import Base
-from routers import auth, user, agent, mapcoder, mcp
+from core.event_bus import get_event_bus
+from core.event_hub import close_event_hub, get_event_hub
+from core.loop_monitor import get_loop_monitor
+from core.mapcoder.provider import aclose_async_client
+from core.mapcoder.session_queue import start_embedded_workers, stop_embedded_workers
+from core.metrics import render_metrics
+from core.query_stats import QueryCountMiddleware
+from core.models import Base, ensure_columns
+from routers import auth, user, agent, mapcoder, mcp, admin
 
 sys.path.append(str(Path(__file__).parent.parent))
 
-# 创建数据库表
+# 创建数据库表，并给早先建好的表补上后来新增的列
 Base.metadata.create_all(bind=engine)
+ensure_columns(engine)
 
 app = FastAPI(title="Multi-Agent", description="多智能体协作任务系统", version="1.0.0", )
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"],
-                   allow_headers=["*"], )
+                   allow_headers=["*"], expose_headers=["X-DB-Queries", "X-DB-Time-Ms", "X-DB-Query-Budget"], )
+app.add_middleware(QueryCountMiddleware)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 
+@app.on_event("startup")
+def start_session_workers():
+    start_embedded_workers()
+
+
+@app.on_event("startup")
+async def start_loop_monitor():
+    get_loop_monitor("api").start()
+
+
+@app.on_event("startup")
+async def start_event_hub():
+    # 选择事件总线（auto 模式会 ping Redis，放到线程里），每个 worker 进程一个订阅，SSE 客户端共享
+    await asyncio.to_thread(get_event_bus)
+    get_event_hub().start()
+
+
+@app.on_event("shutdown")
+async def stop_session_workers():
+    get_loop_monitor("api").stop()
+    stop_embedded_workers()
+    await aclose_async_client()
+    await close_event_hub()
+
+
 @app.get("/")
 async def health_check():
     return {"status": "running", "timestamp": datetime.now(), "service": "多智能体协作任务系统"}
 
 
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+def metrics():
+    # Prometheus 文本格式；每个 worker 进程各自计数
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
 app.include_router(auth.router)
 app.include_router(user.router)
 app.include_router(agent.router)
 app.include_router(mapcoder.router)
 
 app.include_router(mcp.router)
+app.include_router(admin.router)
 
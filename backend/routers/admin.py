@@ -0,0 +1,20 @@
+from fastapi import APIRouter, Depends
+
+from core.event_hub import get_event_hub
+from core.loop_monitor import loop_lag_stats
+from core.permission import get_admin_user
+
+router = APIRouter(prefix="/admin", tags=["运维"])
+
+
+@router.get("/loop-lag")
+async def get_loop_lag(stacks: bool = True, current=Depends(get_admin_user)):
+    """Event-loop scheduling delay per loop (API loop, session worker loops) and the most recent
+    stalls with the stack of the call that blocked the loop."""
+    return loop_lag_stats(stacks)
+
+
+@router.get("/event-hub")
+async def get_event_hub_stats(current=Depends(get_admin_user)):
+    """SSE fan-out of this worker process: subscription state, open streams, dropped slow clients."""
+    return get_event_hub().stats()
@@ -1,12 +1,21 @@
+import asyncio
+import json
 import os
 from datetime import datetime, timezone
 from pathlib import Path
-from typing import Dict, Optional, Any
-
-import requests
-from core.dependencies import get_db, logger
+from typing import Callable, Dict, Optional, Set, Tuple
+
+from core.chat_context import CHAT_CONTEXT_TOKENS, ChatContext, build_context, schedule_summary
+from core.dependencies import SessionLocal, get_db, logger
+from core.mapcoder.llm_cache import get_llm_cache
+from core.mapcoder.provider import LLM_BACKEND, acomplete, get_backend, provider_status
+from core.mapcoder.rate_limit import rate_limit_stats
+from core.mapcoder.resilience import endpoint_stats
+from core.mapcoder.singleflight import get_single_flight
+from core.messages import append_messages, delete_messages, migrate_legacy_messages, page_messages
 from core.permission import get_current_user
-from fastapi import APIRouter, Depends, Body, HTTPException
+from fastapi import APIRouter, Depends, Body, HTTPException, Request
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
 
 from core.models import AgentSession
@@ -31,6 +40,9 @@ else:
     load_dotenv()
 # default session title prefix
 DEFAULT_TITLE_PREFIX = '任务 '
+FALLBACK_ANSWER = "抱歉，模型服务未配置或调用失败，无法生成答案。"
+# chat turns still running after their client disconnected (kept referenced until persisted)
+_DETACHED_TURNS: Set[asyncio.Task] = set()
 
 def _env_any(*names):
     for n in names:
@@ -119,6 +131,7 @@ async def get_session_summary(session_id: Optional[int] = None, db: Session = De
             'updated_at': sess.updated_at,
             'metadata': sess.metadata_,
             'final_result': sess.final_result,
+            'messages': page_messages(db, sess.id)['messages'],
         }
     sessions = db.query(AgentSession).filter_by(user_id=user.id).order_by(AgentSession.id.desc()).all()
     return {
@@ -136,273 +149,95 @@ async def get_session_summary(session_id: Optional[int] = None, db: Session = De
     }
 
 
-# OpenAI call helper
-try:
-    from openai import OpenAI
-except Exception:
-    OpenAI = None
+def _is_provider_available(temp_key: Optional[str] = None) -> bool:
+    if OPENAI_API_KEY:
+        return True
+    if LLM_BACKEND not in ('auto', 'openai') and not get_backend().requires_key:
+        # explicitly selected keyless backend (local server, mock for load tests)
+        return True
+    if DEBUG_ALLOW_TEMP_KEY and temp_key:
+        return True
+    return False
 
 
-def _call_openai(prompt: str, model_id: str, max_tokens: int = 1024, temperature: float = 0.2,
-                 api_key: Optional[str] = None) -> str:
-    """Call OpenAI-compatible chat completions endpoint and return assistant text.
-    Uses api_key override if provided (and DEBUG_ALLOW_TEMP_KEY is true).
-    Tries SDK first, falls back to HTTP and supports several provider response shapes.
-    """
-    use_key = api_key or OPENAI_API_KEY
-    if not use_key:
-        logger.warning(f"OpenAI API key not configured. OPENAI_API_KEY set? {bool(OPENAI_API_KEY)}")
-        return ""
-
-    def _extract_from_data(data):
-        # robust extraction from various provider response shapes
-        try:
-            if not data:
-                return ''
-            if isinstance(data, dict):
-                # try common OpenAI format first
-                choices = data.get('choices') or []
-                if choices and isinstance(choices, list):
-                    first = choices[0]
-                    # if first is simple string
-                    if isinstance(first, str) and first.strip():
-                        return first
-                    if isinstance(first, dict):
-                        # 1) choices[].message.content may be string
-                        msg = first.get('message')
-                        if isinstance(msg, dict):
-                            cont = msg.get('content') or msg.get('contentText') or msg.get('text')
-                            # content might be string
-                            if isinstance(cont, str) and cont.strip():
-                                return cont
-                            # content might be a list of chunks/parts
-                            if isinstance(cont, list) and cont:
-                                # common: [{'type': 'output_text', 'text': '...'}]
-                                parts_texts = []
-                                for p in cont:
-                                    if isinstance(p, str):
-                                        parts_texts.append(p)
-                                    elif isinstance(p, dict):
-                                        # try standard keys
-                                        if 'text' in p and isinstance(p['text'], str):
-                                            parts_texts.append(p['text'])
-                                        elif 'content' in p and isinstance(p['content'], str):
-                                            parts_texts.append(p['content'])
-                                if parts_texts:
-                                    return ''.join(parts_texts)
-                            # sometimes content is dict with 'parts'
-                            if isinstance(cont, dict):
-                                parts = cont.get('parts') or cont.get('items')
-                                if isinstance(parts, list) and parts:
-                                    return ''.join([x for x in parts if isinstance(x, str)])
-                        # 2) choices[].delta or choices[].text
-                        # delta often used in streaming and may carry a 'content' or 'message' key
-                        delta = first.get('delta') if isinstance(first, dict) else None
-                        if isinstance(delta, dict):
-                            # delta.message or delta.content
-                            dmsg = delta.get('message') or delta.get('content')
-                            if isinstance(dmsg, str) and dmsg.strip():
-                                return dmsg
-                            if isinstance(dmsg, dict):
-                                # try parts etc
-                                dcont = dmsg.get('content') or dmsg.get('parts')
-                                if isinstance(dcont, str) and dcont.strip():
-                                    return dcont
-                                if isinstance(dcont, list) and dcont:
-                                    return ''.join([x for x in dcont if isinstance(x, str)])
-                        # 3) choices[].text (legacy completion API)
-                        if 'text' in first and isinstance(first['text'], str) and first['text'].strip():
-                            return first['text']
-                        # 4) choices[].content
-                        if 'content' in first:
-                            c = first['content']
-                            if isinstance(c, str) and c.strip():
-                                return c
-                            if isinstance(c, list) and c:
-                                return ''.join([x for x in c if isinstance(x, str)])
-                            if isinstance(c, dict):
-                                parts = c.get('parts') or c.get('items')
-                                if isinstance(parts, list) and parts:
-                                    return ''.join([x for x in parts if isinstance(x, str)])
-                # providers may return top-level fields
-                for key in ('output', 'result', 'answer', 'response', 'text'):
-                    v = data.get(key)
-                    if isinstance(v, str) and v.strip():
-                        return v
-                    if isinstance(v, dict):
-                        # try nested keys
-                        for subk in ('content', 'text', 'parts'):
-                            sv = v.get(subk)
-                            if isinstance(sv, str) and sv.strip():
-                                return sv
-                            if isinstance(sv, list) and sv:
-                                return ''.join([x for x in sv if isinstance(x, str)])
-                # some providers embed messages in data['messages'] as a list
-                msgs = data.get('messages') or data.get('message')
-                if isinstance(msgs, list) and msgs:
-                    firstm = msgs[0]
-                    if isinstance(firstm, dict):
-                        for subk in ('content', 'text'):
-                            if subk in firstm and isinstance(firstm[subk], str) and firstm[subk].strip():
-                                return firstm[subk]
-                            if subk in firstm and isinstance(firstm[subk], list) and firstm[subk]:
-                                return ''.join([x for x in firstm[subk] if isinstance(x, str)])
-            # fallback: if it's a plain string
-            if isinstance(data, str) and data.strip():
-                return data
-            if isinstance(data, list) and data:
-                return ''.join([x for x in data if isinstance(x, str)])
-        except Exception as e:
-            logger.warning(f"_extract_from_data error: {e}")
-        return ''
-
-    # prefer official SDK if available
-    if OpenAI is not None:
+def _open_turn(db: Session, user, session_id_input, title: Optional[str], text_input: str, model_id: str,
+               context_tokens: int, context_size: Optional[int]) -> Tuple[int, ChatContext]:
+    """Resolve the target session and build the token-budgeted prompt (runs in a worker thread)."""
+    if session_id_input is not None:
         try:
-            client = OpenAI(api_key=use_key, base_url=OPENAI_BASE_URL) if OPENAI_BASE_URL else OpenAI(api_key=use_key)
-            try:
-                resp = client.chat.completions.create(
-                    model=model_id,
-                    messages=[{"role": "user", "content": prompt}],
-                    max_tokens=max_tokens,
-                    temperature=temperature,
-                    stream=False,
-                )
-            except Exception as sdk_call_exc:
-                # some providers or SDK versions may expose a different method; try responses.create as fallback
-                logger.info(f"chat.completions.create failed: {sdk_call_exc}; trying responses.create")
-                try:
-                    resp = client.responses.create(
-                        model=model_id,
-                        input=prompt,
-                        max_tokens=max_tokens,
-                        temperature=temperature,
-                    )
-                except Exception as sdk_alt_exc:
-                    logger.warning(f"OpenAI SDK alternate call failed: {sdk_alt_exc}")
-                    resp = None
-
-            if resp is not None:
-                # attempt to normalize resp to dict-like for extraction
-                data = None
-                try:
-                    # SDK objects sometimes allow .to_dict() or behave like dict
-                    if hasattr(resp, 'to_dict'):
-                        data = resp.to_dict()
-                    elif isinstance(resp, dict):
-                        data = resp
-                    else:
-                        # try serializing
-                        import json as _json
-                        try:
-                            data = _json.loads(getattr(resp, 'text', '') or str(resp))
-                        except Exception:
-                            # as last resort, inspect repr
-                            data = None
-                except Exception:
-                    data = None
-
-                # if we have data, try extract
-                if data:
-                    extracted = _extract_from_data(data)
-                    if extracted:
-                        return extracted
-                    # if not extracted, log for debugging
-                    logger.info(f"OpenAI SDK returned data but extraction failed; data keys: {list(data.keys())}")
-                else:
-                    # resp might be simple; try to inspect attributes
-                    try:
-                        # try typical SDK attribute path
-                        choices = getattr(resp, 'choices', None)
-                        if choices and isinstance(choices, (list, tuple)):
-                            first = choices[0]
-                            # attempt to read message content
-                            content = None
-                            if hasattr(first, 'message'):
-                                msg = getattr(first, 'message')
-                                if isinstance(msg, dict):
-                                    content = msg.get('content')
-                                elif hasattr(msg, 'get'):
-                                    content = msg.get('content')
-                            if not content and hasattr(first, 'text'):
-                                content = getattr(first, 'text')
-                            if isinstance(content, str) and content.strip():
-                                return content
-                    except Exception:
-                        pass
-                    # as final fallback, try str(resp)
-                    resp_text = str(resp)
-                    if resp_text and resp_text.strip():
-                        return resp_text
-            # if SDK route didn't return usable text, continue to HTTP fallback below
-        except Exception as e:
-            logger.warning(f"OpenAI SDK request failed entirely: {e}")
-
-    # fallback to raw HTTP (compatible with OpenAI-style endpoints)
-    url = (OPENAI_BASE_URL.rstrip('/') if OPENAI_BASE_URL else 'https://api.openai.com') + '/v1/chat/completions'
-    headers = {'Authorization': f'Bearer {use_key}', 'Content-Type': 'application/json'}
-    payload = {'model': model_id, 'messages': [{'role': 'user', 'content': prompt}], 'max_tokens': max_tokens,
-               'temperature': temperature, 'stream': False}
-    try:
-        resp = requests.post(url, json=payload, headers=headers, timeout=30)
-    except Exception as e:
-        logger.warning(f"OpenAI HTTP request failed: {e}")
-        return ""
-
-    # log status and body for debugging when things look wrong
-    status = getattr(resp, 'status_code', None)
-    body_text = None
-    try:
-        body_text = resp.text
-    except Exception:
-        body_text = None
-    logger.info(f"OpenAI HTTP call status={status}")
+            sid = int(str(session_id_input))
+        except ValueError:
+            raise HTTPException(status_code=400, detail='session_id 必须是整数')
+        session = db.query(AgentSession).filter_by(id=sid, user_id=user.id).first()
+        if not session:
+            raise HTTPException(status_code=404, detail='任务会话不存在')
+    else:
+        session = _get_or_create_latest_session(db, user)
+        if title:
+            session.title = title
+            db.commit()
+
+    if migrate_legacy_messages(db, session):
+        db.commit()
 
-    if status != 200:
-        logger.warning(f"OpenAI call failed status={status}, body={body_text}")
-        return ""
+    ctx = build_context(db, session, text_input, model_id, budget=context_tokens, max_messages=context_size)
+    return session.id, ctx
 
+
+def _save_turn(session_id: int, user_text: str, asked_at: datetime, assistant_text: str) -> None:
+    """Append both sides of a finished turn in one commit (own DB session: the request's one may be
+    closed by the time a streamed reply completes)."""
+    db = SessionLocal()
     try:
-        data = resp.json()
-    except Exception:
-        # not JSON, but maybe text contains the answer
-        if body_text:
-            logger.info("OpenAI response not JSON, returning raw text")
-            return body_text
-        return ""
-
-    # Try robust extraction from JSON data
-    extracted = _extract_from_data(data)
-    if extracted:
-        return extracted
-
-    # if nothing extracted, log a concise debug snapshot and return raw text as last resort
-    try:
-        # log top-level keys and a short preview of the body (no secrets)
-        keys = list(data.keys()) if isinstance(data, dict) else None
-        preview = None
-        try:
-            import json as _json
-            preview = _json.dumps({k: data.get(k) for k in (keys or [])[:3]}, ensure_ascii=False)[:1000]
-        except Exception:
-            preview = str(data)[:1000]
-        logger.warning(f"OpenAI returned JSON but couldn't extract assistant text. top_keys={keys}; preview={preview}")
+        session = db.query(AgentSession).filter_by(id=session_id).first()
+        if not session:
+            return
+        append_messages(db, session_id, [('user', user_text, asked_at), ('assistant', assistant_text, None)])
+        session.updated_at = datetime.now(timezone.utc)
+        db.commit()
     except Exception:
-        logger.warning("OpenAI returned JSON but couldn't extract assistant text and couldn't stringify it")
-    return body_text or ''
+        db.rollback()
+        logger.exception(f"保存对话记录失败 session={session_id}")
+    finally:
+        db.close()
+
+
+async def _run_turn(session_id: int, ctx: ChatContext, text_input: str, asked_at: datetime, model_id: str,
+                    api_key: Optional[str], on_token: Optional[Callable[[str], None]] = None) -> str:
+    """One chat turn on the loop: await the completion (streamed into `on_token` when given), then
+    persist the transcript off the loop and fold old turns into the summary in the background."""
+    prompt = ctx.prompt
+    resp = await acomplete(prompt, model_id, api_key=api_key, on_token=on_token, role="chat")
+    assistant_text = resp.text or FALLBACK_ANSWER
+    if not resp.text and on_token is not None:
+        on_token(assistant_text)
+    await asyncio.to_thread(_save_turn, session_id, text_input, asked_at, assistant_text)
+    schedule_summary(session_id, ctx, model_id, api_key)
+    logger.info(f"提示词({ctx.prompt_tokens} tokens, {ctx.messages} 条消息): {prompt}")
+    logger.info(f"回答: {assistant_text}")
+    return assistant_text
 
 
-def _is_provider_available(temp_key: Optional[str] = None) -> bool:
-    if OPENAI_API_KEY:
-        return True
-    if DEBUG_ALLOW_TEMP_KEY and temp_key:
-        return True
-    return False
+def _stream_mode(body: Dict[str, object], request: Request) -> Optional[str]:
+    stream = body.get('stream')
+    if stream in ('text', 'chunked'):
+        return 'text'
+    if stream is True or stream in ('sse', 'true', '1') or 'text/event-stream' in request.headers.get('accept', ''):
+        return 'sse'
+    return None
 
 
 @router.post('')
-async def post_message(body: Dict[str, object] = Body(...), db: Session = Depends(get_db),
-                       current_user: dict = Depends(get_current_user)) -> dict[str, bool | Any] | str:
+async def post_message(request: Request, body: Dict[str, object] = Body(...), db: Session = Depends(get_db),
+                       current_user: dict = Depends(get_current_user)):
+    """Send a chat message and get the assistant's answer.
+
+    By default the full answer is returned as a JSON string. With `"stream": true` (or
+    `Accept: text/event-stream`) the answer is streamed as SSE: `data: {"type": "delta", "delta": ...}`
+    per chunk, then `data: {"type": "done", "session_id": ..., "text": ...}`. With `"stream": "text"`
+    the raw answer text is sent with chunked transfer encoding. The transcript is saved once the
+    answer is complete, even if the client disconnected mid-stream.
+    """
     user = current_user.get('user') if isinstance(current_user, dict) else None
     if not user:
         raise HTTPException(status_code=401, detail='未认证的用户')
@@ -412,63 +247,88 @@ async def post_message(body: Dict[str, object] = Body(...), db: Session = Depend
     text_input = body.get('text')
     if not text_input:
         raise HTTPException(status_code=400, detail='text 字段不能为空')
+    text_input = str(text_input)
 
-    context_size = int(body.get('context_size', 12) or 12)
+    # context_tokens caps the prompt; context_size optionally also caps the number of messages
+    context_tokens = int(body.get('context_tokens') or CHAT_CONTEXT_TOKENS)
+    context_size = int(body['context_size']) if body.get('context_size') else None
     model_id = str(body.get('model_id') or DEFAULT_MODEL)
     temp_openai_key = body.get('temp_openai_key') if isinstance(body.get('temp_openai_key'), str) else None
+    api_key = str(temp_openai_key) if temp_openai_key and DEBUG_ALLOW_TEMP_KEY else None
 
     # availability check
     if not _is_provider_available(temp_openai_key):
         logger.warning(f"No OpenAI provider configured (requested model: {model_id})")
         raise HTTPException(status_code=503, detail='模型服务未配置或不可用，请检查后端环境变量（OPENAI_API_KEY）')
 
-    # choose/create session container
-    session_id_input = body.get('session_id')
-    title = _normalize_title_input(body.get('title'))
-
-    if session_id_input is not None:
-        try:
-            sid = int(str(session_id_input))
-            session = db.query(AgentSession).filter_by(id=sid, user_id=user.id).first()
-            if not session:
-                raise HTTPException(status_code=404, detail='任务会话不存在')
-        except ValueError:
-            raise HTTPException(status_code=400, detail='session_id 必须是整数')
-    else:
-        session = _get_or_create_latest_session(db, user)
-        if title:
-            session.title = title
-            db.commit()
-
-    # save user message
-    history = session.metadata_ or {}
-    transcripts = history.get('messages', [])
-    transcripts.append({'role': 'user', 'content': str(text_input), 'created_at': datetime.now(timezone.utc).isoformat()})
-    history['messages'] = transcripts[-context_size:]
-    session.metadata_ = history
-    db.commit()
-
-    context = "\n".join([f"{m['role']}: {m['content']}" for m in history.get('messages', [])])
-    prompt = f"\n用户问题: {text_input}\n\n对话上下文:\n{context}\n\n请基于上述对话内容直接回答用户的问题。"
+    asked_at = datetime.now(timezone.utc)
+    session_id, ctx = await asyncio.to_thread(
+        _open_turn, db, user, body.get('session_id'), _normalize_title_input(body.get('title')), text_input, model_id,
+        context_tokens, context_size,
+    )
 
-    # call OpenAI (use temp key if provided and allowed)
-    if temp_openai_key and DEBUG_ALLOW_TEMP_KEY:
-        assistant_text = _call_openai(prompt, model_id, api_key=str(temp_openai_key))
-    else:
-        assistant_text = _call_openai(prompt, model_id)
+    mode = _stream_mode(body, request)
+    if mode is None:
+        return await _run_turn(session_id, ctx, text_input, asked_at, model_id, api_key)
 
-    assistant_text = assistant_text or "抱歉，模型服务未配置或调用失败，无法生成答案。"
+    queue: asyncio.Queue = asyncio.Queue()
+    turn = asyncio.ensure_future(
+        _run_turn(session_id, ctx, text_input, asked_at, model_id, api_key, on_token=queue.put_nowait)
+    )
+    turn.add_done_callback(lambda _t: queue.put_nowait(None))
 
-    transcripts = history.get('messages', [])
-    transcripts.append({'role': 'assistant', 'content': assistant_text, 'created_at': datetime.now(timezone.utc).isoformat()})
-    history['messages'] = transcripts[-context_size:]
-    session.metadata_ = history
-    session.updated_at = datetime.now(timezone.utc)
-    db.commit()
+    async def deltas():
+        while True:
+            delta = await queue.get()
+            if delta is None:
+                return
+            yield delta
 
-    logger.info(f"提示词: {prompt}")
-    logger.info(f"回答: {assistant_text}")
-    return assistant_text
+    async def sse_stream():
+        try:
+            async for delta in deltas():
+                yield f"data: {json.dumps({'type': 'delta', 'delta': delta}, ensure_ascii=False)}\n\n"
+            text = turn.result() if not turn.cancelled() and turn.exception() is None else FALLBACK_ANSWER
+            yield f"data: {json.dumps({'type': 'done', 'session_id': session_id, 'text': text}, ensure_ascii=False)}\n\n"
+        finally:
+            _detach(turn)
+
+    async def text_stream():
+        try:
+            async for delta in deltas():
+                yield delta
+        finally:
+            _detach(turn)
+
+    if mode == 'text':
+        return StreamingResponse(text_stream(), media_type='text/plain; charset=utf-8',
+                                 headers={'X-Session-Id': str(session_id)})
+    return StreamingResponse(sse_stream(), media_type='text/event-stream',
+                             headers={'X-Session-Id': str(session_id), 'Cache-Control': 'no-cache'})
+
+
+def _detach(turn: asyncio.Task) -> None:
+    # a client that went away does not cancel the turn: it finishes and is persisted in the background
+    if not turn.done():
+        _DETACHED_TURNS.add(turn)
+        turn.add_done_callback(_DETACHED_TURNS.discard)
+
+
+@router.get('/messages')
+async def get_messages(session_id: int, before_id: Optional[int] = None, after_id: Optional[int] = None,
+                       limit: int = 50, db: Session = Depends(get_db),
+                       current_user: dict = Depends(get_current_user)) -> Dict:
+    """Keyset-paginated transcript: newest page by default, `before_id` for older messages,
+    `after_id` for messages added since."""
+    user = current_user.get('user') if isinstance(current_user, dict) else None
+    if not user:
+        raise HTTPException(status_code=401, detail='未认证的用户')
+    sess = db.query(AgentSession).filter_by(id=int(session_id), user_id=user.id).first()
+    if not sess:
+        raise HTTPException(status_code=404, detail='任务会话不存在')
+    if migrate_legacy_messages(db, sess):
+        db.commit()
+    return {'session_id': sess.id, **page_messages(db, sess.id, before_id=before_id, after_id=after_id, limit=limit)}
 
 
 @router.delete('')
@@ -488,6 +348,7 @@ async def clear_session(session_id: Optional[int] = None, db: Session = Depends(
     if not session:
         return {'status': 'success', 'deleted': 0, 'message': '无任务会话'}
     try:
+        delete_messages(db, session.id)
         db.delete(session)
         db.commit()
         return {'status': 'success', 'session_id': session.id}
@@ -501,4 +362,6 @@ async def agent_status() -> Dict:
     return {
         'openai': {'configured': bool(OPENAI_API_KEY), 'base_url': OPENAI_BASE_URL or None,
             'masked_key': _mask(OPENAI_API_KEY)}, 'debug_allow_temp_key': DEBUG_ALLOW_TEMP_KEY,
-        'default_model': DEFAULT_MODEL}
+        'default_model': DEFAULT_MODEL, 'provider': provider_status(), 'llm_cache': get_llm_cache().stats(),
+        'llm_inflight': get_single_flight().stats(), 'llm_rate_limits': rate_limit_stats(),
+        'llm_endpoints': endpoint_stats()}
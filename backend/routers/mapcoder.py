@@ -3,14 +3,20 @@ from __future__ import annotations
 from datetime import datetime, timezone
 from typing import Dict, Optional, List
 
-from fastapi import APIRouter, Body, Depends, HTTPException, BackgroundTasks, Request
-from fastapi.responses import StreamingResponse
+from fastapi import APIRouter, Body, Depends, HTTPException, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
 import asyncio
 from sqlalchemy.orm import Session
 
-from core.dependencies import get_db, SessionLocal, get_redis, SECRET_KEY, ALGORITHM, logger
+from core.dependencies import get_db, SECRET_KEY, ALGORITHM, logger
+from core.event_bus import content_ref, parse_event_id
+from core.event_hub import SSE_CONNECT_TIMEOUT, SSE_HEARTBEAT_SECONDS, ClientDropped, get_event_hub
 from core.mapcoder.coordinator import CoordinatorService
+from core.mapcoder.leases import lease_active
+from core.mapcoder.rate_limit import rate_limit_stats
+from core.mapcoder.session_queue import get_session_queue, queue_stats
 from core.mapcoder.schemas import CreateSessionRequest, UpdateSessionRequest, SessionDetail, SessionStatusResponse, SessionSummary
+from core.messages import append_messages, delete_messages, message_dict, migrate_legacy_messages, recent_messages
 from core.models import AgentSession, AgentTask, AgentTaskLog, User
 import jwt
 from redis import exceptions as redis_exceptions
@@ -76,6 +82,7 @@ def _session_to_detail(session: AgentSession, db: Session) -> SessionDetail:
             for l in logs
         ],
         final_result=session.final_result,
+        messages=[message_dict(m) for m in recent_messages(db, session.id, 100)] or (session.metadata_ or {}).get('messages'),
     )
 
 
@@ -205,6 +212,47 @@ async def get_session_detail(
     return _session_to_detail(session, db)
 
 
+def _artifact_response(request: Optional[Request], body: Dict, value) -> Response:
+    # the hash matches the result_ref / final_result_ref sent in session events
+    ref_hash = content_ref(value)["hash"]
+    etag = f'"{ref_hash}"'
+    if request is not None and request.headers.get('if-none-match') == etag:
+        return Response(status_code=304, headers={'ETag': etag})
+    return JSONResponse({**body, 'hash': ref_hash}, headers={'ETag': etag, 'Cache-Control': 'private, no-cache'})
+
+
+@router.get("/session/{session_id}/tasks/{task_id}/result")
+async def get_task_result(session_id: int, task_id: int, db: Session = Depends(get_db), request: Request = None):
+    """Full result of one task. task_update events only carry a result_ref (hash + preview);
+    clients fetch this when the hash differs from what they hold (ETag / If-None-Match)."""
+    user = _user_from_request(request, db)
+    if not user:
+        raise HTTPException(status_code=401, detail="未认证的用户")
+    task = (
+        db.query(AgentTask)
+        .join(AgentSession, AgentSession.id == AgentTask.session_id)
+        .filter(AgentTask.id == task_id, AgentTask.session_id == session_id, AgentSession.user_id == user.id)
+        .first()
+    )
+    if not task:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return _artifact_response(request, {'task_id': task.id, 'status': task.status, 'result': task.result}, task.result)
+
+
+@router.get("/session/{session_id}/final-result")
+async def get_final_result(session_id: int, db: Session = Depends(get_db), request: Request = None):
+    """Full final artifact of a session; the final_result event only carries final_result_ref."""
+    user = _user_from_request(request, db)
+    if not user:
+        raise HTTPException(status_code=401, detail="未认证的用户")
+    session = db.query(AgentSession).filter_by(id=session_id, user_id=user.id).first()
+    if not session:
+        raise HTTPException(status_code=404, detail="任务会话不存在")
+    body = {'session_id': session.id, 'status': session.status, 'summary_title': session.summary_title,
+            'final_result': session.final_result}
+    return _artifact_response(request, body, session.final_result)
+
+
 @router.get("/session/{session_id}/status", response_model=SessionStatusResponse)
 async def get_session_status(
     session_id: int,
@@ -272,6 +320,7 @@ async def delete_session(
     if not session:
         raise HTTPException(status_code=404, detail="任务会话不存在")
 
+    delete_messages(db, session.id)
     deleted_logs = db.query(AgentTaskLog).filter_by(session_id=session.id).delete(synchronize_session=False)
     deleted_tasks = db.query(AgentTask).filter_by(session_id=session.id).delete(synchronize_session=False)
     db.delete(session)
@@ -287,7 +336,6 @@ async def delete_session(
 @router.post("/session/{session_id}/run")
 async def run_session(
     session_id: int,
-    background_tasks: BackgroundTasks,
     db: Session = Depends(get_db),
     request: Request = None,
     # current_user: dict = Depends(get_current_user),
@@ -300,6 +348,15 @@ async def run_session(
     if not session:
         raise HTTPException(status_code=404, detail="任务会话不存在")
 
+    root = (
+        db.query(AgentTask)
+        .filter_by(session_id=session.id, parent_id=None)
+        .order_by(AgentTask.id.asc())
+        .first()
+    )
+    if lease_active(root):
+        raise HTTPException(status_code=409, detail="任务正在执行中")
+
     # update prompt if provided in request body
     # For now, we accept optional prompt field to update draft session
     extra = None
@@ -312,16 +369,19 @@ async def run_session(
     if extra and isinstance(extra, dict):
         new_prompt = (extra.get('prompt') or '').strip()
         if new_prompt:
-            meta = session.metadata_ or {}
+            migrate_legacy_messages(db, session)
+            meta = dict(session.metadata_ or {})
             meta['prompt'] = new_prompt
-            meta.setdefault('messages', []).append({'role': 'user', 'content': new_prompt, 'created_at': datetime.now(timezone.utc).isoformat()})
             session.metadata_ = meta
+            append_messages(db, session.id, [('user', new_prompt, None)])
             session.status = 'pending'
             session.title = extra.get('title') or session.title
             # recreate root task if missing
-            existing_root = db.query(AgentTask).filter_by(session_id=session.id, parent_id=None).first()
-            if not existing_root:
-                AgentTask(session_id=session.id, title='整体任务', description=new_prompt, status='pending')
+            if not root:
+                root = AgentTask(session_id=session.id, title='整体任务', description=new_prompt, status='pending')
+                db.add(root)
+            else:
+                root.description = new_prompt
             db.commit()
         for key in ('max_tokens', 'temperature', 'api_key'):
             if extra.get(key) is not None:
@@ -333,21 +393,45 @@ async def run_session(
             session.metadata_ = meta
             db.commit()
 
-    # schedule background run using fresh DB session
-    def _bg_run(sid: int):
-        db2 = SessionLocal()
-        try:
-            coord = CoordinatorService(db2)
-            import asyncio
-
-            asyncio.run(coord.run_session_by_id(sid))
-        finally:
-            db2.close()
+    # a user-triggered run starts from scratch: reset the root task so a worker can claim it
+    if root:
+        root.status = 'pending'
+        root.attempt_count = 0
+        root.result = None
+    # commit 'queued' before enqueueing: a worker may pick the job up immediately and must not see
+    # the previous run's status (it would ack the job as a duplicate), nor have its own status
+    # overwritten by a late commit here
+    previous_status, previous_updated_at = session.status, session.updated_at
+    session.status = 'queued'
+    session.updated_at = datetime.now(timezone.utc)
+    db.commit()
 
-    background_tasks.add_task(_bg_run, session_id)
+    # hand the run over to the session job queue; workers pick it up with their own DB session
+    try:
+        get_session_queue().enqueue(session.id)
+    except Exception as e:
+        logger.warning(f"run_session: enqueue failed for session {session_id}: {e}")
+        session.status = previous_status
+        session.updated_at = previous_updated_at
+        db.commit()
+        raise HTTPException(status_code=503, detail="任务队列不可用，请稍后重试")
     return _session_to_detail(session, db)
 
 
+@router.get("/queue")
+async def get_queue_stats(db: Session = Depends(get_db), request: Request = None) -> Dict:
+    """Session job queue depth: pending / processing / dead jobs, local worker utilisation and
+    the LLM rate limiter queues (depth and wait per model / API key)."""
+    user = _user_from_request(request, db)
+    if not user:
+        raise HTTPException(status_code=401, detail="未认证的用户")
+    try:
+        return {**queue_stats(), "llm_rate_limits": rate_limit_stats()}
+    except Exception as e:
+        logger.warning(f"get_queue_stats failed: {e}")
+        raise HTTPException(status_code=503, detail="任务队列不可用")
+
+
 @router.patch("/session/{session_id}")
 async def update_session(
     session_id: int,
@@ -379,10 +463,20 @@ async def update_session(
 
 
 @router.get('/session/{session_id}/events')
-async def session_events(session_id: int, token: Optional[str] = None, db: Session = Depends(get_db), redis_client=Depends(get_redis)):
+async def session_events(session_id: int, request: Request, token: Optional[str] = None,
+                         last_event_id: Optional[str] = None, db: Session = Depends(get_db)):
     """Server-Sent Events endpoint that streams events published to Redis channel session:{id}:events
     Optional token (JWT) can be provided as query param because EventSource can't set headers.
     If token is missing or invalid, return 401.
+
+    Events come from the process-wide SessionEventHub (one pattern subscription per worker), so an
+    open stream holds no Redis connection or thread of its own. A client that falls
+    SSE_CLIENT_QUEUE events behind gets `event: overflow` and the stream ends.
+
+    Logged events carry an SSE `id:`. On reconnect the browser sends it back as Last-Event-ID (a
+    fresh page can pass ?last_event_id=) and only the events after it are replayed from the
+    session event log; `event: reset` means the log no longer reaches back that far and the
+    client should reload the session detail.
     """
     # validate token if provided
     if not token:
@@ -404,46 +498,52 @@ async def session_events(session_id: int, token: Optional[str] = None, db: Sessi
     session = db.query(AgentSession).filter_by(id=session_id).first()
     if not session or session.user_id != user.id:
         raise HTTPException(status_code=404, detail='任务会话不存在或无权访问')
+    # 释放数据库连接，长连接期间不再占用连接池
+    db.close()
 
-    if redis_client is None:
-        logger.warning(f"session_events: redis_client is None; Redis appears unavailable for session {session_id}")
+    hub = get_event_hub()
+    if not await hub.wait_connected(SSE_CONNECT_TIMEOUT):
+        logger.warning(f"session_events: event hub not connected; Redis appears unavailable for session {session_id}")
         raise HTTPException(status_code=503, detail="Redis unavailable. SSE disabled.")
-    try:
-        pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
-        channel = f"session:{session_id}:events"
-        pubsub.subscribe(channel)
-    except Exception as e:
-        # Catch redis connection/subscribe errors and return 503 instead of crashing
-        logger.warning(f"session_events: Redis subscribe failed for session {session_id}: {e}")
-        raise HTTPException(status_code=503, detail="Redis unavailable or connection refused. SSE is disabled.")
+
+    resume_from = request.headers.get('last-event-id') or last_event_id
 
     async def event_generator():
-        try:
+        # subscribe before reading the log so nothing published in between is missed
+        async with hub.subscribe(session_id) as sub:
             # yield a keep-alive comment to establish the stream
             yield 'event: keepalive\n\n'
+            replayed = None
+            if resume_from:
+                try:
+                    missed, complete = await hub.replay(session_id, resume_from)
+                except Exception as e:
+                    logger.warning(f"session_events: replay failed for session {session_id}: {e}")
+                    missed, complete = [], False
+                if not complete:
+                    yield 'event: reset\ndata: {}\n\n'
+                for event_id, data in missed:
+                    yield f'id: {event_id}\ndata: {data}\n\n'
+                replayed = parse_event_id(missed[-1][0]) if missed else parse_event_id(resume_from)
             while True:
-                message = await asyncio.to_thread(pubsub.get_message, timeout=1.0)
-                if message:
-                    data = message.get('data')
-                    if isinstance(data, bytes):
-                        try:
-                            text = data.decode('utf-8')
-                        except Exception:
-                            text = str(data)
-                    else:
-                        text = str(data)
-                    # send as SSE 'data:' lines
-                    yield f'data: {text}\n\n'
-                else:
-                    # send a comment as heartbeat every ~10s to keep connection alive in some proxies
+                try:
+                    data = await sub.get(timeout=SSE_HEARTBEAT_SECONDS)
+                except ClientDropped:
+                    yield 'event: overflow\ndata: {}\n\n'
+                    return
+                if data is None:
+                    # send a comment as heartbeat to keep connection alive in some proxies
                     yield ': heartbeat\n\n'
-                await asyncio.sleep(0.1)
-        finally:
-            try:
-                pubsub.unsubscribe(channel)
-                pubsub.close()
-            except Exception:
-                pass
+                    continue
+                event_id, payload = data
+                if event_id is None:
+                    # unlogged (token deltas): nothing to resume from
+                    yield f'data: {payload}\n\n'
+                    continue
+                if replayed is not None and parse_event_id(event_id) <= replayed:
+                    continue  # already sent by the replay
+                # send as SSE 'id:' + 'data:' lines
+                yield f'id: {event_id}\ndata: {payload}\n\n'
 
     return StreamingResponse(event_generator(), media_type='text/event-stream')
 
@@ -504,18 +604,14 @@ async def session_debug_events(session_id: int, token: Optional[str] = None, db:
 
 
 @router.post('/session/{session_id}/publish-event')
-async def publish_session_event(session_id: int, payload: Optional[Dict] = Body(None), db: Session = Depends(get_db), redis_client=Depends(get_redis)):
-    """Debug helper: publish a JSON event to the session Redis channel.
+async def publish_session_event(session_id: int, payload: Optional[Dict] = Body(None), db: Session = Depends(get_db)):
+    """Debug helper: publish a JSON event to the session's event bus (Redis channel or in-process).
     Body payload is optional; if omitted, a timestamped test event is sent.
     Requires authenticated user (Bearer token in header).
     """
     user = _user_from_request(Request, db) if False else None
     # We can't use Request in this signature easily here; instead require token via body or use get_db auth fallback
-    # For simplicity, accept unauthenticated publishes only when redis is available locally.
-    if redis_client is None:
-        logger.warning(f"publish_session_event: Redis unavailable, cannot publish for session {session_id}")
-        raise HTTPException(status_code=503, detail='Redis unavailable; start Redis to test real-time events')
-
+    # For simplicity, accept unauthenticated publishes (debug only).
     event = payload or {
         'type': 'published_debug',
         'time': datetime.now(timezone.utc).isoformat(),
@@ -525,8 +621,8 @@ async def publish_session_event(session_id: int, payload: Optional[Dict] = Body(
         # use publish_event helper which will log failures
         from core.dependencies import publish_event
 
-        publish_event(session_id, event, redis_client=redis_client)
-        return {'status': 'ok', 'published': True, 'event': event}
+        event_id = await asyncio.to_thread(publish_event, session_id, event)
+        return {'status': 'ok', 'published': True, 'id': event_id, 'event': event}
     except Exception as e:
         logger.warning(f"publish_session_event failed: {e}")
         raise HTTPException(status_code=500, detail=f'publish failed: {e}')
@@ -0,0 +1,185 @@
+"""Micro-benchmarks for backend helpers that run on every poll and every event.
+
+Usage (from backend/):
+    python -m scripts.bench_helpers [--rounds 200] [--out helpers.json] [--baseline helpers_base.json] [--tolerance 0.2]
+
+Builds a realistic fixture in a throw-away SQLite database (DATABASE_URL is pointed at a temp
+file unless already set): one session with 100 tasks carrying LLM-sized results and 5000 logs.
+Each benchmark is warmed up and then timed for --rounds calls; the median per-call time is
+checked against its absolute budget in BUDGETS_US and, with --baseline, against a previous run.
+Exits 1 on any regression.
+
+Benchmarked:
+- coordinator._extract_code_snippet on an ~8 KB answer with a fenced code block
+- routers.mapcoder._build_task_dict over 100 tasks
+- routers.mapcoder._session_to_detail (task + log queries and pydantic model)
+- publish_event serialization of a task_update event as built by coordinator.task_event
+  (client injected, nothing is sent)
+- the provider backend's response parser (the replacement for /agent's _extract_from_data)
+- routers.mapcoder._user_from_request: JWT decode plus user lookup
+
+load_category_mappings is not covered: the Category model it queries does not exist in this tree.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+# per-call median budget in microseconds; generous on purpose, they catch order-of-magnitude slips
+BUDGETS_US = {
+    "extract_code_snippet": 100,
+    "build_task_dict_x100": 3000,
+    "session_to_detail": 60000,
+    "publish_event_serialize": 300,
+    "provider_parse": 10,
+    "user_from_request": 5000,
+}
+
+LLM_ANSWER = (
+    "下面给出实现思路与代码。\n\n" + "说明：考虑边界条件、重复元素与稳定性。\n" * 60
+    + "```python\n" + "def quicksort(a):\n    if len(a) <= 1:\n        return a\n    pivot = a[0]\n"
+    "    left = [x for x in a[1:] if x <= pivot]\n    right = [x for x in a[1:] if x > pivot]\n"
+    "    return quicksort(left) + [pivot] + quicksort(right)\n" * 20 + "```\n" + "复杂度分析：平均 O(n log n)。\n" * 40
+)
+
+
+class _NullRedis:
+    def publish(self, channel: str, payload: str) -> int:
+        return 0
+
+    def evalsha(self, sha: str, numkeys: int, *keys_and_args: Any) -> str:
+        return "0-1"
+
+
+def timeit(fn: Callable[[], Any], rounds: int, warmup: int = 10) -> Dict[str, float]:
+    for _ in range(warmup):
+        fn()
+    samples: List[float] = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1e6)
+    return {
+        "median_us": round(statistics.median(samples), 2),
+        "mean_us": round(statistics.mean(samples), 2),
+        "min_us": round(min(samples), 2),
+        "rounds": rounds,
+    }
+
+
+def build_fixture(db, n_tasks: int = 100, n_logs: int = 5000):
+    from core.models import AgentSession, AgentTask, AgentTaskLog, User
+
+    user = User(username=f"bench_helpers_{int(time.time())}", hashed_password="x")
+    db.add(user)
+    db.flush()
+    session = AgentSession(user_id=user.id, title="bench", model_id="gpt-4o", status="completed",
+                           metadata_={"prompt": "实现快速排序", "messages": [{"role": "user", "content": "实现快速排序"}]},
+                           final_result={"text": LLM_ANSWER})
+    db.add(session)
+    db.flush()
+    for i in range(n_tasks):
+        db.add(AgentTask(session_id=session.id, title=f"coder 子任务{i}", description="根据计划生成代码", status="completed",
+                         confidence=0.8, attempt_count=1,
+                         result={"text": LLM_ANSWER[:2000], "code": LLM_ANSWER[-800:], "meta": {"type": "coding"},
+                                 "role_type": "coding"}))
+    db.flush()
+    db.bulk_save_objects([
+        AgentTaskLog(session_id=session.id, level="INFO", message=f"任务 {i} 已完成", payload={"meta": {"type": "coding"}})
+        for i in range(n_logs)
+    ])
+    db.commit()
+    tasks = db.query(AgentTask).filter_by(session_id=session.id).all()
+    return user, session, tasks
+
+
+def run(rounds: int) -> Dict[str, Dict[str, float]]:
+    from starlette.requests import Request
+
+    from core.dependencies import SessionLocal, engine, publish_event
+    from core.mapcoder.coordinator import _extract_code_snippet, task_event
+    from core.mapcoder.provider import OpenAICompatibleBackend
+    from core.models import Base
+    from routers.auth import create_access_token
+    from routers.mapcoder import _build_task_dict, _session_to_detail, _user_from_request
+
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    try:
+        user, session, tasks = build_fixture(db)
+        token = create_access_token({"id": user.id})
+        request = Request({"type": "http", "method": "GET", "path": "/", "query_string": b"",
+                           "headers": [(b"authorization", f"Bearer {token}".encode())]})
+        event = task_event(tasks[0])
+        backend = OpenAICompatibleBackend()
+        response = {"id": "chatcmpl-1", "object": "chat.completion", "model": "gpt-4o",
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": LLM_ANSWER}, "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": 200, "completion_tokens": 900, "total_tokens": 1100}}
+        null_redis = _NullRedis()
+
+        benches: Dict[str, Callable[[], Any]] = {
+            "extract_code_snippet": lambda: _extract_code_snippet(LLM_ANSWER),
+            "build_task_dict_x100": lambda: [_build_task_dict(t) for t in tasks],
+            "session_to_detail": lambda: _session_to_detail(session, db),
+            "publish_event_serialize": lambda: publish_event(session.id, event, redis_client=null_redis),
+            "provider_parse": lambda: backend.parse(response),
+            "user_from_request": lambda: _user_from_request(request, db),
+        }
+        return {name: timeit(fn, rounds) for name, fn in benches.items()}
+    finally:
+        db.close()
+
+
+def check(results: Dict[str, Dict[str, float]], baseline: Optional[Dict[str, Any]], tolerance: float) -> List[str]:
+    problems = []
+    for name, stats in results.items():
+        budget = BUDGETS_US.get(name)
+        if budget is not None and stats["median_us"] > budget:
+            problems.append(f"{name}: median {stats['median_us']}us over budget {budget}us")
+        before = ((baseline or {}).get("results") or {}).get(name, {}).get("median_us")
+        if before and stats["median_us"] > before * (1 + tolerance):
+            problems.append(f"{name}: median {before}us -> {stats['median_us']}us (+{stats['median_us'] / before - 1:.0%})")
+    return problems
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Micro-benchmarks for backend hot helpers")
+    ap.add_argument("--rounds", type=int, default=200)
+    ap.add_argument("--out", default=None, help="write the JSON result here")
+    ap.add_argument("--baseline", default=None, help="compare against this JSON result")
+    ap.add_argument("--tolerance", type=float, default=0.20, help="allowed relative slowdown against the baseline")
+    args = ap.parse_args()
+
+    tmp = None
+    if not os.environ.get("DATABASE_URL"):
+        tmp = tempfile.NamedTemporaryFile(suffix=".db", delete=False)
+        tmp.close()
+        os.environ["DATABASE_URL"] = f"sqlite:///{tmp.name}"
+    try:
+        results = run(args.rounds)
+    finally:
+        if tmp is not None:
+            os.unlink(tmp.name)
+
+    output = {"results": results, "budgets_us": BUDGETS_US}
+    print(json.dumps(output, indent=2))
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(output, f, indent=2)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    problems = check(results, baseline, args.tolerance)
+    if problems:
+        print("REGRESSIONS:\n  " + "\n  ".join(problems))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,314 @@
+"""End-to-end MapCoder session throughput benchmark.
+
+Usage (from backend/):
+    python -m scripts.bench_sessions --users 5 --sessions 50 [--concurrency 10] [--fake-llm]
+        [--db-url sqlite:///bench.db] [--out bench.json] [--baseline baseline.json] [--tolerance 0.1]
+
+Starts the API in-process (uvicorn on --port, embedded session workers), creates N users directly
+in the database, then for M sessions: POST /mapcoder/session, subscribe to
+/mapcoder/session/{id}/events, POST /mapcoder/session/{id}/run and wait for the final result.
+With --fake-llm a local scripts.fake_llm_server is started and OPENAI_BASE_URL pointed at it
+(latency flags are passed through); otherwise the configured provider is used. The LLM cache
+is disabled so every session really goes through the model.
+
+Reported (and written to --out as JSON):
+- sessions/sec over the whole run and end-to-end session latency percentiles
+- per-stage latency p50/p95/p99 (from the "开始执行" log event to the task's final task_update)
+- SQL statements per session (SQLAlchemy cursor executions in this process, workers included)
+- event delivery lag percentiles (receive time minus the event's publish `ts`)
+
+With --baseline, key metrics are compared against a previous JSON result and the script exits 1
+if any regresses by more than --tolerance. Redis must be reachable for the events stream.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from datetime import timedelta
+from typing import Any, Dict, List, Optional
+
+# (metric, higher_is_better) pairs compared against the baseline
+BASELINE_METRICS = [
+    ("sessions_per_sec", True),
+    ("session_latency_s.p95", False),
+    ("db_queries_per_session", False),
+    ("event_lag_ms.p95", False),
+]
+
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    if not values:
+        return {"count": 0, "p50": None, "p95": None, "p99": None, "max": None}
+    ordered = sorted(values)
+
+    def pick(q: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 4)
+
+    return {"count": len(ordered), "p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "max": round(ordered[-1], 4)}
+
+
+def stage_of(title: str) -> str:
+    # "coder 子任务A" / "retriever 子任务" / "候选计划 B" -> coder / retriever / 候选计划
+    return re.split(r"\s+", title.strip(), 1)[0] if title.strip() else "unknown"
+
+
+class SessionProbe:
+    """Collects timings for one session from its SSE stream."""
+
+    def __init__(self, session_id: int):
+        self.session_id = session_id
+        self.subscribed = asyncio.Event()
+        self.done = asyncio.Event()
+        self.run_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.status: Optional[str] = None
+        self.events = 0
+        self.lags: List[float] = []
+        self.task_started: Dict[int, tuple] = {}
+        self.stage_latency: Dict[str, List[float]] = {}
+
+    def on_event(self, event: Dict[str, Any]) -> None:
+        now = time.time()
+        self.events += 1
+        if isinstance(event.get("ts"), (int, float)):
+            self.lags.append((now - event["ts"]) * 1000)
+        kind = event.get("type")
+        if kind == "log":
+            log = event.get("log") or {}
+            message = log.get("message") or ""
+            if log.get("task_id") and message.endswith("开始执行"):
+                self.task_started[log["task_id"]] = (stage_of(message[: -len("开始执行")]), now)
+        elif kind == "task_update":
+            task = event.get("task") or {}
+            started = self.task_started.pop(task.get("id"), None)
+            if started and task.get("status") in ("completed", "failed", "canceled"):
+                self.stage_latency.setdefault(started[0], []).append(now - started[1])
+        elif kind == "final_result" or (kind == "session" and (event.get("session") or {}).get("status") in ("canceled", "failed")):
+            self.status = event.get("status") or (event.get("session") or {}).get("status")
+            self.finished_at = now
+            self.done.set()
+
+
+async def consume_events(client, probe: SessionProbe, token: str) -> None:
+    async with client.stream("GET", f"/mapcoder/session/{probe.session_id}/events", params={"token": token},
+                             timeout=None) as resp:
+        if resp.status_code != 200:
+            probe.status = f"events_http_{resp.status_code}"
+            probe.subscribed.set()
+            probe.done.set()
+            return
+        async for line in resp.aiter_lines():
+            if not probe.subscribed.is_set():
+                # the first keep-alive arrives after the Redis subscription is in place
+                probe.subscribed.set()
+            if line.startswith("data:"):
+                try:
+                    probe.on_event(json.loads(line[5:].strip()))
+                except ValueError:
+                    continue
+            if probe.done.is_set():
+                return
+
+
+async def run_one(client, index: int, token: str, run_id: str, timeout: float) -> SessionProbe:
+    headers = {"Authorization": f"Bearer {token}"}
+    body = {"title": f"bench {run_id} #{index}", "prompt": f"[{run_id}-{index}] 实现快速排序并给出复杂度分析"}
+    resp = await client.post("/mapcoder/session", json=body, headers=headers)
+    resp.raise_for_status()
+    probe = SessionProbe(resp.json()["id"])
+    consumer = asyncio.create_task(consume_events(client, probe, token))
+    try:
+        await asyncio.wait_for(probe.subscribed.wait(), 10)
+        probe.run_at = time.time()
+        run = await client.post(f"/mapcoder/session/{probe.session_id}/run", headers=headers)
+        if run.status_code >= 400:
+            probe.status = f"run_http_{run.status_code}"
+            return probe
+        await asyncio.wait_for(probe.done.wait(), timeout)
+    except asyncio.TimeoutError:
+        probe.status = probe.status or "timeout"
+    finally:
+        consumer.cancel()
+    return probe
+
+
+def create_users(n: int, run_id: str) -> List[str]:
+    from core.dependencies import SessionLocal, pwd_context
+    from core.models import User
+    from routers.auth import create_access_token
+
+    db = SessionLocal()
+    try:
+        hashed = pwd_context.hash(run_id)
+        users = [User(username=f"bench_{run_id}_{i}", hashed_password=hashed) for i in range(n)]
+        db.add_all(users)
+        db.commit()
+        return [create_access_token({"id": u.id}, expires_delta=timedelta(hours=6)) for u in users]
+    finally:
+        db.close()
+
+
+def start_api(port: int):
+    import uvicorn
+    from main import app
+
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, name="bench-api", daemon=True)
+    thread.start()
+    deadline = time.time() + 30
+    while not server.started:
+        if time.time() > deadline:
+            raise RuntimeError("API server did not start")
+        time.sleep(0.05)
+    return server, thread
+
+
+def start_fake_llm(args) -> subprocess.Popen:
+    cmd = [sys.executable, "-m", "scripts.fake_llm_server", "--port", str(args.llm_port),
+           "--ttft", args.llm_ttft, "--tokens-per-sec", str(args.llm_tokens_per_sec),
+           "--error-rate", str(args.llm_error_rate), "--rate-429", str(args.llm_rate_429)]
+    proc = subprocess.Popen(cmd)
+    time.sleep(1.5)
+    if proc.poll() is not None:
+        raise RuntimeError("fake LLM server failed to start")
+    return proc
+
+
+def lookup(result: Dict[str, Any], dotted: str) -> Optional[float]:
+    cur: Any = result
+    for part in dotted.split("."):
+        cur = cur.get(part) if isinstance(cur, dict) else None
+    return cur if isinstance(cur, (int, float)) else None
+
+
+def compare(result: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    regressions = []
+    for metric, higher_is_better in BASELINE_METRICS:
+        now, before = lookup(result, metric), lookup(baseline, metric)
+        if now is None or not before:
+            continue
+        change = (now - before) / before
+        if (change < -tolerance) if higher_is_better else (change > tolerance):
+            regressions.append(f"{metric}: {before} -> {now} ({change:+.1%})")
+    return regressions
+
+
+async def bench(args, tokens: List[str], run_id: str, counter: Dict[str, int]) -> Dict[str, Any]:
+    import httpx
+
+    limits = httpx.Limits(max_connections=args.concurrency * 2 + 10)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.port}", timeout=30, limits=limits) as client:
+        gate = asyncio.Semaphore(args.concurrency)
+
+        async def guarded(i: int) -> SessionProbe:
+            async with gate:
+                return await run_one(client, i, tokens[i % len(tokens)], run_id, args.session_timeout)
+
+        queries_before = counter["statements"]
+        started = time.time()
+        probes = await asyncio.gather(*(guarded(i) for i in range(args.sessions)))
+        elapsed = time.time() - started
+        queries = counter["statements"] - queries_before
+
+    ok = [p for p in probes if p.status == "completed"]
+    stages: Dict[str, List[float]] = {}
+    for p in probes:
+        for name, values in p.stage_latency.items():
+            stages.setdefault(name, []).extend(values)
+    statuses: Dict[str, int] = {}
+    for p in probes:
+        statuses[p.status or "unknown"] = statuses.get(p.status or "unknown", 0) + 1
+    return {
+        "run_id": run_id,
+        "config": {"users": args.users, "sessions": args.sessions, "concurrency": args.concurrency,
+                   "db_url": os.environ.get("DATABASE_URL") or "default", "fake_llm": args.fake_llm},
+        "elapsed_s": round(elapsed, 3),
+        "completed": len(ok),
+        "statuses": statuses,
+        "sessions_per_sec": round(len(ok) / elapsed, 4) if elapsed else None,
+        "session_latency_s": percentiles([p.finished_at - p.run_at for p in ok if p.run_at and p.finished_at]),
+        "stage_latency_s": {name: percentiles(values) for name, values in sorted(stages.items())},
+        "db_queries_per_session": round(queries / len(probes), 1) if probes else None,
+        "events_per_session": round(statistics.mean(p.events for p in probes), 1) if probes else None,
+        "event_lag_ms": percentiles([lag for p in probes for lag in p.lags]),
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description="End-to-end MapCoder session throughput benchmark")
+    ap.add_argument("--users", type=int, default=5)
+    ap.add_argument("--sessions", type=int, default=20)
+    ap.add_argument("--concurrency", type=int, default=10, help="sessions in flight at once")
+    ap.add_argument("--session-timeout", type=float, default=300)
+    ap.add_argument("--port", type=int, default=8765, help="port for the in-process API")
+    ap.add_argument("--db-url", default=None, help="DATABASE_URL for this run, e.g. sqlite:///bench.db")
+    ap.add_argument("--fake-llm", action="store_true", help="start scripts.fake_llm_server and use it")
+    ap.add_argument("--llm-port", type=int, default=8900)
+    ap.add_argument("--llm-ttft", default="lognormal:-0.7,0.5")
+    ap.add_argument("--llm-tokens-per-sec", type=float, default=200)
+    ap.add_argument("--llm-error-rate", type=float, default=0.0)
+    ap.add_argument("--llm-rate-429", type=float, default=0.0)
+    ap.add_argument("--out", default=None, help="write the JSON result here")
+    ap.add_argument("--baseline", default=None, help="compare against this JSON result")
+    ap.add_argument("--tolerance", type=float, default=0.10, help="allowed relative regression")
+    args = ap.parse_args()
+
+    # configuration must be in the environment before the app modules are imported
+    if args.db_url:
+        os.environ["DATABASE_URL"] = args.db_url
+    os.environ["LLM_CACHE_ENABLED"] = "false"
+    os.environ.setdefault("MAPCODER_QUEUE_EMBEDDED", "true")
+    fake = None
+    if args.fake_llm:
+        os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{args.llm_port}/v1"
+        os.environ["OPENAI_API_KEY"] = os.environ.get("OPENAI_API_KEY") or "fake"
+        os.environ["LLM_BACKEND"] = "openai"
+        fake = start_fake_llm(args)
+
+    from sqlalchemy import event
+    from core.dependencies import engine
+
+    counter = {"statements": 0}
+    counter_lock = threading.Lock()
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _count(*_):
+        with counter_lock:
+            counter["statements"] += 1
+
+    server = None
+    try:
+        server, thread = start_api(args.port)
+        run_id = uuid.uuid4().hex[:8]
+        tokens = create_users(args.users, run_id)
+        result = asyncio.run(bench(args, tokens, run_id, counter))
+    finally:
+        if server is not None:
+            server.should_exit = True
+            thread.join(timeout=15)
+        if fake is not None:
+            fake.terminate()
+
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        if regressions:
+            print("REGRESSIONS:\n  " + "\n  ".join(regressions))
+            sys.exit(1)
+        print(f"no regression beyond {args.tolerance:.0%} against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+"""Fake OpenAI-compatible LLM server for load tests and benchmarks.
+
+Usage (from backend/):
+    python -m scripts.fake_llm_server [--port 8900] [--ttft lognormal:-0.5,0.5] [--tokens-per-sec 60]
+        [--completion-tokens normal:300,80] [--error-rate 0.01] [--rate-429 0.02] [--rpm 600] [--tpm 200000]
+
+Then point the backend at it:
+    OPENAI_BASE_URL=http://127.0.0.1:8900/v1 OPENAI_API_KEY=fake uvicorn main:app
+
+Serves POST /v1/chat/completions (plain JSON or SSE with "stream": true), GET /v1/models and
+GET /stats. Answers are canned per MapCoder role (examples, candidate plans, code, debug notes)
+and padded to the sampled completion length, so the coordinator's parsers see realistic text.
+
+Latency model: time to first token is drawn from --ttft, then tokens are produced at
+--tokens-per-sec (0 = all at once); non-streaming responses are returned after the full time.
+Distributions: fixed:S | uniform:LO,HI | normal:MEAN,SD | lognormal:MU,SIGMA | exp:MEAN (seconds).
+--error-rate injects 500s and --rate-429 injects 429s with Retry-After; --rpm / --tpm enforce real
+server-side limits (429 when exceeded), like a provider account quota.
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+import uvicorn
+from fastapi import Body, FastAPI
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+def parse_distribution(spec: str):
+    """Return a sampler for a distribution spec like 'lognormal:-0.5,0.5' (values clipped at 0)."""
+    kind, _, args = (spec or "fixed:0").partition(":")
+    params = [float(x) for x in args.split(",") if x.strip()] or [0.0]
+    kind = kind.lower()
+    if kind == "fixed":
+        return lambda: max(0.0, params[0])
+    if kind == "uniform":
+        return lambda: random.uniform(params[0], params[1])
+    if kind == "normal":
+        return lambda: max(0.0, random.gauss(params[0], params[1]))
+    if kind == "lognormal":
+        return lambda: random.lognormvariate(params[0], params[1])
+    if kind == "exp":
+        return lambda: random.expovariate(1.0 / params[0]) if params[0] > 0 else 0.0
+    raise ValueError(f"unknown distribution: {spec}")
+
+
+CANNED = [
+    (("给我3个",), "1) 示例A：问题：...；思路：...\n2) 示例B：问题：...；思路：...\n3) 示例C：问题：...；思路：..."),
+    (("候选计划",), "计划A(置信度0.9)：步骤1, 步骤2。\n计划B(置信度0.6)：步骤1, 步骤2。\n计划C(置信度0.4)：步骤1, 步骤2。"),
+    (("调试", "debug"), "找到问题：边界条件未处理。建议修复：在循环中判断空列表并返回。\n修复后的代码：\n```python\n"
+                             "def quicksort(a):\n    if len(a) <= 1:\n        return a\n    pivot = a[0]\n"
+                             "    return quicksort([x for x in a[1:] if x <= pivot]) + [pivot] + quicksort([x for x in a[1:] if x > pivot])\n```"),
+    (("生成可运行的代码", "生成代码"), "```python\ndef quicksort(a):\n    if len(a) <= 1:\n        return a\n    pivot = a[0]\n"
+                                     "    left = [x for x in a[1:] if x <= pivot]\n    right = [x for x in a[1:] if x > pivot]\n"
+                                     "    return quicksort(left) + [pivot] + quicksort(right)\n```"),
+]
+FILLER = "\n补充说明：该步骤的复杂度与边界条件已在上文讨论。"
+CHARS_PER_TOKEN = 4
+
+
+def canned_answer(prompt: str) -> str:
+    # the role instruction is the prompt's first line; the rest (task, plan, code) would mislead
+    head = prompt.split("\n", 1)[0].lower()
+    for keywords, answer in CANNED:
+        if any(k in head for k in keywords):
+            return answer
+    return f"（模拟回答）{prompt[:200]}"
+
+
+def tokenize(text: str) -> List[str]:
+    return [text[i:i + CHARS_PER_TOKEN] for i in range(0, len(text), CHARS_PER_TOKEN)]
+
+
+class Bucket:
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def take(self, amount: float) -> Optional[float]:
+        """Consume `amount`; return None on success or the seconds until it would fit."""
+        if self.capacity <= 0:
+            return None
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60.0)
+        self.updated = now
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            self.level -= amount
+            return None
+        return (amount - self.level) * 60.0 / self.capacity
+
+
+class FakeLLM:
+    def __init__(self, args: argparse.Namespace):
+        self.ttft = parse_distribution(args.ttft)
+        self.completion_tokens = parse_distribution(args.completion_tokens) if args.completion_tokens else None
+        self.tokens_per_sec = args.tokens_per_sec
+        self.error_rate = args.error_rate
+        self.rate_429 = args.rate_429
+        self.rpm = Bucket(args.rpm)
+        self.tpm = Bucket(args.tpm)
+        self.lock = threading.Lock()
+        self.stats: Dict[str, Any] = {"requests": 0, "streamed": 0, "in_flight": 0, "injected_500": 0,
+                                      "injected_429": 0, "quota_429": 0, "completion_tokens": 0}
+
+    def count(self, name: str, n: int = 1) -> None:
+        with self.lock:
+            self.stats[name] += n
+
+    def answer_tokens(self, prompt: str, max_tokens: int) -> List[str]:
+        text = canned_answer(prompt)
+        if self.completion_tokens is not None:
+            target = max(1, int(self.completion_tokens()))
+            while len(text) < target * CHARS_PER_TOKEN:
+                text += FILLER
+            text = text[:target * CHARS_PER_TOKEN]
+        return tokenize(text)[:max(1, max_tokens)]
+
+    def admit(self, prompt: str, max_tokens: int) -> Optional[JSONResponse]:
+        """Fault injection and quota checks; returns an error response or None."""
+        if random.random() < self.error_rate:
+            self.count("injected_500")
+            return JSONResponse({"error": {"message": "injected server error", "type": "server_error"}}, status_code=500)
+        if random.random() < self.rate_429:
+            self.count("injected_429")
+            return self._too_many("injected rate limit", 1.0)
+        with self.lock:
+            wait = self.rpm.take(1) or self.tpm.take(len(prompt) // CHARS_PER_TOKEN + max_tokens)
+        if wait:
+            self.count("quota_429")
+            return self._too_many("quota exceeded", wait)
+        return None
+
+    @staticmethod
+    def _too_many(message: str, retry_after: float) -> JSONResponse:
+        return JSONResponse({"error": {"message": message, "type": "rate_limit_error"}}, status_code=429,
+                            headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+
+    def generation_time(self, n_tokens: int) -> float:
+        return n_tokens / self.tokens_per_sec if self.tokens_per_sec > 0 else 0.0
+
+
+def create_app(fake: FakeLLM) -> FastAPI:
+    app = FastAPI(title="Fake LLM")
+
+    @app.get("/v1/models")
+    async def models():
+        return {"object": "list", "data": [{"id": "fake-model", "object": "model", "owned_by": "fake"}]}
+
+    @app.get("/stats")
+    async def stats():
+        with fake.lock:
+            return dict(fake.stats)
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(body: Dict[str, Any] = Body(...)):
+        fake.count("requests")
+        messages = body.get("messages") or []
+        prompt = "\n".join(str(m.get("content", "")) for m in messages if isinstance(m, dict))
+        model = body.get("model") or "fake-model"
+        max_tokens = int(body.get("max_tokens") or 1024)
+        rejected = fake.admit(prompt, max_tokens)
+        if rejected is not None:
+            return rejected
+
+        tokens = fake.answer_tokens(prompt, max_tokens)
+        fake.count("completion_tokens", len(tokens))
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        usage = {"prompt_tokens": len(prompt) // CHARS_PER_TOKEN, "completion_tokens": len(tokens)}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        ttft = fake.ttft()
+
+        if not body.get("stream"):
+            fake.count("in_flight")
+            try:
+                await asyncio.sleep(ttft + fake.generation_time(len(tokens)))
+            finally:
+                fake.count("in_flight", -1)
+            return {
+                "id": completion_id, "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)},
+                             "finish_reason": "stop"}],
+                "usage": usage,
+            }
+
+        async def events():
+            fake.count("streamed")
+            fake.count("in_flight")
+            try:
+                await asyncio.sleep(ttft)
+                per_token = fake.generation_time(1)
+                for token in tokens:
+                    chunk = {"id": completion_id, "object": "chat.completion.chunk", "model": model,
+                             "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]}
+                    yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+                    if per_token:
+                        await asyncio.sleep(per_token)
+                done = {"id": completion_id, "object": "chat.completion.chunk", "model": model,
+                        "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}], "usage": usage}
+                yield f"data: {json.dumps(done)}\n\n"
+                yield "data: [DONE]\n\n"
+            finally:
+                fake.count("in_flight", -1)
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return app
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Fake OpenAI-compatible chat completions server")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8900)
+    ap.add_argument("--ttft", default="lognormal:-0.7,0.5", help="time-to-first-token distribution (seconds)")
+    ap.add_argument("--tokens-per-sec", type=float, default=60.0, help="generation speed, 0 = instant")
+    ap.add_argument("--completion-tokens", default=None, help="completion length distribution (tokens); default: canned length")
+    ap.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 500")
+    ap.add_argument("--rate-429", type=float, default=0.0, help="fraction of requests answered with 429")
+    ap.add_argument("--rpm", type=float, default=0, help="server-side requests/minute quota, 0 = unlimited")
+    ap.add_argument("--tpm", type=float, default=0, help="server-side tokens/minute quota, 0 = unlimited")
+    ap.add_argument("--seed", type=int, default=None, help="random seed")
+    args = ap.parse_args()
+    if args.seed is not None:
+        random.seed(args.seed)
+    uvicorn.run(create_app(FakeLLM(args)), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
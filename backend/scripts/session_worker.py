@@ -0,0 +1,42 @@
+"""Standalone MapCoder session worker.
+
+Usage (from backend/):
+    python -m scripts.session_worker [--workers N]
+
+Pulls session run jobs from the shared Redis queue and executes them. Start as many worker
+processes (on as many machines) as needed; set MAPCODER_QUEUE_EMBEDDED=false on the API
+processes so they only enqueue.
+"""
+
+import argparse
+import signal
+import threading
+
+from core.dependencies import engine, logger
+from core.mapcoder.session_queue import QUEUE_WORKERS, SessionWorkerPool, get_session_queue
+from core.models import ensure_columns
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run MapCoder session workers")
+    parser.add_argument("--workers", type=int, default=QUEUE_WORKERS, help="worker threads in this process")
+    args = parser.parse_args()
+
+    # 独立 worker 可能先于 API 进程启动，租约列缺失时先补上
+    ensure_columns(engine)
+    job_queue = get_session_queue()
+    if job_queue.backend != "redis":
+        logger.warning("Redis 不可用：独立 worker 只能消费本进程内的队列，无法接收 API 进程的任务")
+
+    pool = SessionWorkerPool(job_queue, workers=args.workers)
+    stopped = threading.Event()
+    signal.signal(signal.SIGINT, lambda *_: stopped.set())
+    signal.signal(signal.SIGTERM, lambda *_: stopped.set())
+    pool.start()
+    while not stopped.wait(30):
+        logger.info(f"session worker stats: {pool.stats()}")
+    pool.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -62,6 +62,9 @@ CREATE TABLE agent_tasks (
 	confidence DOUBLE PRECISION, 
 	attempt_count INTEGER NOT NULL, 
 	max_attempts INTEGER NOT NULL, 
+	lease_owner VARCHAR(120), 
+	lease_expires_at TIMESTAMP WITHOUT TIME ZONE, 
+	heartbeat_at TIMESTAMP WITHOUT TIME ZONE, 
 	result JSON, 
 	created_at TIMESTAMP WITHOUT TIME ZONE, 
 	updated_at TIMESTAMP WITHOUT TIME ZONE, 
@@ -71,6 +74,9 @@ CREATE TABLE agent_tasks (
 	CONSTRAINT agent_tasks_session_id_fkey FOREIGN KEY(session_id) REFERENCES agent_sessions (id)
 );
 
+CREATE INDEX ix_agent_tasks_lease_owner ON agent_tasks (lease_owner);
+CREATE INDEX ix_agent_tasks_lease_expires_at ON agent_tasks (lease_expires_at);
+
 
 CREATE TABLE agent_task_logs (
 	id SERIAL NOT NULL, 
@@ -87,3 +93,17 @@ CREATE TABLE agent_task_logs (
 	CONSTRAINT agent_task_logs_task_id_fkey FOREIGN KEY(task_id) REFERENCES agent_tasks (id)
 );
 
+
+CREATE TABLE agent_messages (
+	id SERIAL NOT NULL, 
+	session_id INTEGER NOT NULL, 
+	role VARCHAR(20) NOT NULL, 
+	content TEXT NOT NULL, 
+	created_at TIMESTAMP WITHOUT TIME ZONE, 
+	CONSTRAINT agent_messages_pkey PRIMARY KEY (id), 
+	CONSTRAINT agent_messages_session_id_fkey FOREIGN KEY(session_id) REFERENCES agent_sessions (id)
+);
+
+CREATE INDEX ix_agent_messages_session_id_id ON agent_messages (session_id, id);
+
+
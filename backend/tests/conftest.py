@@ -0,0 +1,34 @@
+import os
+import tempfile
+
+# 测试不依赖 Postgres / Redis：临时 SQLite 库与进程内的事件总线、会话队列，LLM 使用 mock 后端
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp(prefix='agent-tests-')}/test.db")
+os.environ.setdefault("EVENT_BUS_BACKEND", "memory")
+os.environ.setdefault("MAPCODER_QUEUE_BACKEND", "memory")
+os.environ.setdefault("LLM_BACKEND", "mock")
+
+import pytest  # noqa: E402
+
+
+@pytest.fixture
+def db():
+    from core.dependencies import SessionLocal, engine
+    from core.models import Base
+
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+@pytest.fixture
+def user(db):
+    from core.models import User
+
+    u = User(username="tester", hashed_password="x")
+    db.add(u)
+    db.commit()
+    return u
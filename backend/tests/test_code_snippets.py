@@ -0,0 +1,16 @@
+from core.mapcoder.coordinator import _code_block, _extract_code_snippet
+
+PROSE = "找到问题：边界条件未处理。\n建议在循环中判断空列表并返回，其余逻辑不变。"
+
+
+def test_prose_is_not_a_code_block():
+    assert _code_block(PROSE) is None
+    assert _code_block("") is None
+    # the lenient extractor still keeps multi-line prose as a fallback artifact
+    assert _extract_code_snippet(PROSE) == PROSE
+
+
+def test_fenced_block_and_bare_source_are_code():
+    fenced = "修复后的代码：\n```python\ndef f(a):\n    return a\n```\n说明：..."
+    assert _code_block(fenced) == "def f(a):\n    return a"
+    assert _code_block("def f(a):\n    return a\n") == "def f(a):\n    return a"
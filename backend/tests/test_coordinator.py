@@ -0,0 +1,25 @@
+import asyncio
+
+from core.mapcoder.coordinator import CoordinatorService
+from core.models import AgentSession, AgentTask
+
+
+def run_session(db, user, prompt="用 Python 实现快速排序"):
+    async def main():
+        service = CoordinatorService(db)
+        session = await service.create_session(user.id, "quicksort", None, prompt)
+        await service.run_session(session)
+        return session.id
+
+    session_id = asyncio.run(main())
+    db.expire_all()
+    return db.get(AgentSession, session_id)
+
+
+def test_mock_session_produces_code(db, user):
+    session = run_session(db, user)
+    assert session.status == "completed"
+    assert "def quicksort" in session.final_result["code"]
+    winner = db.get(AgentTask, session.final_result["task_id"])
+    assert winner.title.startswith("debugger 子任务")
+    assert winner.status == "completed"
@@ -0,0 +1,96 @@
+import asyncio
+import json
+
+import pytest
+from starlette.requests import Request
+
+from core.dependencies import publish_event
+from core.event_bus import InMemoryEventBus, encode_event
+from core.event_hub import ClientDropped, SessionEventHub, close_event_hub
+from core.models import AgentSession
+from routers.auth import create_access_token
+from routers.mapcoder import session_events
+
+
+def publish(bus, session_id, n, log=True):
+    return bus.publish(session_id, encode_event({"type": "log", "n": n}), log=log)
+
+
+def test_replay_returns_only_missed_events():
+    async def main():
+        bus = InMemoryEventBus()
+        ids = [publish(bus, 1, n) for n in range(3)]
+        publish(bus, 2, 99)
+        missed, complete = await SessionEventHub(bus).replay(1, ids[0])
+        assert complete
+        assert [event_id for event_id, _ in missed] == ids[1:]
+        assert json.loads(missed[-1][1])["n"] == 2
+
+    asyncio.run(main())
+
+
+def test_replay_past_the_trimmed_log_is_incomplete():
+    async def main():
+        bus = InMemoryEventBus(maxlen=2)
+        ids = [publish(bus, 1, n) for n in range(4)]
+        hub = SessionEventHub(bus)
+        missed, complete = await hub.replay(1, ids[0])
+        assert not complete
+        assert [event_id for event_id, _ in missed] == ids[2:]
+        assert await hub.replay(1, "not-an-id") == ([], False)
+
+    asyncio.run(main())
+
+
+def test_slow_client_is_dropped_with_overflow():
+    async def main():
+        bus = InMemoryEventBus()
+        hub = SessionEventHub(bus, client_queue=2)
+        assert await hub.wait_connected(1)
+        async with hub.subscribe(1) as slow, hub.subscribe(1) as fast:
+            event_id = publish(bus, 1, 0)
+            received_id, payload = await fast.get(timeout=1)
+            assert received_id == event_id and json.loads(payload)["n"] == 0
+            for n in range(1, 3):
+                publish(bus, 1, n)
+            await asyncio.sleep(0)
+            with pytest.raises(ClientDropped):
+                while True:
+                    await slow.get(timeout=1)
+            assert hub.stats()["dropped_clients"] == 1
+            assert (await fast.get(timeout=1))[0] is not None
+        await hub.stop()
+
+    asyncio.run(main())
+
+
+def test_stream_resumes_from_last_event_id_without_duplicates(db, user):
+    session = AgentSession(user_id=user.id, title="s", status="running")
+    db.add(session)
+    db.commit()
+    session_id = session.id
+    token = create_access_token({"id": user.id})
+
+    async def main():
+        first = publish_event(session_id, {"type": "log", "n": 1})
+        second = publish_event(session_id, {"type": "log", "n": 2})
+        request = Request({"type": "http", "method": "GET", "path": "/", "query_string": b"",
+                           "headers": [(b"last-event-id", first.encode())]})
+        response = await session_events(session_id, request, token=token, db=db)
+        stream = response.body_iterator
+        try:
+            assert await stream.__anext__() == "event: keepalive\n\n"
+            # published after the subscription and before the replay: in both, sent once
+            third = publish_event(session_id, {"type": "log", "n": 3})
+            await asyncio.sleep(0)
+            frames = [await stream.__anext__() for _ in range(2)]
+            assert [f.split("\n", 1)[0] for f in frames] == [f"id: {second}", f"id: {third}"]
+            publish_event(session_id, {"type": "token_delta", "delta": "x"}, log=False)
+            fourth = publish_event(session_id, {"type": "log", "n": 4})
+            assert (await stream.__anext__()).startswith("data: ")
+            assert (await stream.__anext__()).startswith(f"id: {fourth}\n")
+        finally:
+            await stream.aclose()
+            await close_event_hub()
+
+    asyncio.run(main())
@@ -0,0 +1,115 @@
+from datetime import timedelta
+
+from core.dependencies import SessionLocal
+from core.mapcoder.leases import TaskLeaseManager, _now, lease_active, renew_leases
+from core.models import AgentSession, AgentTask
+
+
+def make_session(db, user, tasks=1):
+    session = AgentSession(user_id=user.id, title="s", status="running")
+    db.add(session)
+    db.flush()
+    rows = [AgentTask(session_id=session.id, title=f"t{i}", status="pending") for i in range(tasks)]
+    db.add_all(rows)
+    db.commit()
+    return session, rows
+
+
+def test_renew_leases_does_not_commit_pending_changes(db, user):
+    session, (task, other) = make_session(db, user, tasks=2)
+    leases = TaskLeaseManager(db, worker_id="w1", lease_seconds=60)
+    leases.claim_task(task.id)
+    task.lease_expires_at = _now() + timedelta(seconds=1)
+    db.commit()
+
+    other.title = "half-written"
+    assert renew_leases(session.id, "w1", 60) == 1
+    db.rollback()
+
+    fresh = SessionLocal()
+    try:
+        assert fresh.get(AgentTask, other.id).title == "t1"
+        assert fresh.get(AgentTask, task.id).lease_expires_at > _now() + timedelta(seconds=30)
+    finally:
+        fresh.close()
+
+
+def test_claim_is_exclusive_until_the_lease_expires(db, user):
+    _, (task,) = make_session(db, user)
+    w1 = TaskLeaseManager(db, worker_id="w1", lease_seconds=60)
+    w2 = TaskLeaseManager(db, worker_id="w2", lease_seconds=60)
+
+    claimed = w1.claim_task(task.id)
+    assert claimed is not None and claimed.lease_owner == "w1" and claimed.attempt_count == 1
+    assert lease_active(claimed)
+    assert w2.claim_task(task.id) is None
+
+    # w1 crashed: its lease lapses and w2 may take over
+    task.lease_expires_at = _now() - timedelta(seconds=1)
+    db.commit()
+    assert not lease_active(task)
+    claimed = w2.claim_task(task.id)
+    assert claimed is not None and claimed.lease_owner == "w2" and claimed.attempt_count == 2
+
+
+def test_claim_stops_after_max_attempts(db, user):
+    _, (task,) = make_session(db, user)
+    task.max_attempts = 1
+    db.commit()
+    leases = TaskLeaseManager(db, worker_id="w1", lease_seconds=60)
+    assert leases.claim_task(task.id) is not None
+    task.lease_expires_at = _now() - timedelta(seconds=1)
+    db.commit()
+    assert leases.claim_task(task.id) is None
+
+
+def test_heartbeat_only_renews_own_running_leases(db, user):
+    session, (mine, theirs, done) = make_session(db, user, tasks=3)
+    w1 = TaskLeaseManager(db, worker_id="w1", lease_seconds=60)
+    w2 = TaskLeaseManager(db, worker_id="w2", lease_seconds=60)
+    w1.claim_task(mine.id)
+    w2.claim_task(theirs.id)
+    w1.claim_task(done.id)
+    done.status = "completed"
+    soon = _now() + timedelta(seconds=1)
+    for t in (mine, theirs, done):
+        t.lease_expires_at = soon
+    db.commit()
+
+    assert w1.heartbeat(session.id) == 1
+    db.expire_all()
+    assert db.get(AgentTask, mine.id).lease_expires_at > soon
+    assert db.get(AgentTask, theirs.id).lease_expires_at == soon
+    assert db.get(AgentTask, done.id).lease_expires_at == soon
+
+
+def test_expire_stale_fails_lapsed_stage_tasks(db, user):
+    session, (root, stage, live) = make_session(db, user, tasks=3)
+    leases = TaskLeaseManager(db, worker_id="w1", lease_seconds=60)
+    for t in (root, stage, live):
+        leases.claim_task(t.id)
+    root.lease_expires_at = stage.lease_expires_at = _now() - timedelta(seconds=1)
+    db.commit()
+
+    stale = leases.expire_stale(session.id, exclude_id=root.id)
+    assert [t.id for t in stale] == [stage.id]
+    assert stage.status == "failed" and stage.lease_owner is None
+    assert root.status == "running" and live.status == "running"
+
+
+def test_reclaim_orphaned_roots(db, user):
+    _, (retry,) = make_session(db, user)
+    _, (exhausted,) = make_session(db, user)
+    _, (alive,) = make_session(db, user)
+    leases = TaskLeaseManager(db, worker_id="w1", lease_seconds=60)
+    for t in (retry, exhausted, alive):
+        leases.claim_task(t.id)
+    exhausted.attempt_count = exhausted.max_attempts
+    retry.lease_expires_at = exhausted.lease_expires_at = _now() - timedelta(seconds=1)
+    db.commit()
+
+    reclaimed = TaskLeaseManager(db, worker_id="w2").reclaim_orphaned_roots()
+    assert {t.id for t in reclaimed} == {retry.id, exhausted.id}
+    assert retry.status == "pending" and retry.lease_owner is None
+    assert exhausted.status == "failed"
+    assert alive.status == "running" and alive.lease_owner == "w1"
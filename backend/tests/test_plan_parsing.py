@@ -0,0 +1,43 @@
+from core.mapcoder.coordinator import _parse_candidate_plans
+
+
+def labels(text):
+    return [label for label, _, _ in _parse_candidate_plans(text)]
+
+
+def test_parses_inline_headings_by_confidence():
+    text = "计划A(置信度0.6)：步骤1, 步骤2。\n计划B(置信度0.9)：步骤1, 步骤2。\n计划C(置信度40%)：步骤1。"
+    plans = _parse_candidate_plans(text)
+    assert [(label, confidence) for label, _, confidence in plans] == [("B", 0.9), ("A", 0.6), ("C", 0.4)]
+    assert plans[0][1].startswith("计划B")
+
+
+def test_parses_markdown_headings():
+    text = (
+        "## Plan 1: brute force\nconfidence: 0.5\n\n"
+        "## **Plan 2**\nuse a heap, confidence 0.8\n\n"
+        "> 方案三、贪心\n置信度 0.3\n"
+    )
+    assert labels(text) == ["2", "1", "三"]
+
+
+def test_ignores_words_and_list_items_that_mention_plans():
+    text = (
+        "Planning: consider the constraints first.\n"
+        "计划A：排序后二分。置信度0.7\n"
+        "- 计划A的风险：边界处理\n"
+        "Plans: may overlap.\n"
+        "Plan A is simple but slow.\n"
+        "计划B：动态规划。置信度0.8\n"
+        "* plan B: 备注\n"
+    )
+    plans = _parse_candidate_plans(text)
+    assert [label for label, _, _ in plans] == ["B", "A"]
+    assert "计划A的风险" in plans[1][1]
+    assert "Plan A is simple" in plans[1][1]
+
+
+def test_needs_at_least_two_plans():
+    assert _parse_candidate_plans("计划A：直接模拟。") == []
+    assert _parse_candidate_plans("Planning notes\nPlans overview\n- 计划A的风险") == []
+    assert _parse_candidate_plans(None) == []
@@ -0,0 +1,20 @@
+import asyncio
+
+from core.mapcoder import provider
+
+
+def test_unexpected_error_is_not_answered_with_the_mock(monkeypatch):
+    backend = provider.OpenAICompatibleBackend("http://llm.invalid/v1")
+    monkeypatch.setattr(provider, "_resolve", lambda model_id, api_key: (backend, "gpt-4o", "sk-test"))
+
+    async def broken(*args, **kwargs):
+        raise RuntimeError("bug")
+
+    monkeypatch.setattr(provider.get_single_flight(), "do_async", broken)
+    resp = asyncio.run(provider.acomplete("请根据以下任务生成可运行的代码：\n任务：排序", role="coding"))
+    assert resp.text == ""
+
+
+def test_unconfigured_provider_answers_with_the_mock():
+    resp = asyncio.run(provider.acomplete("请根据以下任务生成可运行的代码：\n任务：排序", role="coding"))
+    assert "def quicksort" in resp.text
@@ -0,0 +1,42 @@
+import asyncio
+
+import pytest
+
+from core.mapcoder.coordinator import CoordinatorService
+from core.models import AgentSession
+from core.query_stats import QUERY_BUDGET_SESSION, assert_max_queries
+from routers.mapcoder import _session_to_detail
+
+
+def run_session(db, user):
+    async def main():
+        service = CoordinatorService(db)
+        session = await service.create_session(user.id, "quicksort", None, "用 Python 实现快速排序")
+        with assert_max_queries(QUERY_BUDGET_SESSION, "coordinator run") as stats:
+            await service.run_session(session)
+        return session.id, stats.count
+
+    return asyncio.run(main())
+
+
+def test_coordinator_run_stays_within_the_session_budget(db, user):
+    session_id, count = run_session(db, user)
+    assert count > 0
+    assert db.get(AgentSession, session_id).status == "completed"
+
+
+def test_session_detail_query_count_does_not_grow_with_tasks(db, user):
+    session_id, _ = run_session(db, user)
+    session = db.get(AgentSession, session_id)
+    db.expire_all()
+    # tasks, logs and messages: one statement each (plus loading the expired session)
+    with assert_max_queries(4, "session detail"):
+        detail = _session_to_detail(session, db)
+    assert len(detail.tasks) > 5
+
+
+def test_assert_max_queries_reports_the_statements(db, user):
+    with pytest.raises(AssertionError, match="执行了 3 条 SQL，上限 2"):
+        with assert_max_queries(2, "loop"):
+            for _ in range(3):
+                db.get(AgentSession, 1, populate_existing=True)
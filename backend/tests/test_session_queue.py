@@ -0,0 +1,105 @@
+import asyncio
+import time
+from datetime import timedelta
+
+from core.mapcoder import session_queue
+from core.mapcoder.coordinator import CoordinatorService
+from core.mapcoder.leases import _now
+from core.mapcoder.session_queue import InMemorySessionQueue, SessionWorkerPool
+from core.models import AgentSession, AgentTask
+
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def idle(q):
+    stats = q.stats()
+    return stats["pending"] == 0 and stats["processing"] == 0
+
+
+def create_session(db, user):
+    session = asyncio.run(CoordinatorService(db).create_session(user.id, "quicksort", None, "用 Python 实现快速排序"))
+    return session.id
+
+
+def test_ack_and_nack():
+    q = InMemorySessionQueue(max_attempts=2)
+    q.enqueue(1)
+    job = q.reserve(timeout=0.1)
+    assert job.session_id == 1
+    assert q.stats()["processing"] == 1
+    q.ack(job)
+    assert q.stats() == {"backend": "memory", "pending": 0, "processing": 0, "dead": 0}
+
+    q.enqueue(2)
+    job = q.reserve(timeout=0.1)
+    q.nack(job)
+    retry = q.reserve(timeout=0.1)
+    assert (retry.id, retry.attempt) == (job.id, 1)
+    q.nack(retry)
+    assert q.reserve(timeout=0.1) is None
+    assert q.stats()["dead"] == 1
+
+
+def test_pool_runs_a_job_and_skips_a_duplicate_delivery(db, user):
+    session_id = create_session(db, user)
+    q = InMemorySessionQueue()
+    pool = SessionWorkerPool(q, workers=1)
+    pool.start()
+    try:
+        q.enqueue(session_id)
+        assert wait_for(lambda: idle(q) and pool.active == 0)
+        db.expire_all()
+        assert db.get(AgentSession, session_id).status == "completed"
+        tasks = db.query(AgentTask).filter_by(session_id=session_id).count()
+
+        # at-least-once delivery: the same session again must not run a second time
+        q.enqueue(session_id)
+        assert wait_for(lambda: idle(q) and pool.active == 0)
+        db.expire_all()
+        assert db.query(AgentTask).filter_by(session_id=session_id).count() == tasks
+        assert q.stats()["dead"] == 0
+    finally:
+        pool.stop()
+
+
+def test_failing_job_is_retried_then_dead_lettered(monkeypatch):
+    calls = []
+
+    async def failing(job):
+        calls.append(job.attempt)
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(session_queue, "run_session_job", failing)
+    q = InMemorySessionQueue(max_attempts=3)
+    pool = SessionWorkerPool(q, workers=1)
+    monkeypatch.setattr(pool, "_recover_orphaned_sessions", lambda: None)
+    pool.start()
+    try:
+        q.enqueue(42)
+        assert wait_for(lambda: q.stats()["dead"] == 1)
+    finally:
+        pool.stop()
+    assert calls == [0, 1, 2]
+    assert idle(q)
+
+
+def test_sweeper_requeues_a_session_whose_worker_died(db, user):
+    session_id = create_session(db, user)
+    root = db.query(AgentTask).filter_by(session_id=session_id, parent_id=None).one()
+    root.status, root.attempt_count = "running", 1
+    root.lease_owner, root.lease_expires_at = "dead-worker", _now() - timedelta(seconds=5)
+    db.commit()
+
+    q = InMemorySessionQueue()
+    SessionWorkerPool(q, workers=1)._recover_orphaned_sessions()
+    job = q.reserve(timeout=0.1)
+    assert job is not None and job.session_id == session_id
+    db.expire_all()
+    assert db.get(AgentTask, root.id).status == "pending"
@@ -0,0 +1,79 @@
+import asyncio
+
+import pytest
+
+from core.mapcoder.singleflight import SingleFlight
+
+
+def test_cancelled_follower_does_not_cancel_the_flight():
+    async def main():
+        flights = SingleFlight()
+        release = asyncio.Event()
+        calls = []
+
+        async def upstream(emit):
+            calls.append(1)
+            await release.wait()
+            return "answer"
+
+        leader = asyncio.ensure_future(flights.do_async("k", upstream))
+        await asyncio.sleep(0)
+        f1 = asyncio.ensure_future(flights.do_async("k", upstream))
+        f2 = asyncio.ensure_future(flights.do_async("k", upstream))
+        await asyncio.sleep(0)
+        f1.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await f1
+        release.set()
+        assert await leader == ("answer", False)
+        assert await f2 == ("answer", True)
+        assert len(calls) == 1
+        assert flights.stats()["in_flight"] == 0
+
+    asyncio.run(main())
+
+
+def test_cancelled_leader_hands_over_to_a_follower():
+    async def main():
+        flights = SingleFlight()
+        started = asyncio.Event()
+        got = []
+
+        async def slow(emit):
+            emit("a")
+            started.set()
+            await asyncio.sleep(10)
+
+        async def fresh(emit):
+            for delta in "abc":
+                emit(delta)
+            return "abc"
+
+        leader = asyncio.ensure_future(flights.do_async("k", slow, lambda d: None))
+        await started.wait()
+        follower = asyncio.ensure_future(flights.do_async("k", fresh, got.append))
+        await asyncio.sleep(0)
+        leader.cancel()
+        assert await follower == ("abc", False)
+        # "a" was replayed on join; the new flight does not send it again
+        assert got == ["a", "b", "c"]
+
+    asyncio.run(main())
+
+
+def test_leader_error_reaches_followers():
+    async def main():
+        flights = SingleFlight()
+        release = asyncio.Event()
+
+        async def failing(emit):
+            await release.wait()
+            raise ValueError("upstream")
+
+        tasks = [asyncio.ensure_future(flights.do_async("k", failing)) for _ in range(3)]
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        assert all(isinstance(r, ValueError) for r in results)
+
+    asyncio.run(main())